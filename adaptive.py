@@ -0,0 +1,179 @@
+"""
+adaptive.py
+
+Adaptive concurrency for the hashing and upload stages. An
+AdaptiveController measures the throughput and latency its workers report
+and moves the number of workers allowed to run between minWorkers and
+maxWorkers, AIMD style: one more worker per window while latency stays
+close to the best seen, half as many as soon as it degrades. A RateLimiter
+caps the bytes per second of a stage, e.g. to keep the site link usable
+during business hours.
+"""
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class RateLimiter(object):
+    """
+    Token bucket allowing rate bytes per second on average, with bursts of
+    up to one second worth of bytes. A rate of None means unlimited.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.tokens = float(rate or 0)
+        self.last = time.time()
+
+    def consume(self, amount):
+        """
+        Block until amount bytes may be transferred. Returns the seconds
+        waited.
+        """
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class AdaptiveController(object):
+    """
+    Limit the number of concurrently running workers of a stage. Workers
+    call acquire() and release() around each item and record() the bytes
+    they processed and the seconds they spent on them, not counting time
+    spent waiting on a RateLimiter. Every window seconds the limit is
+    raised by one while the latency per byte is within latencyFactor of the
+    best seen and all allowed workers were busy, and halved when it is
+    not. The limit is not raised while the stage runs at limiter's rate.
+    """
+
+    def __init__(self, name, minWorkers=1, maxWorkers=8, window=2.0,
+                 latencyFactor=1.5, limiter=None):
+        self.name = name
+        self.minWorkers = max(1, minWorkers)
+        self.maxWorkers = max(self.minWorkers, maxWorkers)
+        self.window = window
+        self.latencyFactor = latencyFactor
+        self.limiter = limiter
+        self.limit = self.minWorkers
+        self.active = 0
+        self.cond = threading.Condition()
+        self.bestLatency = None
+        self.startWindow(time.time())
+
+    def startWindow(self, now):
+        self.windowStart = now
+        self.windowBytes = 0
+        self.windowSeconds = 0.0
+        self.windowMaxActive = self.active
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+            self.windowMaxActive = max(self.windowMaxActive, self.active)
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def record(self, numBytes, seconds):
+        with self.cond:
+            self.windowBytes += numBytes
+            self.windowSeconds += seconds
+            now = time.time()
+            if now - self.windowStart >= self.window:
+                self.adjust(now - self.windowStart)
+                self.startWindow(now)
+
+    def adjust(self, elapsed):
+        """
+        Update the worker limit from the measurements of the last window.
+        Called with the lock held.
+        """
+        if self.windowBytes <= 0:
+            return None
+        throughput = self.windowBytes / elapsed
+        latency = self.windowSeconds / self.windowBytes
+        if self.bestLatency is None or latency < self.bestLatency:
+            self.bestLatency = latency
+        limit = self.limit
+        if latency > self.bestLatency * self.latencyFactor:
+            limit = max(self.minWorkers, self.limit // 2)
+        elif self.windowMaxActive >= self.limit and \
+                not self.atRateLimit(throughput):
+            limit = min(self.maxWorkers, self.limit + 1)
+        if limit != self.limit:
+            logging.debug("%s workers %s -> %s at %.1f MB/s"
+                          % (self.name, self.limit, limit,
+                             throughput / (1024 * 1024)))
+            self.limit = limit
+            self.cond.notify_all()
+        return None
+
+    def atRateLimit(self, throughput):
+        return self.limiter is not None and self.limiter.rate is not None \
+            and throughput >= 0.9 * self.limiter.rate
+
+
+class Meter(object):
+    """
+    Progress callback for spinnaker.checksums(): reports every read to a
+    controller, paces the reads with a limiter and passes the progress on
+    to callback.
+    """
+
+    def __init__(self, controller=None, limiter=None, callback=None):
+        self.controller = controller
+        self.limiter = limiter
+        self.callback = callback
+        self.done = 0
+        self.last = time.time()
+
+    def __call__(self, done, total):
+        numBytes = done - self.done
+        self.done = done
+        if self.controller is not None:
+            self.controller.record(numBytes, time.time() - self.last)
+        if self.limiter is not None:
+            self.limiter.consume(numBytes)
+        if self.callback is not None:
+            self.callback(done, total)
+        self.last = time.time()
+
+
+def mapAdaptive(func, items, controller):
+    """
+    Return [func(item) for item in items], running up to
+    controller.maxWorkers threads of which at most controller.limit work at
+    once.
+    """
+    items = list(items)
+    if controller.maxWorkers == 1 or len(items) < 2:
+        return [func(item) for item in items]
+
+    def run(item):
+        controller.acquire()
+        try:
+            return func(item)
+        finally:
+            controller.release()
+
+    pool = ThreadPool(min(controller.maxWorkers, len(items)))
+    try:
+        return pool.map(run, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
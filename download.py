@@ -0,0 +1,284 @@
+"""
+download.py
+
+Download the objects listed in an upload receipt or a file browser manifest
+with a bounded pool of icgc-storage-client processes, and verify each file
+against the checksums recorded at upload time.
+"""
+import logging
+from optparse import OptionParser
+import sys
+import os
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+import spinnaker
+
+
+def getOptions():
+    """
+    parse options
+    """
+    usage_text = []
+    usage_text.append("%prog [options] [receipt or manifest tsv files]")
+
+    description_text = []
+    description_text.append("Download client for Analysis Core")
+    description_text.append("Downloads all objects listed in the input files "
+                            "and verifies their size, md5 and sha1 sums.")
+
+    parser = OptionParser(usage="\n".join(usage_text), description="\n"
+                          .join(description_text))
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+                      dest="verbose", help="Switch for verbose mode.")
+    parser.add_option("-d", "--output-dir", action="store", default="/data",
+                      type="string", dest="outputDir",
+                      help="download directory. Files are stored as "
+                      "<bundle_uuid>/<file name>.")
+    parser.add_option("-j", "--concurrency", action="store", default=4,
+                      type="int", dest="concurrency",
+                      help="Number of storage client processes run at once.")
+    parser.add_option("--force", action="store_true", default=False,
+                      dest="force",
+                      help="Download objects even if a verified copy exists.")
+
+    (options, args) = parser.parse_args()
+
+    return (options, args, parser)
+
+
+def loadRegistrationMd5s(registrationFile):
+    """
+    Map (bundle_uuid, file name) to the md5 in a registration manifest.
+    """
+    md5s = {}
+    for row in spinnaker.readTsv(spinnaker.readFileLines(registrationFile)):
+        md5s[(row["gnos_id"], os.path.basename(row["file_path"]))] = \
+            row["file_md5"]
+    return md5s
+
+
+def loadBundleChecksums(bundleDir):
+    """
+    Map file names to (file_size, file_sha) from a bundle's metadata.json.
+    """
+    checksums = {}
+    metadataPath = os.path.join(bundleDir, "metadata.json")
+    if os.path.isfile(metadataPath):
+        bundle = spinnaker.Bundle.from_dict(spinnaker.loadJsonObj(
+            metadataPath))
+        for output in bundle.workflow_outputs:
+            checksums[os.path.basename(output.file_path)] = \
+                (output.file_size, output.file_sha)
+    return checksums
+
+
+def readDownloadList(fileName, registrationFileName="registration.tsv"):
+    """
+    Read the objects to download from a receipt.tsv or a file browser
+    manifest. Sizes and checksums are taken from the file's own columns if
+    present, otherwise from the bundle metadata.json files and registration
+    manifest next to a receipt.
+    """
+    inputDir = os.path.dirname(os.path.abspath(fileName))
+    registrationFile = os.path.join(inputDir, registrationFileName)
+    md5s = {}
+    if os.path.isfile(registrationFile):
+        md5s = loadRegistrationMd5s(registrationFile)
+
+    bundleChecksums = {}
+    objects = []
+    reader = spinnaker.readTsv(spinnaker.readFileLines(fileName))
+    for row in spinnaker.processFieldNames(reader):
+        object_id = row.get("file_uuid") or row.get("upload_file_id")
+        bundle_uuid = row.get("bundle_uuid") or row.get("data_bundle_id")
+        file_name = row.get("file_path") or row.get("file_name")
+        if not object_id or not bundle_uuid or not file_name:
+            logging.warn("skipping row without object id, bundle id or file "
+                         "name in %s" % fileName)
+            continue
+        file_name = os.path.basename(file_name)
+        if bundle_uuid not in bundleChecksums:
+            bundleChecksums[bundle_uuid] = loadBundleChecksums(
+                os.path.join(inputDir, bundle_uuid))
+        file_size, file_sha = bundleChecksums[bundle_uuid].get(
+            file_name, (None, None))
+        if row.get("file_size"):
+            file_size = int(row["file_size"])
+        file_md5 = row.get("file_md5") or \
+            md5s.get((bundle_uuid, file_name))
+        objects.append({"object_id": object_id, "bundle_uuid": bundle_uuid,
+                        "file_name": file_name, "file_size": file_size,
+                        "file_md5": file_md5,
+                        "file_sha": row.get("file_sha") or file_sha})
+    return objects
+
+
+def verifyFile(filePath, obj, sums=None):
+    """
+    Check filePath against the recorded size and checksums of obj. Returns
+    None if it matches, otherwise the reason it doesn't. sums, a dict
+    shared by the links of one object, keeps the checksums by inode so
+    that hard links to the same file are hashed once.
+    """
+    if not os.path.isfile(filePath):
+        return "missing"
+    st = os.stat(filePath)
+    if obj["file_size"] is not None and st.st_size != obj["file_size"]:
+        return "size differs"
+    if obj["file_sha"] is None and obj["file_md5"] is None:
+        return None
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    if sums is None or key not in sums:
+        checksums = spinnaker.checksums(filePath, progress=False)
+        if sums is None:
+            sums = {}
+        sums[key] = checksums
+    file_sha, file_md5 = sums[key]
+    if obj["file_sha"] is not None and file_sha != obj["file_sha"]:
+        return "sha1 differs"
+    if obj["file_md5"] is not None and file_md5 != obj["file_md5"]:
+        return "md5 differs"
+    return None
+
+
+def isVerifiable(obj):
+    return obj["file_size"] is not None or obj["file_sha"] is not None or \
+        obj["file_md5"] is not None
+
+
+# objects are downloaded as <outputDir>/.objects/<object id> and linked to
+# <bundle_uuid>/<file name>; deduplicated and previously uploaded files
+# are objects of another bundle
+OBJECT_DIR = ".objects"
+
+
+def downloadObject(objs, outputDir, force=False):
+    """
+    Download one object with icgc-storage-client and place it at every
+    <bundle_uuid>/<file name> of objs, the rows sharing its object id, and
+    verify each. Returns a list of (obj, status) where status is "skipped",
+    "downloaded" or an error.
+    """
+    filePaths = [os.path.join(outputDir, obj["bundle_uuid"], obj["file_name"])
+                 for obj in objs]
+    sums = {}
+    if not force and all(isVerifiable(obj) and os.path.isfile(filePath) and
+                         verifyFile(filePath, obj, sums) is None
+                         for obj, filePath in zip(objs, filePaths)):
+        logging.info("%s already present" % ", ".join(filePaths))
+        return [(obj, "skipped") for obj in objs]
+
+    objectDir = os.path.join(outputDir, OBJECT_DIR)
+    objectPath = os.path.join(objectDir, objs[0]["object_id"])
+    command = "icgc-storage-client download --output-dir {} --object-id {} " \
+        "--output-layout id --force".format(objectDir, objs[0]["object_id"])
+    logging.info("downloading: {}".format(command))
+    try:
+        subprocess.check_output(command, cwd=os.getcwd(),
+                                stderr=subprocess.STDOUT, shell=True,
+                                executable="/bin/bash")
+    except subprocess.CalledProcessError as exc:
+        spinnaker.writeJarExceptionsToLog(exc.output)
+        return [(obj, "download failed") for obj in objs]
+    if not os.path.isfile(objectPath):
+        return [(obj, "download failed: %s missing" % objectPath)
+                for obj in objs]
+
+    results = []
+    numHardlinks = 0
+    sums = {}
+    for obj, filePath in zip(objs, filePaths):
+        spinnaker.mkdir_p(os.path.dirname(filePath))
+        if os.path.lexists(filePath):
+            os.unlink(filePath)
+        if spinnaker.linkFile(os.path.abspath(objectPath), filePath,
+                              "hardlink") == "hardlink":
+            numHardlinks += 1
+        error = verifyFile(filePath, obj, sums)
+        if error is not None:
+            results.append((obj, "verification failed: " + error))
+        else:
+            results.append((obj, "downloaded"))
+    if numHardlinks == len(objs):
+        os.unlink(objectPath)
+    return results
+
+
+def downloadObjects(objects, outputDir, concurrency=4, force=False):
+    """
+    Download objects with at most concurrency storage client processes,
+    each object id once. Returns a map of status to list of objects.
+    """
+    groups = []
+    groupsById = {}
+    for obj in objects:
+        group = groupsById.get(obj["object_id"])
+        if group is None:
+            group = groupsById[obj["object_id"]] = []
+            groups.append(group)
+        group.append(obj)
+    results = {}
+    pool = ThreadPool(max(1, concurrency))
+    try:
+        for groupResults in pool.imap_unordered(
+                lambda objs: downloadObject(objs, outputDir, force), groups):
+            for obj, status in groupResults:
+                if status not in ("skipped", "downloaded"):
+                    logging.error("%s (%s/%s): %s" % (
+                        obj["object_id"], obj["bundle_uuid"],
+                        obj["file_name"], status))
+                results.setdefault(status, []).append(obj)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def main():
+    startTime = spinnaker.getNow()
+    (options, args, parser) = getOptions()
+
+    if len(args) == 0:
+        logging.error("no input files")
+        sys.exit(1)
+
+    if options.verbose:
+        logLevel = logging.DEBUG
+    else:
+        logLevel = logging.INFO
+    logfileName = os.path.basename(__file__).replace(".py", ".log")
+    spinnaker.mkdir_p(options.outputDir)
+    logFilePath = os.path.join(options.outputDir, logfileName)
+    logFormat = "%(asctime)s %(levelname)s %(funcName)s:%(lineno)d %(message)s"
+    spinnaker.setupLogging(logFilePath, logFormat, logLevel)
+
+    objects = []
+    seen = set()
+    for fileName in args:
+        for obj in readDownloadList(fileName):
+            key = (obj["object_id"], obj["bundle_uuid"], obj["file_name"])
+            if key not in seen:
+                seen.add(key)
+                objects.append(obj)
+    logging.info("%s files of %s objects to download"
+                 % (len(objects), len(set(key[0] for key in seen))))
+
+    results = downloadObjects(objects, options.outputDir,
+                              options.concurrency, options.force)
+    counts = dict((status, len(objs)) for status, objs in results.items())
+    logging.info("counts\t%s" % counts)
+
+    runTime = spinnaker.getTimeDelta(startTime).total_seconds()
+    logging.info("Download took %s s." % str(runTime))
+    numFailed = len(objects) - len(results.get("skipped", [])) - \
+        len(results.get("downloaded", []))
+    if numFailed:
+        logging.error("%s downloads failed. A detailed log is at: %s"
+                      % (numFailed, logFilePath))
+        sys.exit(1)
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+events.py
+
+Structured progress events for upload monitoring. Events are dicts with at
+least "time" and "event" keys and are written as JSON lines to a file
+descriptor or file, passed to a callback, and/or pushed in batches to the
+submission server.
+
+Event types:
+    phase     {"phase": name} when the submission enters a new phase
+    progress  {"stage": "hash"|"upload", "item", "done", "total",
+               "rate" (bytes/s), "eta" (s)}, throttled per item
+    <other>   free-form events such as "plan", "file" or "error"
+
+Each submission emits to its own child() stream, which stamps its events
+with the submission's fields (manifests, submission_id) and passes them on
+to the sinks of the shared stream, so concurrent submissions can be told
+apart. The submission's SubmissionPushSink is a sink of its child stream.
+"""
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+import requests
+
+
+class JsonLinesSink(object):
+    """
+    Write events as JSON lines to a file object.
+    """
+
+    def __init__(self, fileObj):
+        self.fileObj = fileObj
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, sort_keys=True) + "\n"
+        with self.lock:
+            self.fileObj.write(line)
+            self.fileObj.flush()
+
+    def close(self):
+        if self.fileObj not in (sys.stdout, sys.stderr):
+            self.fileObj.close()
+
+
+class SubmissionPushSink(object):
+    """
+    Collect events and PUT them in batches to
+    <submissionServerUrl>/v0/submissions/<id> as {"events": [...]}.
+    Events are buffered until the submission id is known, and those
+    emitted before it get it stamped on. The batches are pushed by a
+    thread of the sink, every interval seconds or once batchSize events
+    are waiting, so emitting threads never wait for the server.
+    """
+
+    def __init__(self, submissionServerUrl, batchSize=100, interval=10.0,
+                 session=requests):
+        self.submissionServerUrl = submissionServerUrl
+        self.batchSize = batchSize
+        self.interval = interval
+        self.session = session
+        self.submission_id = None
+        self.batch = []
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="event-push")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def setSubmission(self, submission_id):
+        with self.condition:
+            self.submission_id = submission_id
+            self.batch = [dict(event, submission_id=submission_id)
+                          if event.get("submission_id") is None else event
+                          for event in self.batch]
+            self.condition.notify()
+
+    def __call__(self, event):
+        with self.condition:
+            self.batch.append(event)
+            if len(self.batch) >= self.batchSize:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.closed and len(self.batch) < self.batchSize:
+                    self.condition.wait(self.interval)
+                closed = self.closed
+            self.flush()
+            if closed:
+                return None
+
+    def flush(self):
+        with self.condition:
+            if self.submission_id is None or not self.batch:
+                return None
+            batch, self.batch = self.batch, []
+        try:
+            self.session.put(self.submissionServerUrl +
+                             "/v0/submissions/{}".format(self.submission_id),
+                             json={"events": batch})
+        except requests.RequestException:
+            # monitoring must not break the upload, retry with the next batch
+            with self.condition:
+                self.batch = batch + self.batch
+        return None
+
+    def close(self):
+        """
+        Push what is left and stop the thread.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        return None
+
+
+class EventStream(object):
+    """
+    Emit events to any number of sinks (callables taking the event dict).
+    Progress events of one item are throttled to one per minInterval
+    seconds, except for the first and last one. Every event carries the
+    stream's fields; events of a child stream also go to its parent's
+    sinks.
+    """
+
+    def __init__(self, sinks=None, minInterval=1.0, parent=None,
+                 fields=None):
+        self.sinks = list(sinks or [])
+        self.minInterval = minInterval
+        self.parent = parent
+        self.fields = dict(fields or {})
+        self.lock = threading.Lock()
+        # (stage, item) -> [start time, last emit time]
+        self.progressTimes = {}
+
+    def child(self, **fields):
+        """
+        A stream for one submission, stamping its events with fields.
+        """
+        return EventStream(minInterval=self.minInterval, parent=self,
+                           fields=dict(self.fields, **fields))
+
+    def setField(self, key, value):
+        with self.lock:
+            self.fields[key] = value
+
+    def addSink(self, sink):
+        with self.lock:
+            self.sinks.append(sink)
+
+    def hasSinks(self):
+        return bool(self.sinks) or \
+            (self.parent is not None and self.parent.hasSinks())
+
+    def deliver(self, event):
+        # sinks are called outside the lock, they may block
+        with self.lock:
+            sinks = list(self.sinks)
+        for sink in sinks:
+            sink(event)
+        if self.parent is not None:
+            self.parent.deliver(event)
+        return None
+
+    def emit(self, eventType, **fields):
+        if not self.hasSinks():
+            return None
+        with self.lock:
+            event = dict(self.fields)
+        event.update(fields)
+        event["event"] = eventType
+        event["time"] = datetime.datetime.utcnow().isoformat()
+        return self.deliver(event)
+
+    def phase(self, name, **fields):
+        return self.emit("phase", phase=name, **fields)
+
+    def progress(self, stage, item, done, total):
+        if not self.hasSinks():
+            return None
+        now = time.time()
+        key = (stage, item)
+        finished = total is not None and done >= total
+        with self.lock:
+            times = self.progressTimes.get(key)
+            if times is None:
+                times = self.progressTimes[key] = [now, None]
+            elif not finished and now - times[1] < self.minInterval:
+                return None
+            times[1] = now
+            if finished:
+                del self.progressTimes[key]
+        elapsed = now - times[0]
+        rate = done / elapsed if elapsed > 0 else None
+        eta = (total - done) / rate if rate and total is not None else None
+        return self.emit("progress", stage=stage, item=item, done=done,
+                         total=total, rate=rate, eta=eta)
+
+    def close(self):
+        """
+        Close the stream's own sinks, not those of its parent.
+        """
+        with self.lock:
+            sinks = list(self.sinks)
+        for sink in sinks:
+            if hasattr(sink, "close"):
+                sink.close()
+        return None
+
+
+def openSink(target):
+    """
+    Open a JSON lines sink for target: "-" for stdout, "fd:N" for an open
+    file descriptor, anything else is a file path to append to.
+    """
+    if target == "-":
+        return JsonLinesSink(sys.stdout)
+    if target.startswith("fd:"):
+        return JsonLinesSink(os.fdopen(int(target[3:]), "a"))
+    return JsonLinesSink(open(target, "a"))
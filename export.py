@@ -0,0 +1,142 @@
+"""
+export.py
+
+All bundles of a run in three files in the output dir, instead of (or next
+to) one <bundle_uuid>/metadata.json dir per bundle:
+
+    bundles.jsonl      one line of compact metadata.json per bundle
+    bundles.idx        bundle_uuid, offset and length of its line
+    bundle_files.tsv   one row per file: the bundle, the file name in the
+                       bundle, type, size, sha1, referenced bundle and the
+                       path the file was read from
+
+Indexers load everything with one sequential read of bundles.jsonl, or
+random-access single bundles through the index:
+
+    index = readIndex(outputDir)
+    bundle = loadBundle(outputDir, bundle_uuid, index)
+
+The files are written under temporary names and renamed into place, so
+they are either complete or not there.
+"""
+import csv
+import json
+import os
+import tempfile
+
+STREAM_FILE = "bundles.jsonl"
+INDEX_FILE = "bundles.idx"
+FILES_FILE = "bundle_files.tsv"
+
+INDEX_COLUMNS = ["bundle_uuid", "offset", "length"]
+FILES_COLUMNS = ["bundle_uuid", "file_name", "file_type", "file_size",
+                 "file_sha", "reference_bundle_uuid", "source_path"]
+
+
+def hasExport(outputDir):
+    return os.path.isfile(os.path.join(outputDir, STREAM_FILE))
+
+
+def toStr(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def openTemp(outputDir, fileName):
+    fd, tmpPath = tempfile.mkstemp(prefix="." + fileName, dir=outputDir)
+    return os.fdopen(fd, "wb"), tmpPath
+
+
+def writeBundleStream(bundles, outputDir):
+    """
+    Write the Bundles, a map of bundle uuid to Bundle, to bundles.jsonl
+    with its index and bundle_files.tsv. Bundles are written in bundle uuid
+    order and their file paths are cut to the file name, as in the bundle
+    dirs. Returns the number of bundles written.
+    """
+    if not os.path.isdir(outputDir):
+        os.makedirs(outputDir)
+    files = []
+    try:
+        stream, streamPath = openTemp(outputDir, STREAM_FILE)
+        files.append((stream, streamPath, STREAM_FILE))
+        index, indexPath = openTemp(outputDir, INDEX_FILE)
+        files.append((index, indexPath, INDEX_FILE))
+        table, tablePath = openTemp(outputDir, FILES_FILE)
+        files.append((table, tablePath, FILES_FILE))
+        indexWriter = csv.writer(index, delimiter="\t", lineterminator="\n")
+        indexWriter.writerow(INDEX_COLUMNS)
+        tableWriter = csv.writer(table, delimiter="\t", lineterminator="\n")
+        tableWriter.writerow(FILES_COLUMNS)
+
+        offset = 0
+        for bundle_uuid in sorted(bundles):
+            obj = bundles[bundle_uuid].to_dict()
+            analysis = obj["specimen"][0]["samples"][0]["analysis"][0]
+            for output in analysis["workflow_outputs"]:
+                source_path = output["file_path"]
+                output["file_path"] = source_path.split("/")[-1]
+                reference = output.get("file_reference") or {}
+                tableWriter.writerow([toStr(value) for value in [
+                    bundle_uuid, output["file_path"], output["file_type"],
+                    output.get("file_size", ""), output.get("file_sha", ""),
+                    reference.get("bundle_uuid", ""), source_path]])
+            line = json.dumps(obj, sort_keys=True,
+                              separators=(",", ":")) + "\n"
+            stream.write(line)
+            indexWriter.writerow([bundle_uuid, offset, len(line)])
+            offset += len(line)
+
+        for fileObj, tmpPath, fileName in files:
+            fileObj.flush()
+            os.fsync(fileObj.fileno())
+            fileObj.close()
+            os.chmod(tmpPath, 0644)
+        # the stream last, hasExport() means the export is complete
+        for fileObj, tmpPath, fileName in reversed(files):
+            os.rename(tmpPath, os.path.join(outputDir, fileName))
+    except:
+        for fileObj, tmpPath, fileName in files:
+            fileObj.close()
+            if os.path.exists(tmpPath):
+                os.unlink(tmpPath)
+        raise
+    return len(bundles)
+
+
+def readIndex(outputDir):
+    """
+    Map bundle uuid to (offset, length) of its line in bundles.jsonl.
+    """
+    index = {}
+    with open(os.path.join(outputDir, INDEX_FILE)) as indexFile:
+        reader = csv.reader(indexFile, delimiter="\t")
+        next(reader)
+        for bundle_uuid, offset, length in reader:
+            index[bundle_uuid] = (int(offset), int(length))
+    return index
+
+
+def loadBundle(outputDir, bundle_uuid, index=None):
+    """
+    The metadata.json dict of one bundle, read through the index. Returns
+    None if the bundle is not in the export.
+    """
+    if index is None:
+        index = readIndex(outputDir)
+    if bundle_uuid not in index:
+        return None
+    offset, length = index[bundle_uuid]
+    with open(os.path.join(outputDir, STREAM_FILE), "rb") as stream:
+        stream.seek(offset)
+        return json.loads(stream.read(length))
+
+
+def iterBundles(outputDir):
+    """
+    Yield the metadata.json dicts of all bundles, in one sequential read.
+    """
+    with open(os.path.join(outputDir, STREAM_FILE), "rb") as stream:
+        for line in stream:
+            yield json.loads(line)
@@ -0,0 +1,421 @@
+"""
+fetch.py
+
+Download files given as http(s):// URLs in the File Path column, hashing
+them while they download. A file is split into ranges that are fetched
+over several connections at once and written in place into a .part file
+next to the destination. Meanwhile the calling thread hashes the file in
+order as the ranges complete, reading them back while they are still in
+the page cache, and feeds the same chunks to an integrity inspector:
+
+    fetcher = Fetcher(connections=4)
+    sums = fetcher.fetch(url, destPath, inspector)
+
+The completed ranges are recorded in <destPath>.fetch.json, so an
+interrupted download resumes where it stopped, as long as the server
+still reports the same size and ETag or Last-Modified. Servers that don't
+support range requests are fetched over one connection and hashed as the
+data arrives.
+
+file:// URLs are not fetched, they name a local file, see getLocalPath().
+scripts/range_server.py serves a dir with range support to test against.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import posixpath
+import re
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+REMOTE_SCHEMES = ("http", "https")
+
+# bytes per range request, and per read when streaming and hashing
+RANGE_SIZE = 16 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+# statuses of range requests that are retried, like dropped connections
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class FetchError(Exception):
+    pass
+
+
+class RetryableFetchError(FetchError):
+    pass
+
+
+def getScheme(file_path):
+    if "://" not in file_path:
+        return None
+    return file_path.split("://", 1)[0].lower()
+
+
+def isUrl(file_path):
+    return getScheme(file_path) in REMOTE_SCHEMES + ("file",)
+
+
+def isRemote(file_path):
+    return getScheme(file_path) in REMOTE_SCHEMES
+
+
+def getLocalPath(fileUrl):
+    """
+    The local path named by a file:// URL.
+    """
+    url = urlparse.urlparse(fileUrl)
+    if url.netloc not in ("", "localhost"):
+        raise FetchError("%s is not on this host" % fileUrl)
+    return urllib.url2pathname(url.path)
+
+
+def getFileName(file_path):
+    """
+    Base name of a local path or of the path of a URL. For a URL ending in
+    a slash it is the last part of the path, empty if there is none.
+    """
+    if isUrl(file_path):
+        return urllib.unquote(posixpath.basename(
+            urlparse.urlparse(file_path).path.rstrip("/")))
+    return os.path.basename(file_path)
+
+
+def getHost(url):
+    url = urlparse.urlparse(url)
+    return "{}://{}".format(url.scheme, url.netloc)
+
+
+def getValidator(response):
+    return response.headers.get("ETag") or \
+        response.headers.get("Last-Modified")
+
+
+def statUrl(url, session=requests, verify=True):
+    """
+    Ask the server for the first byte of url. A GET is used rather than a
+    HEAD, presigned URLs are often only signed for GET. Returns
+    {"size", "ranges", "validator"}; size is None if the server doesn't
+    tell, ranges is whether it answered with a partial response.
+    """
+    try:
+        response = session.get(url, headers={"Range": "bytes=0-0"},
+                               stream=True, verify=verify)
+    except requests.RequestException as exc:
+        raise FetchError("can't connect: %s" % exc)
+    try:
+        if response.status_code == 206:
+            match = CONTENT_RANGE.match(
+                response.headers.get("Content-Range", ""))
+            if match is not None and match.group(3) != "*":
+                return {"size": int(match.group(3)), "ranges": True,
+                        "validator": getValidator(response)}
+            # Content-Length is that of the one byte, not of the file
+            return {"size": None, "ranges": False,
+                    "validator": getValidator(response)}
+        elif response.status_code == 416:
+            # an empty file has no first byte
+            return {"size": 0, "ranges": False, "validator": None}
+        elif response.status_code != 200:
+            raise FetchError("HTTP %s" % response.status_code)
+        size = response.headers.get("Content-Length")
+        return {"size": int(size) if size is not None else None,
+                "ranges": False, "validator": getValidator(response)}
+    finally:
+        response.close()
+
+
+def writeAll(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+class DownloadState(object):
+    """
+    The ranges of a download that are complete, kept in
+    <destPath>.fetch.json. Shared by the threads fetching the ranges and
+    the thread hashing them.
+    """
+
+    def __init__(self, path, url, info, rangeSize):
+        self.path = path
+        self.key = {"url": url, "size": info["size"],
+                    "validator": info["validator"], "range_size": rangeSize}
+        self.done = set()
+        self.bytesDone = 0
+        self.error = None
+        self.condition = threading.Condition()
+
+    def load(self):
+        """
+        Resume from the recorded state if it is for the same version of
+        the same file. Returns the number of bytes already there.
+        """
+        try:
+            with open(self.path) as stateFile:
+                state = json.load(stateFile)
+        except (IOError, ValueError):
+            return 0
+        if not self.key["validator"] or \
+                any(state.get(key) != value
+                    for key, value in self.key.items()):
+            return 0
+        self.done = set(state["done"])
+        self.bytesDone = sum(min(self.key["range_size"],
+                                 self.key["size"] - start)
+                             for start in self.done)
+        return self.bytesDone
+
+    def save(self):
+        state = dict(self.key, done=sorted(self.done))
+        directory = os.path.dirname(self.path)
+        fd, tmpPath = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        with os.fdopen(fd, "w") as stateFile:
+            json.dump(state, stateFile)
+        os.rename(tmpPath, self.path)
+
+    def complete(self, start):
+        with self.condition:
+            self.done.add(start)
+            self.save()
+            self.condition.notify_all()
+
+    def fail(self, error):
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.condition.notify_all()
+
+    def wait(self, start):
+        """
+        Block until the range at start is complete. Raises the error of a
+        failed range.
+        """
+        with self.condition:
+            while start not in self.done and self.error is None:
+                # a wait with a timeout can be interrupted with Ctrl-C
+                self.condition.wait(1.0)
+            if self.error is not None:
+                raise FetchError(self.error)
+
+
+class Fetcher(object):
+    """
+    Fetch URLs with up to connections range requests at once per file.
+    poolSize is the number of connections kept open to a host; raise it
+    when several files are fetched at once. callback(url, bytesDone,
+    size) is called as data arrives.
+    """
+
+    def __init__(self, connections=4, rangeSize=RANGE_SIZE, poolSize=None,
+                 retries=3, verify=True, callback=None):
+        self.connections = max(1, connections)
+        self.rangeSize = rangeSize
+        self.retries = retries
+        self.verify = verify
+        self.callback = callback
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=poolSize or self.connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def fetch(self, url, destPath, inspector=None):
+        """
+        Download url to destPath and return ('sha1$<hex>', '<md5 hex>') of
+        its content. An integrity.ContentInspector passed as inspector is
+        fed the content in order.
+        """
+        info = statUrl(url, self.session, self.verify)
+        directory = os.path.dirname(destPath)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        partPath = destPath + ".part"
+        statePath = destPath + ".fetch.json"
+        if info["ranges"] and info["size"]:
+            sums = self.fetchRanges(url, info, partPath, statePath, inspector)
+        else:
+            sums = self.fetchStream(url, info, partPath, inspector)
+        os.rename(partPath, destPath)
+        if os.path.exists(statePath):
+            os.unlink(statePath)
+        logging.info("fetched %s to %s" % (url, destPath))
+        return sums
+
+    def report(self, url, bytesDone, size):
+        if self.callback is not None:
+            self.callback(url, bytesDone, size)
+
+    def fetchStream(self, url, info, partPath, inspector):
+        """
+        GET the whole file over one connection, hashing what arrives.
+        """
+        sha1 = hashlib.sha1()
+        md5 = hashlib.md5()
+        bytesDone = 0
+        try:
+            response = self.session.get(url, stream=True, verify=self.verify)
+        except requests.RequestException as exc:
+            raise FetchError("can't connect: %s" % exc)
+        try:
+            if response.status_code != 200:
+                raise FetchError("HTTP %s" % response.status_code)
+            with open(partPath, "wb") as part:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    part.write(chunk)
+                    sha1.update(chunk)
+                    md5.update(chunk)
+                    if inspector is not None:
+                        inspector.update(chunk)
+                    bytesDone += len(chunk)
+                    self.report(url, bytesDone, info["size"])
+        except requests.RequestException as exc:
+            raise FetchError("download failed: %s" % exc)
+        finally:
+            response.close()
+        if info["size"] is not None and bytesDone != info["size"]:
+            raise FetchError("download ended after %s of %s bytes"
+                             % (bytesDone, info["size"]))
+        return ('sha1$' + sha1.hexdigest(), md5.hexdigest())
+
+    def fetchRanges(self, url, info, partPath, statePath, inspector):
+        """
+        Fetch the missing ranges of the file with a pool of connections
+        while the calling thread hashes the complete ones in order.
+        """
+        size = info["size"]
+        state = DownloadState(statePath, url, info, self.rangeSize)
+        if os.path.exists(partPath) and \
+                os.path.getsize(partPath) == size and state.load():
+            logging.info("resuming download of %s, %s of %s bytes are there"
+                         % (url, state.bytesDone, size))
+        else:
+            state.done = set()
+            state.bytesDone = 0
+            with open(partPath, "wb") as part:
+                part.truncate(size)
+        starts = range(0, size, self.rangeSize)
+        pending = [start for start in starts if start not in state.done]
+        pool = ThreadPool(min(self.connections, len(pending))) \
+            if pending else None
+        try:
+            for start in pending:
+                pool.apply_async(self.fetchRange,
+                                 (url, partPath, start,
+                                  min(start + self.rangeSize, size), state))
+            return self.hashRanges(partPath, starts, size, state, inspector)
+        except:
+            # the ranges not started yet give up at once
+            state.fail("download stopped")
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def fetchRange(self, url, partPath, start, end, state):
+        """
+        Fetch bytes start to end into the .part file, retrying failed
+        requests. Runs in the pool.
+        """
+        for attempt in xrange(self.retries + 1):
+            if state.error is not None:
+                return None
+            try:
+                self.getRange(url, partPath, start, end, state)
+                state.complete(start)
+                return None
+            except (requests.RequestException, IOError,
+                    RetryableFetchError) as exc:
+                if attempt == self.retries:
+                    state.fail("range %s-%s failed: %s"
+                               % (start, end - 1, exc))
+                    return None
+                logging.warn("retrying range %s-%s of %s: %s"
+                             % (start, end - 1, url, exc))
+                time.sleep(2 ** attempt)
+            except Exception as exc:
+                # e.g. the disk is full, the hashing thread must not wait
+                state.fail(str(exc))
+                return None
+        return None
+
+    def getRange(self, url, partPath, start, end, state):
+        headers = {"Range": "bytes=%s-%s" % (start, end - 1)}
+        if state.key["validator"]:
+            headers["If-Range"] = state.key["validator"]
+        response = self.session.get(url, headers=headers, stream=True,
+                                    verify=self.verify)
+        pos = start
+        try:
+            if response.status_code == 200:
+                raise FetchError("the file changed during the download")
+            if response.status_code in RETRY_STATUSES:
+                raise RetryableFetchError("HTTP %s for a range request"
+                                          % response.status_code)
+            if response.status_code != 206:
+                raise FetchError("HTTP %s for a range request"
+                                 % response.status_code)
+            fd = os.open(partPath, os.O_WRONLY)
+            try:
+                os.lseek(fd, start, os.SEEK_SET)
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if pos + len(chunk) > end:
+                        raise FetchError("the server sent more than the "
+                                         "range asked for")
+                    writeAll(fd, chunk)
+                    pos += len(chunk)
+                    with state.condition:
+                        state.bytesDone += len(chunk)
+                        self.report(url, state.bytesDone, state.key["size"])
+            finally:
+                os.close(fd)
+            if pos != end:
+                raise IOError("range ended after %s of %s bytes"
+                              % (pos - start, end - start))
+        except:
+            # counted again when the range is retried
+            with state.condition:
+                state.bytesDone -= pos - start
+            raise
+        finally:
+            response.close()
+        return None
+
+    def hashRanges(self, partPath, starts, size, state, inspector):
+        """
+        Hash the .part file in order, each range as soon as it is complete.
+        """
+        sha1 = hashlib.sha1()
+        md5 = hashlib.md5()
+        buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)
+        with io.open(partPath, "rb", buffering=0) as part:
+            for start in starts:
+                state.wait(start)
+                part.seek(start)
+                remaining = min(self.rangeSize, size - start)
+                while remaining:
+                    numBytes = part.readinto(view[:min(remaining,
+                                                       CHUNK_SIZE)])
+                    if not numBytes:
+                        raise FetchError("%s is shorter than %s bytes"
+                                         % (partPath, size))
+                    chunk = view[:numBytes]
+                    sha1.update(chunk)
+                    md5.update(chunk)
+                    if inspector is not None:
+                        inspector.update(chunk)
+                    remaining -= numBytes
+        return ('sha1$' + sha1.hexdigest(), md5.hexdigest())
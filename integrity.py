@@ -0,0 +1,398 @@
+"""
+integrity.py
+
+Check gzip and BGZF compressed files while they are hashed, and count their
+records. An inspector is fed the chunks of the single hashing read:
+
+    inspector = getInspector(filename)
+    for chunk in chunks:
+        inspector.update(chunk)
+    stats = inspector.finish()
+
+stats holds the format, the compression, the uncompressed size and, for
+fastq, vcf and bam, the number of records; or "error" if the file is
+truncated or corrupt. The blocks of BGZF files (bam, bgzip compressed vcf
+and fastq) are independent and decompressed by a pool of threads, zlib
+releases the GIL while it inflates. Plain gzip files are decompressed as
+one stream. Every member's CRC32 and size are checked.
+"""
+import multiprocessing
+import struct
+import threading
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+# file name suffix -> record format
+FORMATS = [
+    (".fastq.gz", "fastq"), (".fq.gz", "fastq"), (".vcf.gz", "vcf"),
+    (".vcf.bgz", "vcf"), (".bam", "bam"), (".gz", None)]
+
+GZIP_MAGIC = "\x1f\x8b"
+FTEXT, FHCRC, FEXTRA, FNAME, FCOMMENT = 1, 2, 4, 8, 16
+
+blockPool = None
+blockPoolLock = threading.Lock()
+
+
+class CorruptFileError(Exception):
+    pass
+
+
+def getBlockPool():
+    global blockPool
+    with blockPoolLock:
+        if blockPool is None:
+            blockPool = ThreadPool(multiprocessing.cpu_count())
+    return blockPool
+
+
+def getFormat(filename):
+    """
+    Returns (checked, record format) for filename; record format is None
+    for gzip files without known records.
+    """
+    lower = filename.lower()
+    for suffix, recordFormat in FORMATS:
+        if lower.endswith(suffix):
+            return True, recordFormat
+    return False, None
+
+
+def getInspector(filename):
+    """
+    ContentInspector for filename, or None if its format is not checked.
+    """
+    checked, recordFormat = getFormat(filename)
+    if not checked:
+        return None
+    return ContentInspector(recordFormat)
+
+
+def toBytes(buf):
+    """
+    str copy of a chunk from spinnaker.readChunks(), which may be a view
+    that is only valid until the next chunk is read.
+    """
+    if isinstance(buf, memoryview):
+        return buf.tobytes()
+    return str(buf)
+
+
+def parseGzipHeader(data, pos, offset=0):
+    """
+    Parse the gzip member header at data[pos:], which is at offset + pos in
+    the file. Returns (length of the header, BGZF block size or None), or
+    None if data ends before the header does.
+    """
+    if len(data) - pos < 10:
+        return None
+    if data[pos:pos + 2] != GZIP_MAGIC or data[pos + 2] != "\x08":
+        raise CorruptFileError("no gzip header at offset %s" % (offset + pos))
+    flags = ord(data[pos + 3])
+    end = pos + 10
+    blockSize = None
+    if flags & FEXTRA:
+        if len(data) - end < 2:
+            return None
+        xlen = struct.unpack("<H", data[end:end + 2])[0]
+        end += 2
+        if len(data) - end < xlen:
+            return None
+        extra = data[end:end + xlen]
+        end += xlen
+        i = 0
+        while i + 4 <= len(extra):
+            sublen = struct.unpack("<H", extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == "BC" and sublen == 2:
+                blockSize = struct.unpack("<H", extra[i + 4:i + 6])[0] + 1
+            i += 4 + sublen
+    for flag in (FNAME, FCOMMENT):
+        if flags & flag:
+            zero = data.find("\x00", end)
+            if zero < 0:
+                return None
+            end = zero + 1
+    if flags & FHCRC:
+        end += 2
+        if end > len(data):
+            return None
+    return end - pos, blockSize
+
+
+def summarizeText(data):
+    """
+    (newlines, lines starting with '#' after a newline, first byte, last
+    byte) of a piece of text, merged in order by TextCounter.
+    """
+    if not data:
+        return (0, 0, "", "")
+    return (data.count("\n"), data.count("\n#"), data[0], data[-1])
+
+
+class TextCounter(object):
+    """
+    Count the lines of a text stream from its summarizeText() pieces.
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.headerLines = 0
+        self.last = "\n"
+
+    def add(self, summary):
+        newlines, headerStarts, first, last = summary
+        if not first:
+            return None
+        if self.last == "\n" and first == "#":
+            self.headerLines += 1
+        self.lines += newlines
+        self.headerLines += headerStarts
+        self.last = last
+        return None
+
+    def getLines(self):
+        return self.lines + (self.last != "\n")
+
+
+class BamCounter(object):
+    """
+    Walk the decompressed BAM stream and count its alignment records.
+    """
+
+    def __init__(self):
+        self.pending = ""
+        self.inHeader = True
+        self.records = 0
+
+    def add(self, data):
+        data = self.pending + data
+        pos = 0
+        if self.inHeader:
+            pos = self.parseHeader(data)
+            if pos is None:
+                self.pending = data
+                return None
+            self.inHeader = False
+        while len(data) - pos >= 4:
+            blockSize = struct.unpack("<i", data[pos:pos + 4])[0]
+            if len(data) - pos - 4 < blockSize:
+                break
+            pos += 4 + blockSize
+            self.records += 1
+        self.pending = data[pos:]
+        return None
+
+    def parseHeader(self, data):
+        if len(data) < 8:
+            return None
+        if data[:4] != "BAM\x01":
+            raise CorruptFileError("not a BAM file")
+        textLength = struct.unpack("<i", data[4:8])[0]
+        pos = 8 + textLength
+        if len(data) < pos + 4:
+            return None
+        numRefs = struct.unpack("<i", data[pos:pos + 4])[0]
+        pos += 4
+        for i in xrange(numRefs):
+            if len(data) < pos + 4:
+                return None
+            nameLength = struct.unpack("<i", data[pos:pos + 4])[0]
+            pos += 4 + nameLength + 4
+            if len(data) < pos:
+                return None
+        return pos
+
+    def finish(self):
+        if self.inHeader or self.pending:
+            raise CorruptFileError("BAM stream ends within a record")
+
+
+def inflateBlock(block, headerLength, summarize):
+    """
+    Decompress one BGZF block and check its CRC32 and size. Runs in the
+    block pool.
+    """
+    crc, size = struct.unpack("<Ii", block[-8:])
+    try:
+        data = zlib.decompress(block[headerLength:-8], -zlib.MAX_WBITS)
+    except zlib.error as exc:
+        return ("error", str(exc))
+    if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+        return ("error", "CRC or size mismatch")
+    return ("ok", len(data), summarizeText(data) if summarize else data)
+
+
+class ContentInspector(object):
+    """
+    Fed the chunks of a file in order, checks its gzip members and counts
+    the records of recordFormat ("fastq", "vcf", "bam" or None).
+    """
+
+    def __init__(self, recordFormat, maxPendingBlocks=None):
+        self.recordFormat = recordFormat
+        self.maxPendingBlocks = maxPendingBlocks or \
+            4 * multiprocessing.cpu_count()
+        self.pending = ""
+        self.offset = 0
+        self.compression = None
+        self.error = None
+        self.uncompressedSize = 0
+        self.lastBlockSize = None
+        self.blocks = deque()
+        # plain gzip member being inflated
+        self.inflater = None
+        self.memberCrc = 0
+        self.memberSize = 0
+        if recordFormat == "bam":
+            self.counter = BamCounter()
+        elif recordFormat in ("fastq", "vcf"):
+            self.counter = TextCounter()
+        else:
+            self.counter = None
+
+    def update(self, buf):
+        if self.error is not None:
+            return None
+        try:
+            self.feed(toBytes(buf))
+        except CorruptFileError as exc:
+            self.setError(str(exc))
+        return None
+
+    def setError(self, error):
+        if self.error is None:
+            self.error = error
+        self.pending = ""
+        for result in self.blocks:
+            result.wait()
+        self.blocks.clear()
+
+    def feed(self, data):
+        data = self.pending + data
+        pos = 0
+        while pos < len(data):
+            if self.inflater is not None:
+                pos = self.inflate(data, pos)
+                if self.inflater is not None:
+                    break
+                continue
+            header = parseGzipHeader(data, pos, self.offset)
+            if header is None:
+                break
+            headerLength, blockSize = header
+            if self.compression is None:
+                self.compression = "bgzf" if blockSize else "gzip"
+            if self.compression == "bgzf":
+                if blockSize is None:
+                    raise CorruptFileError("gzip member without BGZF block "
+                                           "size at offset %s"
+                                           % (self.offset + pos))
+                if len(data) - pos < blockSize:
+                    break
+                self.addBlock(data[pos:pos + blockSize], headerLength)
+                pos += blockSize
+            else:
+                pos += headerLength
+                self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+                self.memberCrc = 0
+                self.memberSize = 0
+        self.pending = data[pos:]
+        self.offset += pos
+
+    def inflate(self, data, pos):
+        """
+        Inflate the plain gzip member at data[pos:]. Returns the position
+        after what was consumed; self.inflater is None once the member and
+        its trailer are complete.
+        """
+        inflater = self.inflater
+        if not inflater.unused_data:
+            try:
+                out = inflater.decompress(data[pos:])
+            except zlib.error as exc:
+                raise CorruptFileError(str(exc))
+            self.memberCrc = zlib.crc32(out, self.memberCrc)
+            self.memberSize += len(out)
+            self.addData(out)
+            if not inflater.unused_data:
+                return len(data)
+            # the deflate stream ended, the rest is the trailer and beyond
+            pos = len(data) - len(inflater.unused_data)
+        if len(data) - pos < 8:
+            return pos
+        crc, size = struct.unpack("<Ii", data[pos:pos + 8])
+        if crc != self.memberCrc & 0xffffffff or \
+                size != self.memberSize & 0xffffffff:
+            raise CorruptFileError("CRC or size mismatch in gzip member "
+                                   "ending at offset %s"
+                                   % (self.offset + pos + 8))
+        self.inflater = None
+        pos += 8
+        # some compressors pad the file with zeros
+        if not data[pos:].strip("\x00"):
+            return len(data)
+        return pos
+
+    def addBlock(self, block, headerLength):
+        if len(self.blocks) >= self.maxPendingBlocks:
+            self.collect(self.blocks.popleft().get())
+        self.lastBlockSize = None
+        self.blocks.append(getBlockPool().apply_async(
+            inflateBlock, (block, headerLength, self.recordFormat != "bam")))
+
+    def collect(self, result):
+        if result[0] == "error":
+            raise CorruptFileError("BGZF block: %s" % result[1])
+        self.uncompressedSize += result[1]
+        self.lastBlockSize = result[1]
+        if self.counter is not None:
+            self.counter.add(result[2])
+
+    def addData(self, data):
+        self.uncompressedSize += len(data)
+        if self.counter is not None:
+            self.counter.add(data if self.recordFormat == "bam"
+                             else summarizeText(data))
+
+    def finish(self):
+        """
+        Returns the stats dict, with an "error" key if the file is corrupt.
+        """
+        try:
+            if self.error is None:
+                while self.blocks:
+                    self.collect(self.blocks.popleft().get())
+                self.check()
+        except CorruptFileError as exc:
+            self.setError(str(exc))
+        stats = {"format": self.recordFormat, "compression": self.compression}
+        if self.error is not None:
+            stats["error"] = self.error
+            return stats
+        stats["uncompressed_size"] = self.uncompressedSize
+        if self.recordFormat == "bam":
+            stats["records"] = self.counter.records
+        elif self.recordFormat == "fastq":
+            stats["records"] = self.counter.getLines() // 4
+        elif self.recordFormat == "vcf":
+            stats["records"] = self.counter.getLines() - \
+                self.counter.headerLines
+        return stats
+
+    def check(self):
+        if self.compression is None:
+            raise CorruptFileError("empty file" if not self.offset and
+                                   not self.pending else
+                                   "truncated gzip header")
+        if self.inflater is not None or self.pending:
+            raise CorruptFileError("truncated at offset %s"
+                                   % (self.offset + len(self.pending)))
+        if self.compression == "bgzf" and self.lastBlockSize != 0:
+            raise CorruptFileError("no BGZF end of file block, the file is "
+                                   "truncated")
+        if self.recordFormat == "bam":
+            self.counter.finish()
+        elif self.recordFormat == "fastq" and self.counter.getLines() % 4:
+            raise CorruptFileError("%s lines, not a multiple of 4"
+                                   % self.counter.getLines())
@@ -0,0 +1,246 @@
+"""
+logqueue.py
+
+Logging off the hot path. Log calls only put the record on a queue; a
+background thread formats the records and writes them to the log file and
+the console. Pass the arguments instead of formatting the message, so the
+formatting is done by that thread too:
+
+    logging.error("%s not found in row", field)
+
+Each message type (the message template, or the aggregateKey passed with
+extra=) is rate limited: after `burst` records within `window` seconds the
+rest are counted and summarized as "1,234 more like: <last message>".
+
+Full object dumps go to dumpLogger, which is not rate limited and is only
+written to a gzip compressed debug file together with all other records:
+
+    dumpLogger.debug("row: %s", LazyJson(row))
+
+Records of dumpLogger and the records of other loggers that were rate
+limited are not lost, they are in the debug file.
+"""
+import atexit
+import gzip
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+
+dumpLogger = logging.getLogger("spinnaker.dump")
+dumpLogger.propagate = False
+dumpLogger.setLevel(logging.DEBUG)
+dumpLogger.addHandler(logging.NullHandler())
+
+listener = None
+
+
+class LazyJson(object):
+    """
+    Log argument that is dumped as pretty JSON only when it is formatted.
+    Rows and Bundles are dumped with their to_dict().
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        obj = self.obj.to_dict() if hasattr(self.obj, "to_dict") \
+            else self.obj
+        return json.dumps(obj, indent=4, separators=(',', ': '),
+                          sort_keys=True)
+
+
+class GzipHandler(logging.StreamHandler):
+    """
+    Append to a gzip file. Every run adds a gzip member, zcat reads them
+    all.
+    """
+
+    def __init__(self, fileName):
+        logging.StreamHandler.__init__(self, gzip.open(fileName, "ab"))
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+        logging.StreamHandler.close(self)
+
+
+def getAggregateKey(record):
+    return getattr(record, "aggregateKey", None) or record.msg
+
+
+class QueueHandler(logging.Handler):
+    """
+    Put records on the listener's queue without formatting them. In a
+    forked child the listener thread does not exist; records are then
+    handled synchronously.
+    """
+
+    def __init__(self, listener):
+        logging.Handler.__init__(self)
+        self.listener = listener
+        self.pid = os.getpid()
+
+    def emit(self, record):
+        if os.getpid() != self.pid:
+            # the listener's lock may have been held when the process forked
+            self.listener.dispatch(record)
+            return None
+        # exc_info can't be formatted once the frames are gone
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        self.listener.queue.put_nowait(record)
+        return None
+
+
+class QueueListener(object):
+    """
+    Background thread that hands the queued records to handlers, rate
+    limited per message type, and all records to dumpHandler.
+    """
+
+    def __init__(self, handlers, dumpHandler=None, burst=10, window=60.0):
+        self.queue = Queue.Queue()
+        self.handlers = handlers
+        self.dumpHandler = dumpHandler
+        self.burst = burst
+        self.window = window
+        self.lock = threading.Lock()
+        # (level, aggregate key) -> [window start, count, suppressed, last]
+        self.counts = {}
+        self.thread = None
+        self.queueHandler = QueueHandler(self)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name="LogQueueListener")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=1.0)
+            except Queue.Empty:
+                self.flushSuppressed(expiredOnly=True)
+                continue
+            if record is None:
+                break
+            self.handle(record)
+        self.flushSuppressed()
+
+    def handle(self, record):
+        with self.lock:
+            self.dispatch(record)
+        return None
+
+    def dispatch(self, record):
+        if self.dumpHandler is not None:
+            self.dumpHandler.handle(record)
+        if record.name == dumpLogger.name or not self.allow(record):
+            return None
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        return None
+
+    def allow(self, record):
+        if not self.burst:
+            return True
+        key = (record.levelno, getAggregateKey(record))
+        now = time.time()
+        entry = self.counts.get(key)
+        if entry is None or now - entry[0] >= self.window:
+            if entry is not None:
+                self.emitSuppressed(entry)
+            entry = self.counts[key] = [now, 0, 0, None]
+        entry[1] += 1
+        if entry[1] <= self.burst:
+            return True
+        entry[2] += 1
+        entry[3] = record
+        return False
+
+    def emitSuppressed(self, entry):
+        record = entry[3]
+        if not entry[2]:
+            return None
+        summary = logging.makeLogRecord(dict(
+            record.__dict__, args=None, exc_info=None, exc_text=None,
+            msg="{:,} more like: {}".format(entry[2], record.getMessage())))
+        for handler in self.handlers:
+            if summary.levelno >= handler.level:
+                handler.handle(summary)
+        return None
+
+    def flushSuppressed(self, expiredOnly=False):
+        """
+        Log the summaries of the rate limited message types, of all types
+        or only of those whose window is over.
+        """
+        with self.lock:
+            now = time.time()
+            for key, entry in self.counts.items():
+                if not expiredOnly or now - entry[0] >= self.window:
+                    self.emitSuppressed(entry)
+                    del self.counts[key]
+        return None
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        for handler in self.handlers + [self.dumpHandler]:
+            if handler is not None:
+                handler.flush()
+                handler.close()
+        return None
+
+
+def start(handlers, dumpFileName=None, logFormat=None, burst=10,
+          window=60.0):
+    """
+    Route the root logger and dumpLogger through a QueueListener that
+    writes to handlers and, with dumpFileName, everything to a gzip
+    compressed debug file. Replaces the listener of an earlier call; the
+    listener is stopped and its files are closed at exit.
+    """
+    global listener
+    stop()
+    dumpHandler = None
+    if dumpFileName is not None:
+        dumpHandler = GzipHandler(dumpFileName)
+        dumpHandler.setFormatter(logging.Formatter(logFormat))
+    listener = QueueListener(handlers, dumpHandler, burst, window)
+    logging.getLogger().addHandler(listener.queueHandler)
+    dumpLogger.addHandler(listener.queueHandler)
+    listener.start()
+    return listener
+
+
+def stop():
+    """
+    Write the queued records and close the files of the current listener.
+    """
+    global listener
+    if listener is None:
+        return None
+    logging.getLogger().removeHandler(listener.queueHandler)
+    dumpLogger.removeHandler(listener.queueHandler)
+    listener.stop()
+    listener = None
+    return None
+
+
+atexit.register(stop)
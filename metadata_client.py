@@ -0,0 +1,213 @@
+"""
+metadata_client.py
+
+Client for the entities endpoint of the redwood metadata server, used to
+find out which bundles (gnosIds) are already in the storage system.
+Several gnosIds can be looked up per request where the server allows it,
+paginated results are followed, and responses are cached on disk so
+retries, resumed runs and multi-manifest batches don't query the same
+bundles again. Cached responses are used as is for ttl seconds and
+revalidated with their ETag afterwards. Empty results are always
+revalidated, so a bundle registered since is never reported missing.
+
+    client = MetadataClient("https://metadata.example.org",
+                            cacheDir="~/.spinnaker/metadata-cache")
+    existing = client.findExistingBundles(gnosIds)
+
+scripts/metadata_stub_server.py serves a local entities endpoint to test
+against.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import urllib
+
+import requests
+
+
+class MetadataClientError(Exception):
+    pass
+
+
+def isEmpty(body):
+    return not body.get("totalElements") and not body.get("content")
+
+
+class ResponseCache(object):
+    """
+    Disk cache of JSON responses keyed by URL. An entry records its ETag and
+    the time it was last fetched or revalidated.
+    """
+
+    def __init__(self, cacheDir, ttl=300):
+        self.cacheDir = os.path.expanduser(cacheDir)
+        self.ttl = ttl
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+    def getPath(self, url):
+        return os.path.join(self.cacheDir,
+                            hashlib.sha1(url).hexdigest() + ".json")
+
+    def get(self, url):
+        """
+        Returns the cached entry {"url", "etag", "time", "body"} or None.
+        """
+        try:
+            with open(self.getPath(url)) as entryFile:
+                entry = json.load(entryFile)
+        except (IOError, ValueError):
+            return None
+        if entry.get("url") != url:
+            return None
+        return entry
+
+    def isFresh(self, entry):
+        return time.time() - entry["time"] < self.ttl
+
+    def put(self, url, body, etag=None):
+        entry = {"url": url, "etag": etag, "time": time.time(), "body": body}
+        # write and rename, so concurrent runs never read a partial entry
+        fd, tmpPath = tempfile.mkstemp(dir=self.cacheDir, prefix=".tmp-")
+        with os.fdopen(fd, "w") as entryFile:
+            json.dump(entry, entryFile)
+        os.rename(tmpPath, self.getPath(url))
+        return entry
+
+
+class MetadataClient(object):
+    """
+    Query the entities endpoint at baseUrl. bulkSize gnosIds are sent per
+    request as repeated gnosId parameters once the server turned out to
+    filter on all of them, see supportsBulk(). Until then, and for servers
+    that don't, one is sent per request. Without cacheDir nothing is
+    cached.
+    """
+
+    def __init__(self, baseUrl, session=requests, cacheDir=None, ttl=300,
+                 bulkSize=1, pageSize=100, verify=False):
+        self.baseUrl = baseUrl.rstrip("/")
+        self.session = session
+        self.cache = ResponseCache(cacheDir, ttl) if cacheDir else None
+        self.bulkSize = max(1, bulkSize)
+        self.pageSize = pageSize
+        self.verify = verify
+        self.bulkSupported = None
+        self.numRequests = 0
+        self.numCacheHits = 0
+
+    def getUrl(self, gnosIds, page, size):
+        params = [("gnosId", gnosId) for gnosId in gnosIds]
+        params += [("page", page), ("size", size)]
+        return "{}/entities?{}".format(self.baseUrl, urllib.urlencode(params))
+
+    def getJson(self, url):
+        """
+        GET url as JSON, from the cache where possible.
+        """
+        entry = self.cache.get(url) if self.cache is not None else None
+        # a cached "not there" may be stale, only trust it after a 304
+        if entry is not None and self.cache.isFresh(entry) and \
+                not isEmpty(entry["body"]):
+            self.numCacheHits += 1
+            return entry["body"]
+
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        self.numRequests += 1
+        try:
+            response = self.session.get(url, headers=headers,
+                                        verify=self.verify)
+        except requests.RequestException as exc:
+            raise MetadataClientError("can't query %s: %s" % (url, exc))
+        if response.status_code == 304 and entry is not None:
+            self.cache.put(url, entry["body"], entry["etag"])
+            return entry["body"]
+        if response.status_code != 200:
+            raise MetadataClientError("%s returned HTTP %s"
+                                      % (url, response.status_code))
+        try:
+            body = response.json()
+        except ValueError:
+            raise MetadataClientError("%s returned invalid JSON" % url)
+        if self.cache is not None:
+            self.cache.put(url, body, response.headers.get("ETag"))
+        return body
+
+    def iterEntities(self, gnosIds):
+        """
+        Yield the entities of all pages of the result for gnosIds.
+        """
+        page = 0
+        while True:
+            body = self.getJson(self.getUrl(gnosIds, page, self.pageSize))
+            for entity in body.get("content", []):
+                yield entity
+            page += 1
+            if body.get("last", True) or page >= body.get("totalPages", 0):
+                return
+
+    def countEntities(self, gnosId):
+        """
+        Number of entities registered for one gnosId. Only the count is
+        needed, so a single entity is fetched.
+        """
+        body = self.getJson(self.getUrl([gnosId], 0, 1))
+        return body["totalElements"]
+
+    def supportsBulk(self, counts):
+        """
+        Whether the server applies every gnosId parameter of a request, not
+        only the first or last one. Two gnosIds of counts, which maps
+        existing gnosIds to their number of entities, are looked up
+        together and the total compared with their counts. This costs one
+        filtered request for a single entity. None while less than two
+        existing gnosIds are known.
+        """
+        if self.bulkSupported is None and len(counts) >= 2:
+            probeIds = sorted(counts)[:2]
+            total = self.getJson(self.getUrl(probeIds, 0, 1))["totalElements"]
+            self.bulkSupported = \
+                total == sum(counts[gnosId] for gnosId in probeIds)
+            if not self.bulkSupported:
+                logging.warning("%s does not look up several gnosIds per "
+                                "request, looking up one at a time"
+                                % self.baseUrl)
+        return self.bulkSupported
+
+    def findExistingBundles(self, gnosIds):
+        """
+        Returns the set of gnosIds that have entities on the server.
+        """
+        gnosIds = sorted(set(gnosIds))
+        existing = set()
+        numRequests = self.numRequests
+        numCacheHits = self.numCacheHits
+        # one at a time until two existing bundles show whether the server
+        # filters on all gnosIds of a request
+        counts = {}
+        numSingle = 0
+        while numSingle < len(gnosIds) and (
+                self.bulkSize == 1 or len(gnosIds) - numSingle < 2 or
+                not self.supportsBulk(counts)):
+            count = self.countEntities(gnosIds[numSingle])
+            if count > 0:
+                counts[gnosIds[numSingle]] = count
+            numSingle += 1
+        existing.update(counts)
+        for i in xrange(numSingle, len(gnosIds), self.bulkSize):
+            batch = gnosIds[i:i + self.bulkSize]
+            for entity in self.iterEntities(batch):
+                if entity.get("gnosId") not in batch:
+                    raise MetadataClientError(
+                        "%s does not filter on gnosId, use a bulk size "
+                        "of 1" % self.baseUrl)
+                existing.add(entity["gnosId"])
+        logging.info("looked up %s bundles: %s requests, %s cached responses"
+                     % (len(gnosIds), self.numRequests - numRequests,
+                        self.numCacheHits - numCacheHits))
+        return existing
@@ -0,0 +1,140 @@
+"""
+report.py
+
+Error and duplicate tables for the console and the output dir. Rows are
+added one at a time: they are streamed to <name>.tsv and <name>.json in the
+output dir, while only the first maxConsoleRows are kept for the console
+table, whose column widths are updated as the rows come in.
+
+    table = ReportTable("existing_bundles", ["source", "workflow_uuid"],
+                        outputDir)
+    for row in rows:
+        table.add(row)
+    table.close()
+    logging.error(table.format())
+"""
+import csv
+import datetime
+import json
+import os
+
+
+def formatValue(value):
+    """
+    Text for a cell. Excel cells may hold numbers, dates or None.
+    """
+    if value is None:
+        return u""
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return unicode(value.isoformat())
+    return unicode(value)
+
+
+def formatRows(rows, widths, margin=2):
+    return u"\n".join(
+        u" ".join(value.ljust(width + margin)
+                  for value, width in zip(row, widths)).rstrip()
+        for row in rows)
+
+
+def formatTable(rows, columns, margin=2):
+    """
+    Format a list of dict-like rows as a text table of the given columns,
+    as a utf-8 encoded str.
+    """
+    table = ReportTable(None, columns, maxConsoleRows=None, margin=margin,
+                        header=False)
+    for row in rows:
+        table.add(row)
+    return table.format()
+
+
+class ReportTable(object):
+    """
+    A table of rows with the given columns. Rows can be dicts, Rows or
+    anything else that supports row[column]. With an outputDir the full
+    table is written to <outputDir>/<name>.tsv and .json; the files are
+    only created once the first row is added. maxConsoleRows=None keeps all
+    rows for format().
+    """
+
+    def __init__(self, name, columns, outputDir=None, maxConsoleRows=20,
+                 margin=2, header=True):
+        self.name = name
+        self.columns = list(columns)
+        self.outputDir = outputDir
+        self.maxConsoleRows = maxConsoleRows
+        self.margin = margin
+        self.header = header
+        self.numRows = 0
+        self.consoleRows = []
+        self.widths = [len(column) if header else 0 for column in columns]
+        self.tsvFile = None
+        self.tsvWriter = None
+        self.jsonFile = None
+
+    def getPath(self, extension):
+        return os.path.join(self.outputDir, self.name + extension)
+
+    def openFiles(self):
+        if not os.path.isdir(self.outputDir):
+            os.makedirs(self.outputDir)
+        self.tsvFile = open(self.getPath(".tsv"), "w")
+        self.tsvWriter = csv.writer(self.tsvFile, delimiter="\t",
+                                    lineterminator="\n")
+        self.tsvWriter.writerow(self.columns)
+        self.jsonFile = open(self.getPath(".json"), "w")
+        self.jsonFile.write("[")
+
+    def add(self, row):
+        values = [formatValue(row[column]) for column in self.columns]
+        if self.outputDir is not None:
+            if self.tsvFile is None:
+                self.openFiles()
+            self.tsvWriter.writerow([value.encode("utf-8")
+                                     for value in values])
+            self.jsonFile.write((",\n" if self.numRows else "\n") +
+                                json.dumps(dict(zip(self.columns, values)),
+                                           sort_keys=True))
+        self.numRows += 1
+        if self.maxConsoleRows is None or \
+                len(self.consoleRows) < self.maxConsoleRows:
+            self.consoleRows.append(values)
+            self.widths = [max(width, len(value))
+                           for width, value in zip(self.widths, values)]
+        return None
+
+    def close(self):
+        if self.tsvFile is not None:
+            self.tsvFile.close()
+            self.jsonFile.write("\n]\n")
+            self.jsonFile.close()
+            self.tsvFile = None
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def format(self):
+        """
+        The console table: the first maxConsoleRows rows, followed by a
+        note where to find the rest. Returns a utf-8 encoded str, so it can
+        be mixed with the other log and exception messages.
+        """
+        rows = self.consoleRows
+        if self.header:
+            rows = [self.columns] + rows
+        text = formatRows(rows, self.widths, self.margin)
+        numHidden = self.numRows - len(self.consoleRows)
+        if numHidden:
+            text += u"\n... %s more rows" % numHidden
+        if self.outputDir is not None and self.numRows:
+            text += u"\nfull table: %s" % self.getPath(".tsv")
+        return text.encode("utf-8")
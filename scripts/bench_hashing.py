@@ -0,0 +1,130 @@
+"""
+bench_hashing.py
+
+Compare the hashing read backends of spinnaker.checksums(), and the old
+separate sha1sum()/md5sum() passes, on one file. Each backend runs in its
+own process so its peak RSS can be reported, and the file is dropped from
+the page cache before each run unless --warm is given. The share of the
+file left in the page cache afterwards shows how much cache a backend
+takes from other jobs.
+
+    python scripts/bench_hashing.py --size 4096
+    python scripts/bench_hashing.py --file /data/huge.bam --backends mmap,readinto
+"""
+import argparse
+import ctypes
+import mmap
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import spinnaker
+
+LEGACY = "sha1sum+md5sum"
+
+
+def makeFile(sizeMb):
+    fd, path = tempfile.mkstemp(prefix="bench_hashing-")
+    chunk = os.urandom(1024 * 1024)
+    with os.fdopen(fd, "wb") as f:
+        for i in xrange(sizeMb):
+            f.write(chunk)
+    return path
+
+
+def dropFromCache(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+        spinnaker.fadvise(f.fileno(), 0, 0, spinnaker.POSIX_FADV_DONTNEED)
+
+
+def cachedFraction(path):
+    """
+    Share of the pages of path in the page cache, from mincore(2).
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0.0
+    libc = ctypes.CDLL(None, use_errno=True)
+    pageSize = mmap.PAGESIZE
+    numPages = (size + pageSize - 1) // pageSize
+    vec = (ctypes.c_ubyte * numPages)()
+    with open(path, "rb") as f:
+        # a private mapping can be handed to ctypes, its pages are still
+        # the page cache pages as long as nothing is written
+        mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_COPY)
+        try:
+            addr = ctypes.addressof(ctypes.c_char.from_buffer(mapped))
+            libc.mincore(ctypes.c_void_p(addr), ctypes.c_size_t(size), vec)
+        finally:
+            mapped.close()
+    return sum(page & 1 for page in vec) / float(numPages)
+
+
+def runBackend(path, backend):
+    """
+    Hash path with backend in this process and print the result line.
+    """
+    start = time.time()
+    if backend == LEGACY:
+        spinnaker.sha1sum(path)
+        spinnaker.md5sum(path)
+    else:
+        spinnaker.checksums(path, progress=False, backend=backend)
+    seconds = time.time() - start
+    # ru_maxrss is in kB on Linux
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print("%s\t%s\t%s" % (seconds, maxRss, cachedFraction(path)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument("--file", default=None,
+                        help="file to hash, default is a random temp file")
+    parser.add_argument("--size", type=int, default=1024,
+                        help="size of the temp file in MB")
+    parser.add_argument("--backends",
+                        default=",".join(spinnaker.HASH_BACKENDS),
+                        help="comma separated backends to compare, %s is "
+                        "the old two pass path with 128 byte reads" % LEGACY)
+    parser.add_argument("--warm", action="store_true",
+                        help="don't drop the file from the page cache first")
+    parser.add_argument("--run-backend", default=None,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_backend is not None:
+        runBackend(args.file, args.run_backend)
+        return None
+
+    path = args.file if args.file is not None else makeFile(args.size)
+    try:
+        size = os.path.getsize(path)
+        print("%s, %s" % (path, spinnaker.formatBytes(size)))
+        print("%-16s %10s %10s %10s %8s" % ("backend", "seconds", "MB/s",
+                                            "max rss", "cached"))
+        for backend in args.backends.split(","):
+            if not args.warm:
+                dropFromCache(path)
+            output = subprocess.check_output([
+                sys.executable, __file__, "--file", path,
+                "--run-backend", backend])
+            seconds, maxRss, cached = output.split()
+            seconds = float(seconds)
+            print("%-16s %10.2f %10.1f %10s %7.0f%%" % (
+                backend, seconds, size / seconds / (1024 * 1024),
+                spinnaker.formatBytes(int(maxRss)), float(cached) * 100))
+    finally:
+        if args.file is None:
+            os.remove(path)
+    return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+bench_staging.py
+
+Time writeDataBundleDirs() for a large number of synthetic bundles with each
+link strategy, and writing them as a single stream with export.py. Reading
+all bundles back is timed for the bundle dirs and for the stream.
+
+    python scripts/bench_staging.py --bundles 10000 --files-per-bundle 2
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import spinnaker
+import export
+
+
+def makeBundles(dataDir, numBundles, filesPerBundle):
+    bundles = {}
+    for i in xrange(numBundles):
+        row = spinnaker.Row()
+        for field in spinnaker.Row.FIELDS:
+            row[field] = "x"
+        row["workflow_uuid"] = "%08x-0000-0000-0000-000000000000" % i
+        bundle = spinnaker.Bundle.from_row(row, "0.0.3")
+        for j in xrange(filesPerBundle):
+            file_path = os.path.join(dataDir, "%d_%d.fastq.gz" % (i, j))
+            with open(file_path, "w") as f:
+                f.write("@read\nACGT\n+\nIIII\n")
+            bundle.workflow_outputs.append(spinnaker.BundleFile(
+                "fastq", file_path, 20, "sha1$0"))
+        bundles[row["workflow_uuid"]] = bundle
+    return bundles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--bundles", type=int, default=10000)
+    parser.add_argument("--files-per-bundle", type=int, default=2)
+    parser.add_argument("--dir", default=None,
+                        help="scratch dir, on the file system to measure")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(dir=args.dir)
+    try:
+        dataDir = os.path.join(scratch, "data")
+        os.mkdir(dataDir)
+        for strategy in spinnaker.LINK_STRATEGIES:
+            bundles = makeBundles(dataDir, args.bundles, args.files_per_bundle)
+            outputDir = os.path.join(scratch, strategy)
+            start = time.time()
+            spinnaker.writeDataBundleDirs(bundles, outputDir, strategy)
+            elapsed = time.time() - start
+            print "%-8s %d bundles in %.2f s (%.0f bundles/s)" % (
+                strategy, args.bundles, elapsed, args.bundles / elapsed)
+
+        bundles = makeBundles(dataDir, args.bundles, args.files_per_bundle)
+        streamDir = os.path.join(scratch, "stream")
+        start = time.time()
+        export.writeBundleStream(bundles, streamDir)
+        elapsed = time.time() - start
+        print "%-8s %d bundles in %.2f s (%.0f bundles/s)" % (
+            "stream", args.bundles, elapsed, args.bundles / elapsed)
+
+        dirsDir = os.path.join(scratch, spinnaker.LINK_STRATEGIES[0])
+        start = time.time()
+        numRead = 0
+        for name in os.listdir(dirsDir):
+            spinnaker.loadJsonObj(os.path.join(dirsDir, name,
+                                               "metadata.json"))
+            numRead += 1
+        print "read %d bundle dirs in %.2f s" % (numRead, time.time() - start)
+        start = time.time()
+        numRead = sum(1 for bundle in export.iterBundles(streamDir))
+        print "read %d streamed bundles in %.2f s" % (numRead,
+                                                      time.time() - start)
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+metadata_stub_server.py
+
+Local stand-in for the entities endpoint of the redwood metadata server,
+to test metadata_client.py and spinnaker.py --metadata-url against.
+Supports repeated gnosId parameters, paging and ETag revalidation, and
+logs every request.
+
+    python scripts/metadata_stub_server.py --port 8444 \
+        --gnos-ids 608e4df1-d829-5c07-a785-1f9eb4951ef1
+    python spinnaker.py --metadata-url http://localhost:8444 ...
+"""
+import argparse
+import BaseHTTPServer
+import hashlib
+import json
+import urlparse
+
+
+def makeHandler(entities, singleGnosId=False):
+
+    class EntitiesHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse.urlparse(self.path)
+            if url.path.rstrip("/") != "/entities":
+                self.send_error(404)
+                return
+            params = urlparse.parse_qs(url.query)
+            gnosIds = params.get("gnosId", [])
+            if singleGnosId:
+                gnosIds = gnosIds[:1]
+            page = int(params.get("page", ["0"])[0])
+            size = int(params.get("size", ["2000"])[0])
+            matches = [entity for entity in entities
+                       if not gnosIds or entity["gnosId"] in gnosIds]
+            totalPages = (len(matches) + size - 1) // size
+            body = json.dumps({
+                "content": matches[page * size:(page + 1) * size],
+                "totalElements": len(matches), "totalPages": totalPages,
+                "number": page, "size": size, "first": page == 0,
+                "last": page >= totalPages - 1}, sort_keys=True)
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return EntitiesHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8444)
+    parser.add_argument("--gnos-ids", nargs="*", default=[],
+                        help="bundles that already exist, with one "
+                        "metadata.json entity each")
+    parser.add_argument("--entities", default=None,
+                        help="JSON file with a list of entities to serve")
+    parser.add_argument("--single-gnos-id", action="store_true",
+                        help="only filter on the first gnosId parameter, "
+                        "like servers without bulk lookups")
+    args = parser.parse_args()
+
+    entities = []
+    if args.entities is not None:
+        with open(args.entities) as entitiesFile:
+            entities = json.load(entitiesFile)
+    for i, gnosId in enumerate(args.gnos_ids):
+        entities.append({"id": "%08d-0000-0000-0000-000000000000" % i,
+                         "gnosId": gnosId, "fileName": "metadata.json",
+                         "projectCode": "TEST", "access": "controlled"})
+
+    server = BaseHTTPServer.HTTPServer(
+        ("localhost", args.port), makeHandler(entities, args.single_gnos_id))
+    print("serving %s entities on http://localhost:%s/entities"
+          % (len(entities), args.port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
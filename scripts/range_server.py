@@ -0,0 +1,144 @@
+"""
+range_server.py
+
+Serve the files of a dir over HTTP with range requests, ETags and If-Range,
+to test fetching http:// File Paths (fetch.py) against. Requests are
+handled by one thread each and logged.
+
+    python scripts/range_server.py --port 8445 --dir /data/fastq
+    # File Path: http://localhost:8445/ERR030886_1.fastq.gz
+
+--no-ranges ignores Range headers like servers without range support,
+--cut-every N cuts every Nth response off halfway through and
+--error-every N answers every Nth request with HTTP 503 to test retries,
+--rate limits each response to that many KB/s so a download can be
+interrupted and resumed.
+"""
+import argparse
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import itertools
+import os
+import re
+import threading
+import time
+import urllib
+
+RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def makeHandler(root, ranges=True, cutEvery=0, rate=None, errorEvery=0):
+    counter = itertools.count(1)
+    counterLock = threading.Lock()
+
+    class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+
+        def getRange(self, size):
+            """
+            (start, end) of the requested range, or None for the whole
+            file. Ranges the server can't satisfy end up as start == size.
+            """
+            header = self.headers.get("Range")
+            if not ranges or header is None:
+                return None
+            match = RANGE.match(header.strip())
+            if match is None:
+                return None
+            first, last = match.groups()
+            if not first:
+                if not last:
+                    return None
+                return max(0, size - int(last)), size
+            return int(first), min(size, int(last) + 1 if last else size)
+
+        def do_GET(self):
+            path = os.path.join(root, urllib.unquote(
+                self.path.split("?", 1)[0]).lstrip("/"))
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            st = os.stat(path)
+            size = st.st_size
+            etag = '"%s"' % hashlib.sha1("%s-%s-%s" % (
+                path, size, st.st_mtime)).hexdigest()
+            byteRange = self.getRange(size)
+            ifRange = self.headers.get("If-Range")
+            if ifRange is not None and ifRange != etag:
+                byteRange = None
+            with counterLock:
+                number = next(counter)
+            if errorEvery and number % errorEvery == 0:
+                self.send_error(503)
+                return
+            if byteRange is not None and byteRange[0] >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%s" % size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start, end = byteRange or (0, size)
+            if byteRange is None:
+                self.send_response(200)
+            else:
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %s-%s/%s"
+                                 % (start, end - 1, size))
+            if ranges:
+                self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(end - start))
+            self.end_headers()
+            if cutEvery and number % cutEvery == 0:
+                end = start + (end - start) // 2
+                self.close_connection = 1
+            with open(path, "rb") as f:
+                f.seek(start)
+                pos = start
+                while pos < end:
+                    buf = f.read(min(64 * 1024, end - pos))
+                    if not buf:
+                        break
+                    self.wfile.write(buf)
+                    pos += len(buf)
+                    if rate:
+                        time.sleep(len(buf) / (rate * 1024.0))
+
+    return RangeHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8445)
+    parser.add_argument("--dir", default=".",
+                        help="dir whose files are served")
+    parser.add_argument("--no-ranges", action="store_true",
+                        help="answer every request with the whole file")
+    parser.add_argument("--cut-every", type=int, default=0,
+                        help="cut every Nth response off halfway through")
+    parser.add_argument("--error-every", type=int, default=0,
+                        help="answer every Nth request with HTTP 503")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="KB/s per response")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(
+        ("localhost", args.port),
+        makeHandler(os.path.abspath(args.dir), not args.no_ranges,
+                    args.cut_every, args.rate, args.error_every))
+    print("serving %s on http://localhost:%s/"
+          % (os.path.abspath(args.dir), args.port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
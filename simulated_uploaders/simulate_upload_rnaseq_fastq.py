@@ -1,6 +1,5 @@
 import argparse
 import subprocess
-import os
 import time
 import random
 
@@ -24,21 +23,6 @@ def getOptions():
 
 def main():
     args = getOptions()
-    # prep download
-    url_arr = args.fastq_r1_path.split("/")
-    if not os.path.isfile(url_arr[-1]):
-        cmd = "curl -k %s > %s" % (args.fastq_r1_path, 'ERR030886_1.fastq.gz')
-        print "DOWNLOADING: "+cmd
-        result = subprocess.call(cmd, shell=True)
-        if (result != 0):
-            print "PROBLEMS DOWNLOADING"
-    url_arr = args.fastq_r2_path.split("/")
-    if not os.path.isfile(url_arr[-1]):
-        cmd = "curl -k %s > %s" % (args.fastq_r2_path, 'ERR030886_2.fastq.gz')
-        print "DOWNLOADING: "+cmd
-        result = subprocess.call(cmd, shell=True)
-        if (result != 0):
-            print "PROBLEMS DOWNLOADING"
     # main loop for upload
     upload_count = 0
     while True:
@@ -47,8 +31,8 @@ def main():
         # create template
         specimen = '{0:05}'.format(random.randint(1, 1000000))
         template = '''Program	Project	Center Name	Submitter Donor ID	Donor UUID	Submitter Specimen ID	Specimen UUID	Submitter Specimen Type	Submitter Experimental Design	Submitter Sample ID	Sample UUID	Analysis Type	Workflow Name	Workflow Version	File Type	File Path	Upload File ID	Data Bundle ID	Metadata.json
-TEST	TEST	UCSC	S%s		S%sa		Normal - blood derived	RNA-Seq	S%sa1		sequence_upload	Spinnaker	1.0.0	fastq.gz	ERR030886_1.fastq.gz
-TEST	TEST	UCSC	S%s		S%sa		Normal - blood derived	RNA-Seq	S%sa1		sequence_upload	Spinnaker	1.0.0	fastq.gz	ERR030886_2.fastq.gz''' % (str(specimen), str(specimen), str(specimen), str(specimen), str(specimen), str(specimen))
+TEST	TEST	UCSC	S%s		S%sa		Normal - blood derived	RNA-Seq	S%sa1		sequence_upload	Spinnaker	1.0.0	fastq.gz	%s
+TEST	TEST	UCSC	S%s		S%sa		Normal - blood derived	RNA-Seq	S%sa1		sequence_upload	Spinnaker	1.0.0	fastq.gz	%s''' % (str(specimen), str(specimen), str(specimen), args.fastq_r1_path, str(specimen), str(specimen), str(specimen), args.fastq_r2_path)
         f = open('sample.tsv', 'w')
         print >>f, template
         f.close()
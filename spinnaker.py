@@ -24,12 +24,34 @@ import semver
 import requests
 import dateutil
 import hashlib
+import re
+import stat
+import time
 from functools import partial
+from itertools import izip, repeat
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
 from tqdm import tqdm
-from fcntl import fcntl, F_GETFL, F_SETFL
-from urllib import urlopen
-import ssl
+from fcntl import fcntl, ioctl, F_GETFL, F_SETFL
 import pprint
+import shutil
+import tempfile
+import watch
+import events as events_module
+import adaptive
+import metadata_client
+import report
+import integrity
+import fetch
+import export
+import logqueue
+from logqueue import dumpLogger, LazyJson
+import select
+import io
+import mmap
+import ctypes
+import ctypes.util
 
 def sha1sum(filename):
     logging.info("Calculating the sha1 sum for {}.".format(
@@ -60,6 +82,257 @@ def md5sum(filename):
         return d.hexdigest()
 
 
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# page cache hints are given and dropped per window, the size is a multiple
+# of mmap.ALLOCATIONGRANULARITY
+HASH_WINDOW_SIZE = 64 * 1024 * 1024
+
+HASH_BACKENDS = ["readinto", "mmap", "read"]
+
+# posix_fadvise(2)
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+libc = None
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    posix_fadvise(2) via ctypes. Does nothing where it is not available.
+    """
+    global libc
+    if libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        except OSError:
+            libc = False
+    posix_fadvise = getattr(libc, "posix_fadvise64", None)
+    if posix_fadvise is None:
+        return None
+    posix_fadvise(fd, ctypes.c_int64(offset), ctypes.c_int64(length), advice)
+    return None
+
+
+def readChunks(filename, backend="readinto"):
+    """
+    Yield the content of filename in chunks for hashing. "read" returns a
+    new string per chunk. "readinto" reuses a single buffer and "mmap" maps
+    the file a window at a time; both yield views that are only valid until
+    the next chunk is requested. Except for "read", the kernel is told that
+    the file is read sequentially and the pages already hashed are dropped
+    from the page cache, so huge files neither grow the RSS nor evict the
+    cache of other jobs.
+    """
+    if backend == "read":
+        with open(filename, mode='rb') as f:
+            for buf in iter(partial(f.read, HASH_BUFFER_SIZE), b''):
+                yield buf
+        return
+
+    with io.open(filename, mode='rb', buffering=0) as f:
+        fd = f.fileno()
+        fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        if backend == "mmap":
+            filesize = os.fstat(fd).st_size
+            for offset in xrange(0, filesize, HASH_WINDOW_SIZE):
+                length = min(HASH_WINDOW_SIZE, filesize - offset)
+                mapped = mmap.mmap(fd, length, access=mmap.ACCESS_READ,
+                                   offset=offset)
+                try:
+                    for pos in xrange(0, length, HASH_BUFFER_SIZE):
+                        # mmap objects only have the old buffer interface
+                        yield buffer(mapped, pos, HASH_BUFFER_SIZE)
+                finally:
+                    mapped.close()
+                fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+            return
+
+        buf = bytearray(HASH_BUFFER_SIZE)
+        view = memoryview(buf)
+        offset = dropped = 0
+        for numBytes in iter(partial(f.readinto, buf), 0):
+            yield view[:numBytes]
+            offset += numBytes
+            if offset - dropped >= HASH_WINDOW_SIZE:
+                fadvise(fd, dropped, offset - dropped, POSIX_FADV_DONTNEED)
+                dropped = offset
+        fadvise(fd, dropped, 0, POSIX_FADV_DONTNEED)
+
+
+def checksums(filename, progress=True, callback=None, backend="readinto",
+              inspector=None):
+    """
+    Calculate the sha1 sum and md5 checksum of a file in a single read.
+    Returns ('sha1$<hex>', '<md5 hex>'). Pass progress=False when hashing
+    from several threads, the tqdm progress bar is not thread safe.
+    callback(bytesDone, fileSize) is called after each read. backend is
+    one of HASH_BACKENDS, see readChunks(). An integrity.ContentInspector
+    passed as inspector is fed the same chunks.
+    """
+    logging.info("Calculating the sha1 sum and md5 checksum for {}.".format(
+        os.path.basename(filename)))
+    filesize = os.path.getsize(filename)
+    sha1 = hashlib.sha1()
+    md5 = hashlib.md5()
+    pbar = tqdm(total=filesize, unit='B', unit_scale=True) \
+        if progress else None
+    bytesDone = 0
+    for buf in readChunks(filename, backend):
+        sha1.update(buf)
+        md5.update(buf)
+        if inspector is not None:
+            inspector.update(buf)
+        bytesDone += len(buf)
+        if pbar is not None:
+            pbar.update(len(buf))
+        if callback is not None:
+            callback(bytesDone, filesize)
+    if pbar is not None:
+        pbar.close()
+    logging.info("checksums done for {}".format(
+        os.path.basename(filename)))
+    return ('sha1$' + sha1.hexdigest(), md5.hexdigest())
+
+
+class ChecksumCache(object):
+    """
+    Checksums of the physical files seen in this run, keyed by
+    (device, inode) so that hard links, symlinks and repeated rows are only
+    hashed once. Entries are dropped if size or mtime of the file changed.
+    With verifyContent, compressed files are checked with integrity.py in
+    the same read, see getStats().
+    """
+
+    def __init__(self, progress=True, events=None, controller=None,
+                 readLimiter=None, backend="readinto", verifyContent=False):
+        self.checksums = {}
+        self.stats = {}
+        # keys hashed by prefetch() that were not asked for yet
+        self.prefetched = set()
+        self.bytesSaved = 0
+        self.progress = progress
+        self.events = events
+        self.controller = controller
+        self.readLimiter = readLimiter
+        self.backend = backend
+        self.verifyContent = verifyContent
+
+    def isCached(self, filename, st):
+        key = (st.st_dev, st.st_ino)
+        entry = self.checksums.get(key)
+        if entry is None or entry[0] != (st.st_size, st.st_mtime):
+            return False
+        # hashed before without the content check
+        return not self.verifyContent or key in self.stats or \
+            not integrity.getFormat(filename)[0]
+
+    def get(self, filename, progress=None, events=None):
+        """
+        Returns (sha1, md5) for filename, hashing it only on a cache miss.
+        Progress events go to events, by default to the cache's stream.
+        """
+        st = os.stat(filename)
+        key = (st.st_dev, st.st_ino)
+        if self.isCached(filename, st):
+            entry = self.checksums[key]
+            if key in self.prefetched:
+                self.prefetched.discard(key)
+            else:
+                self.bytesSaved += st.st_size
+            return entry[1]
+        callback = None
+        if events is None:
+            events = self.events
+        if events is not None:
+            callback = partial(events.progress, "hash", filename)
+        if self.controller is not None or self.readLimiter is not None:
+            callback = adaptive.Meter(self.controller, self.readLimiter,
+                                      callback)
+        inspector = integrity.getInspector(filename) \
+            if self.verifyContent else None
+        sums = checksums(filename,
+                         self.progress if progress is None else progress,
+                         callback, self.backend, inspector)
+        self.checksums[key] = ((st.st_size, st.st_mtime), sums)
+        if inspector is not None:
+            self.stats[key] = inspector.finish()
+        return sums
+
+    def getStats(self, filename):
+        """
+        The integrity.ContentInspector stats of filename, with an "error"
+        key if it is corrupt, or None if its content is not checked.
+        """
+        if not self.verifyContent:
+            return None
+        st = os.stat(filename)
+        if not self.isCached(filename, st):
+            self.get(filename)
+            st = os.stat(filename)
+        return self.stats.get((st.st_dev, st.st_ino))
+
+    def prefetch(self, filenames, events=None):
+        """
+        Hash the files not cached yet, each physical file once, with as
+        many threads as the controller allows.
+        """
+        pending = {}
+        for filename in filenames:
+            st = os.stat(filename)
+            key = (st.st_dev, st.st_ino)
+            if key not in pending and not self.isCached(filename, st):
+                pending[key] = filename
+        if self.controller is None or self.controller.maxWorkers == 1 or \
+                len(pending) < 2:
+            for filename in sorted(pending.values()):
+                self.get(filename, events=events)
+        else:
+            # the tqdm progress bar is not thread safe
+            adaptive.mapAdaptive(partial(self.get, progress=False,
+                                         events=events),
+                                 sorted(pending.values()), self.controller)
+        self.prefetched.update(pending)
+        return None
+
+    def put(self, filename, sums, stats=None):
+        """
+        Record the checksums of filename that were calculated elsewhere,
+        e.g. while it was downloaded, so it does not need to be hashed.
+        """
+        st = os.stat(filename)
+        key = (st.st_dev, st.st_ino)
+        self.checksums[key] = ((st.st_size, st.st_mtime), sums)
+        if stats is not None:
+            self.stats[key] = stats
+        # not counted as a repeated file on the first get()
+        self.prefetched.add(key)
+        return None
+
+    def alias(self, filename, copyname):
+        """
+        Record that copyname has the same content as filename, e.g. for
+        reflink copies, so it does not need to be hashed.
+        """
+        st = os.stat(filename)
+        entry = self.checksums.get((st.st_dev, st.st_ino))
+        if entry is None or entry[0] != (st.st_size, st.st_mtime):
+            return None
+        copy_st = os.stat(copyname)
+        copy_key = (copy_st.st_dev, copy_st.st_ino)
+        self.checksums[copy_key] = \
+            ((copy_st.st_size, copy_st.st_mtime), entry[1])
+        if (st.st_dev, st.st_ino) in self.stats:
+            self.stats[copy_key] = self.stats[(st.st_dev, st.st_ino)]
+        return None
+
+    def sha1sum(self, filename):
+        return self.get(filename)[0]
+
+    def md5sum(self, filename, events=None):
+        return self.get(filename, events=events)[1]
+
+
 def getValueFromObject(x, y):
     """
     Returns a value from a dictionary x if present. Otherwise returns an empty
@@ -68,9 +341,9 @@ def getValueFromObject(x, y):
     return x[y] if y in x else ''
 
 
-def getOptions():
+def getOptions(argv=None):
     """
-    parse options
+    parse options, from sys.argv unless argv is given
     """
     usage_text = []
     usage_text.append("%prog [options] [input Excel or tsv files]")
@@ -130,8 +403,167 @@ def getOptions():
     parser.add_option("--skip-submit", action="store_true", default=False,
                       dest="skip_submit",
                       help="Skip contacting the submission server.")
-
-    (options, args) = parser.parse_args()
+    parser.add_option("--partition", action="store", default=None,
+                      type="string", dest="partition",
+                      help="Only process partition K of N, e.g. 2/4. Rows are "
+                      "assigned to partitions by donor_uuid, so a bundle is "
+                      "never split. Per-partition runs do not contact the "
+                      "submission server; use --merge-partitions for that.")
+    parser.add_option("--merge-partitions", action="store_true",
+                      default=False, dest="merge_partitions",
+                      help="Treat the arguments as output dirs of "
+                      "--partition runs. Merges their receipt and registration "
+                      "files into the output dir and submits the merged "
+                      "receipt.")
+
+    parser.add_option("--dedup-references", action="store_true",
+                      default=False, dest="dedup_references",
+                      help="Upload files with identical content only once. "
+                      "Later bundles listing the same file reference the "
+                      "bundle it is uploaded with instead.")
+    parser.add_option("--previous-output-dir", action="store",
+                      default=None, type="string", dest="previousOutputDir",
+                      help="Output dir of a previous upload. Files that are "
+                      "unchanged since the bundle version uploaded there are "
+                      "referenced instead of uploaded again.")
+    parser.add_option("--link-strategy", action="store", default="symlink",
+                      type="choice", choices=LINK_STRATEGIES,
+                      dest="link_strategy",
+                      help="How data files are placed in the bundle dirs: "
+                      "symlink (default), hardlink or reflink. Falls back to "
+                      "symlink where the file system doesn't support it.")
+    parser.add_option("--bundle-layout", action="store", default="dirs",
+                      type="choice", choices=BUNDLE_LAYOUTS,
+                      dest="bundle_layout",
+                      help="How the bundles are written to the output dir: "
+                      "dirs (default) writes a <bundle_uuid>/metadata.json "
+                      "dir per bundle, stream writes all bundles to "
+                      "bundles.jsonl with an offset index and a "
+                      "bundle_files.tsv table, both writes both. stream "
+                      "requires --skip-upload.")
+    parser.add_option("--watch", action="store", default=None,
+                      type="string", dest="watch",
+                      help="Daemon mode: watch this spool dir for new tsv or "
+                      "Excel manifests and submit each into its own dir "
+                      "below the output dir. Stops on SIGTERM/SIGINT after "
+                      "the running submissions finish.")
+    parser.add_option("--watch-concurrency", action="store", default=2,
+                      type="int", dest="watch_concurrency",
+                      help="Number of manifests processed at once in "
+                      "--watch mode.")
+    parser.add_option("--watch-interval", action="store", default=5.0,
+                      type="float", dest="watch_interval",
+                      help="Seconds between spool dir scans in --watch mode "
+                      "(used when inotify is not available).")
+    parser.add_option("--events", action="store", default=None,
+                      type="string", dest="events",
+                      help="Write JSON lines progress events to this file, "
+                      "to fd:N for an open file descriptor or - for stdout.")
+    parser.add_option("--events-interval", action="store", default=1.0,
+                      type="float", dest="events_interval",
+                      help="Minimum seconds between progress events for the "
+                      "same file.")
+    parser.add_option("--push-events", action="store_true", default=False,
+                      dest="push_events",
+                      help="Also send the progress events in batches to the "
+                      "submission on the submission server.")
+    parser.add_option("--max-hash-workers", action="store", default=8,
+                      type="int", dest="max_hash_workers",
+                      help="Upper bound for the number of files hashed at "
+                      "once. The number is adapted to the measured read "
+                      "throughput and latency.")
+    parser.add_option("--max-upload-workers", action="store", default=1,
+                      type="int", dest="max_upload_workers",
+                      help="Upper bound for the number of storage client "
+                      "processes uploading at once. The number is adapted to "
+                      "the measured upload throughput. The default uploads "
+                      "the whole manifest with one process.")
+    parser.add_option("--max-read-rate", action="store", default=None,
+                      type="float", dest="max_read_rate",
+                      help="Cap for reading input files while hashing, in "
+                      "MB/s.")
+    parser.add_option("--max-upload-rate", action="store", default=None,
+                      type="float", dest="max_upload_rate",
+                      help="Cap for the upload rate in MB/s, averaged over "
+                      "upload chunks of about 1 GB.")
+    parser.add_option("--hash-backend", action="store", default="readinto",
+                      type="choice", choices=HASH_BACKENDS,
+                      dest="hash_backend",
+                      help="How files are read for hashing: readinto "
+                      "(default) or mmap stream the file without keeping it "
+                      "in the page cache, read is the plain buffered read.")
+    parser.add_option("--verify-content", action="store_true",
+                      default=False, dest="verify_content",
+                      help="While hashing, check the gzip CRCs of .gz and "
+                      ".bam files and count the fastq, vcf and bam records "
+                      "into file_stats. Corrupt or truncated files stop the "
+                      "run before anything is registered.")
+    parser.add_option("--max-fetch-workers", action="store", default=4,
+                      type="int", dest="max_fetch_workers",
+                      help="Number of http(s) File Paths downloaded at "
+                      "once.")
+    parser.add_option("--fetch-connections", action="store", default=4,
+                      type="int", dest="fetch_connections",
+                      help="Number of range requests per downloaded file "
+                      "run at once.")
+    parser.add_option("--metadata-url", action="store", default=None,
+                      type="string", dest="metadata_url",
+                      help="URL of the metadata server used to check for "
+                      "existing bundles. Default is "
+                      "https://metadata.$REDWOOD_ENDPOINT.")
+    parser.add_option("--metadata-cache-dir", action="store",
+                      default="~/.spinnaker/metadata-cache", type="string",
+                      dest="metadata_cache_dir",
+                      help="Dir where metadata server responses are cached. "
+                      "Set to an empty string to disable the cache.")
+    parser.add_option("--metadata-cache-ttl", action="store", default=300,
+                      type="int", dest="metadata_cache_ttl",
+                      help="Seconds cached metadata server responses are "
+                      "used without asking the server. Older responses are "
+                      "revalidated with their ETag.")
+    parser.add_option("--metadata-bulk-size", action="store", default=1,
+                      type="int", dest="metadata_bulk_size",
+                      help="Number of bundles looked up per metadata server "
+                      "request, as repeated gnosId parameters. Falls back "
+                      "to 1 if the server doesn't filter on all of them.")
+    parser.add_option("--ingest-processes", action="store", default=0,
+                      type="int", dest="ingest_processes",
+                      help="Number of processes parsing the input files at "
+                      "once. Default is one per CPU, up to one per file.")
+    parser.add_option("--report-rows", action="store", default=20,
+                      type="int", dest="report_rows",
+                      help="Number of rows of error tables shown on the "
+                      "console. The full tables are written to the output "
+                      "dir as tsv and json.")
+    parser.add_option("--log-rate-limit", action="store", default=10,
+                      type="int", dest="log_rate_limit",
+                      help="Log each kind of message at most this many times "
+                      "a minute and summarize the rest, 0 for no limit. "
+                      "Everything, with full row dumps, is written to the "
+                      "compressed spinnaker.debug.gz in the output dir.")
+    parser.add_option("--plan-only", action="store_true", default=False,
+                      dest="plan_only",
+                      help="Only run the pre-flight check of the input files "
+                      "and print the plan, then exit.")
+    parser.add_option("--plan-threads", action="store", default=16,
+                      type="int", dest="plan_threads",
+                      help="Number of threads used to stat the input files "
+                      "during the pre-flight check.")
+    parser.add_option("--plan-upload-rate", action="store", default=50.0,
+                      type="float", dest="plan_upload_rate",
+                      help="Upload rate in MB/s assumed when estimating the "
+                      "upload time.")
+
+    (options, args) = parser.parse_args(argv)
+
+    if options.partition is not None:
+        try:
+            options.partition = parsePartition(options.partition)
+        except ValueError as exc:
+            parser.error(str(exc))
+    if options.bundle_layout == "stream" and not options.skip_upload:
+        parser.error("--bundle-layout stream requires --skip-upload, the "
+                     "upload reads the bundle dirs")
 
     return (options, args, parser)
 
@@ -183,14 +615,34 @@ def loadJsonSchema(fileName):
     return schema
 
 
-def validateObjAgainstJsonSchema(obj, schema):
+def getValidationError(obj, schema):
     """
-    Validate an object against a schema.
+    Validate an object against a schema. schema may also be a compiled
+    validator, see SubmissionContext.getValidator(). Returns None if obj is
+    valid, otherwise the exception.
     """
     try:
-        jsonschema.validate(obj, schema)
+        if isinstance(schema, dict):
+            jsonschema.validate(obj, schema)
+        else:
+            schema.validate(obj)
     except Exception as exc:
-        logging.error("Schemd json validation failed: %s" % (str(exc)))
+        return exc
+    return None
+
+
+def validateObjAgainstJsonSchema(obj, schema):
+    """
+    Validate an object against a schema. schema may also be a compiled
+    validator, see SubmissionContext.getValidator().
+    """
+    exc = getValidationError(obj, schema)
+    if exc is not None:
+        # str() of a ValidationError includes the schema and the instance
+        message = getattr(exc, "message", None) or str(exc)
+        logging.error("Schemd json validation failed: %s", message,
+                      extra={"aggregateKey": message})
+        dumpLogger.debug("Schemd json validation failed: %s", exc)
         return False
     return True
 
@@ -250,36 +702,39 @@ def generateUuid5(nameComponents, namespace=uuid.NAMESPACE_URL):
     return id
 
 
+#    donor_uuid: ["center_name", "submitter_donor_id"]
+#Include 'project', 'program', submitter_donor_primary_site',
+#which are all at the same level in the metadata,
+#when creating donor uuid, so that when donors with the same
+#center name and submitter donor id are merged, donors under different projects
+#or program, or project or submitter_donor_primary_site aren't merged together
+DONOR_KEY_FIELDS = ["program", "center_name", "submitter_donor_id", "project",
+                    "submitter_donor_primary_site"]
+SPECIMEN_KEY_FIELDS = DONOR_KEY_FIELDS + ["submitter_specimen_id"]
+SAMPLE_KEY_FIELDS = SPECIMEN_KEY_FIELDS + ["submitter_sample_id"]
+# must follow sample_uuid assignment
+WORKFLOW_KEY_FIELDS = ["sample_uuid", "workflow_name", "workflow_version"]
+UUID_KEY_FIELDS = [("donor_uuid", DONOR_KEY_FIELDS),
+                   ("specimen_uuid", SPECIMEN_KEY_FIELDS),
+                   ("sample_uuid", SAMPLE_KEY_FIELDS),
+                   ("workflow_uuid", WORKFLOW_KEY_FIELDS)]
+
+
 def setUuids(dataObj):
     """
     Set donor_uuid, specimen_uuid, and sample_uuid for dataObj.
     Uses uuid.uuid5().
     """
-    keyFieldsMapping = {}
-#    keyFieldsMapping["donor_uuid"] = ["center_name", "submitter_donor_id"]
-    #Include 'project', 'program', submitter_donor_primary_site', 
-    #which are all at the same level in the metadata,
-    #when creating donor uuid, so that when donors with the same
-    #center name and submitter donor id are merged, donors under different projects 
-    #or program, or project or submitter_donor_primary_site aren't merged together
-    keyFieldsMapping["donor_uuid"] = ["program", "center_name", "submitter_donor_id", "project", \
-                                      "submitter_donor_primary_site"]
-
-
-    keyFieldsMapping["specimen_uuid"] = list(keyFieldsMapping["donor_uuid"])
-    keyFieldsMapping["specimen_uuid"].append("submitter_specimen_id")
-
-    keyFieldsMapping["sample_uuid"] = list(keyFieldsMapping["specimen_uuid"])
-    keyFieldsMapping["sample_uuid"].append("submitter_sample_id")
-
-#     keyFieldsMapping["workflow_uuid"] = ["sample_uuid", "workflow_name",
-# "workflow_version"]
+    keyFieldsMapping = dict(UUID_KEY_FIELDS[:3])
 
     for uuidName in keyFieldsMapping.keys():
         keyList = []
         for field in keyFieldsMapping[uuidName]:
             if dataObj[field] is None:
-                logging.error("%s not found in %s" % (field, jsonPP(dataObj)))
+                logging.error("%s not found in row", field,
+                              extra={"aggregateKey": "missing " + field})
+                dumpLogger.debug("%s not found in %s", field,
+                                 LazyJson(dataObj))
                 return None
             else:
                 keyList.append(dataObj[field])
@@ -287,11 +742,12 @@ def setUuids(dataObj):
         dataObj[uuidName] = id
 
     # must follow sample_uuid assignment
-    workflow_uuid_keys = ["sample_uuid", "workflow_name", "workflow_version"]
     keyList = []
-    for field in workflow_uuid_keys:
+    for field in WORKFLOW_KEY_FIELDS:
         if dataObj[field] is None:
-            logging.error("%s not found in %s" % (field, jsonPP(dataObj)))
+            logging.error("%s not found in row", field,
+                          extra={"aggregateKey": "missing " + field})
+            dumpLogger.debug("%s not found in %s", field, LazyJson(dataObj))
             return None
         else:
             keyList.append(dataObj[field])
@@ -299,7 +755,218 @@ def setUuids(dataObj):
     dataObj["workflow_uuid"] = id
 
 
-def getDataObj(dict, schema):
+class Row(object):
+    """
+    One flattened metadata row (one output file) from an input manifest.
+    Supports item access so it can be used wherever the old row dicts were.
+    Properties of the input schema that are not listed in FIELDS are kept in
+    'extra'.
+    """
+    FIELDS = (
+        "program", "project", "center_name", "submitter_donor_id",
+        "donor_uuid", "submitter_donor_primary_site", "submitter_specimen_id",
+        "specimen_uuid", "submitter_specimen_type",
+        "submitter_experimental_design", "submitter_sample_id", "sample_uuid",
+        "analysis_type", "workflow_name", "workflow_version", "file_type",
+        "file_path", "workflow_uuid")
+    __slots__ = FIELDS + ("extra", "source")
+
+    def __init__(self):
+        for field in Row.FIELDS:
+            setattr(self, field, '')
+        self.extra = None
+        # "<input file>:<row number>" the row was read from
+        self.source = None
+
+    def __getstate__(self):
+        return [getattr(self, slot) for slot in Row.__slots__]
+
+    def __setstate__(self, state):
+        for slot, value in zip(Row.__slots__, state):
+            setattr(self, slot, value)
+
+    def __getitem__(self, key):
+        if key in Row.FIELDS:
+            return getattr(self, key)
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in Row.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return key in Row.FIELDS or (self.extra is not None and
+                                     key in self.extra)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def to_dict(self):
+        obj = dict((field, getattr(self, field)) for field in Row.FIELDS)
+        if self.extra is not None:
+            obj.update(self.extra)
+        return obj
+
+
+class BundleFile(object):
+    """
+    One entry of a bundle's workflow_outputs.
+    """
+    __slots__ = ("file_type", "file_path", "file_size", "file_sha",
+                 "reference", "file_uuid", "stats")
+
+    def __init__(self, file_type, file_path, file_size=None, file_sha=None,
+                 reference=None, file_uuid=None, stats=None):
+        self.file_type = file_type
+        self.file_path = file_path
+        self.file_size = file_size
+        self.file_sha = file_sha
+        # {"bundle_uuid": ..., "file_path": ...} of the identical file that
+        # is uploaded instead of this one
+        self.reference = reference
+        # object id, only known up front for files uploaded previously
+        self.file_uuid = file_uuid
+        # integrity.ContentInspector stats, with --verify-content
+        self.stats = stats
+
+    @classmethod
+    def from_dict(cls, obj):
+        return cls(obj["file_type"], obj["file_path"], obj.get("file_size"),
+                   obj.get("file_sha"), obj.get("file_reference"),
+                   obj.get("file_uuid"), obj.get("file_stats"))
+
+    def to_dict(self):
+        obj = {"file_type": self.file_type, "file_path": self.file_path}
+        if self.file_size is not None:
+            obj["file_size"] = self.file_size
+        if self.file_sha is not None:
+            obj["file_sha"] = self.file_sha
+        if self.reference is not None:
+            obj["file_reference"] = self.reference
+        if self.file_uuid is not None:
+            obj["file_uuid"] = self.file_uuid
+        if self.stats is not None:
+            obj["file_stats"] = self.stats
+        return obj
+
+
+class Bundle(object):
+    """
+    A data bundle: 1 donor, 1 specimen, 1 sample, 1 analysis and its
+    workflow_outputs. to_dict() gives the structure written to metadata.json.
+    """
+    DONOR_FIELDS = ("program", "project", "center_name", "submitter_donor_id",
+                    "donor_uuid", "submitter_donor_primary_site")
+    SPECIMEN_FIELDS = ("submitter_specimen_id", "submitter_specimen_type",
+                       "submitter_experimental_design", "specimen_uuid")
+    SAMPLE_FIELDS = ("submitter_sample_id", "sample_uuid")
+    ANALYSIS_FIELDS = ("workflow_name", "workflow_version", "analysis_type",
+                       "bundle_uuid")
+    __slots__ = DONOR_FIELDS + SPECIMEN_FIELDS + SAMPLE_FIELDS + \
+        ANALYSIS_FIELDS + ("timestamp", "schema_version", "workflow_outputs")
+
+    def __init__(self):
+        self.timestamp = None
+        self.schema_version = None
+        self.workflow_outputs = []
+
+    @classmethod
+    def from_row(cls, row, schema_version):
+        bundle = cls()
+        for field in cls.DONOR_FIELDS + cls.SPECIMEN_FIELDS + \
+                cls.SAMPLE_FIELDS:
+            setattr(bundle, field, row[field])
+        bundle.workflow_name = row["workflow_name"]
+        bundle.workflow_version = row["workflow_version"]
+        bundle.analysis_type = row["analysis_type"]
+        bundle.bundle_uuid = row["workflow_uuid"]
+        bundle.timestamp = getNow().isoformat()
+        bundle.schema_version = schema_version
+        return bundle
+
+    @classmethod
+    def from_dict(cls, obj):
+        """
+        Build a Bundle from a parsed metadata.json object.
+        """
+        bundle = cls()
+        specimen = obj["specimen"][0]
+        sample = specimen["samples"][0]
+        analysis = sample["analysis"][0]
+        for field in cls.DONOR_FIELDS:
+            setattr(bundle, field, getValueFromObject(obj, field))
+        for field in cls.SPECIMEN_FIELDS:
+            setattr(bundle, field, specimen[field])
+        for field in cls.SAMPLE_FIELDS:
+            setattr(bundle, field, sample[field])
+        for field in cls.ANALYSIS_FIELDS:
+            setattr(bundle, field, analysis[field])
+        bundle.timestamp = obj.get("timestamp")
+        bundle.schema_version = obj.get("schema_version")
+        bundle.workflow_outputs = [BundleFile.from_dict(output)
+                                   for output in analysis["workflow_outputs"]]
+        return bundle
+
+    def to_dict(self):
+        analysis = dict((field, getattr(self, field))
+                        for field in Bundle.ANALYSIS_FIELDS)
+        analysis["workflow_outputs"] = [output.to_dict()
+                                        for output in self.workflow_outputs]
+        sample = dict((field, getattr(self, field))
+                      for field in Bundle.SAMPLE_FIELDS)
+        sample["analysis"] = [analysis]
+        specimen = dict((field, getattr(self, field))
+                        for field in Bundle.SPECIMEN_FIELDS)
+        specimen["samples"] = [sample]
+        obj = dict((field, getattr(self, field))
+                   for field in Bundle.DONOR_FIELDS)
+        obj["timestamp"] = self.timestamp
+        obj["schema_version"] = self.schema_version
+        obj["specimen"] = [specimen]
+        return obj
+
+
+class ReceiptLine(object):
+    """
+    One line of the upload receipt. The common fields are read from the
+    shared Bundle instead of being copied for every file.
+    """
+    FIELDS = (
+        "program", "project", "center_name", "submitter_donor_id",
+        "donor_uuid", "submitter_donor_primary_site",
+        "submitter_specimen_id", "specimen_uuid",
+        "submitter_specimen_type", "submitter_experimental_design",
+        "submitter_sample_id", "sample_uuid", "analysis_type",
+        "workflow_name", "workflow_version", "file_type", "file_path",
+        "file_uuid", "bundle_uuid", "metadata_uuid")
+    __slots__ = ("bundle", "output", "file_uuid", "metadata_uuid")
+
+    def __init__(self, bundle, output, file_uuid, metadata_uuid):
+        self.bundle = bundle
+        self.output = output
+        self.file_uuid = file_uuid
+        self.metadata_uuid = metadata_uuid
+
+    def __getitem__(self, key):
+        if key in ("file_uuid", "metadata_uuid"):
+            return getattr(self, key)
+        if key in ("file_type", "file_path"):
+            return getattr(self.output, key)
+        if key in ReceiptLine.FIELDS:
+            return getattr(self.bundle, key)
+        raise KeyError(key)
+
+    def values(self):
+        return [self[field] for field in ReceiptLine.FIELDS]
+
+
+def getDataObj(dict, schema, validator=None):
     """
     Pull data out from dict. Use the flattened schema to get the key names
     as well as validate. If validation fails, return None.
@@ -309,55 +976,392 @@ def getDataObj(dict, schema):
 #     schema["properties"]["workflow_uuid"] = {"type": "string"}
     propNames = schema["properties"].keys()
 
-    dataObj = {}
+    dataObj = Row()
     for propName in propNames:
         dataObj[propName] = getValueFromObject(dict, propName)
         # dict[propName]
 
-    if "workflow_uuid" in dict.keys():
+    if "workflow_uuid" in dict:
         dataObj["workflow_uuid"] = dict["workflow_uuid"]
 
-    isValid = validateObjAgainstJsonSchema(dataObj, schema)
+    isValid = validateObjAgainstJsonSchema(dataObj.to_dict(),
+                                           validator or schema)
     if (isValid):
         return dataObj
     else:
-        logging.error("Validation failed for %s" % (jsonPP(dataObj)))
+        logging.error("Validation failed for row")
+        dumpLogger.debug("Validation failed for %s", LazyJson(dataObj))
         return None
 
 
-def getDataDictFromXls(fileName, sheetName="Sheet1"):
+class RowLogCapture(logging.Filter):
     """
-    Get list of dict objects from .xlsx,.xlsm,.xltx,.xltm.
+    Filter on the root logger that collects the records logged by a thread
+    while capture() is active for it, instead of emitting them.
     """
-    logging.debug("Attempt to read %s as xls file" % (fileName))
-    workbook = openpyxl.load_workbook(fileName)
-    sheetNames = workbook.get_sheet_names()
-    logging.debug("Sheet names: %s" % (str(sheetNames)))
 
-    worksheet = workbook.get_sheet_by_name(sheetName)
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.records = []
+
+    def release(self):
+        records = self.local.records
+        self.local.records = None
+        return records
+
+    def filter(self, record):
+        records = getattr(self.local, "records", None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+
+rowLogCapture = RowLogCapture()
+
+# schemas and validators of ingest worker processes
+ingestSchemas = {}
+
 
-    headerRow = worksheet.rows[0]
-    dataRows = worksheet.rows[1:]
+# jsonschema keywords that ManifestColumns.checkSchema() can check column-wise
+COLUMN_CHECK_KEYWORDS = set(["type", "minLength", "maxLength", "enum",
+                             "pattern", "title", "description"])
 
-    # map column index to column name
-    colMapping = {}
-    for colIdx in xrange(len(headerRow)):
-        cell = headerRow[colIdx]
-        value = cell.value
-        if (value is not None):
-            colMapping[colIdx] = normalizePropertyName(value)
 
-    # build up list of row data objs
-    data = []
-    for row in dataRows:
-        rowDict = {}
-        data.append(rowDict)
-        for colIdx in colMapping.keys():
-            colName = colMapping[colIdx]
-            value = row[colIdx].value
-            rowDict[colName] = value
+def isValidString(minLength, maxLength, enum, pattern, value):
+    """
+    Whether value passes a string property schema, see
+    ManifestColumns.checkSchema().
+    """
+    return isinstance(value, basestring) and len(value) >= minLength and \
+        (maxLength is None or len(value) <= maxLength) and \
+        (enum is None or value in enum) and \
+        (pattern is None or pattern.search(value) is not None)
+
+
+class ManifestColumns(object):
+    """
+    The rows of one input manifest as a list of values per normalized field
+    name, so the per-field work is done once per column instead of once
+    per row: field names are normalized once, uuids are derived for each
+    distinct key only, and simple schemas are checked column-wise.
+    rowNumbers are those shown by a spreadsheet program, the header being
+    row 1.
+    """
+
+    def __init__(self, columns, rowNumbers):
+        self.columns = columns
+        # derived by setUuids(), these replace uuid columns of the input
+        self.uuidColumns = {}
+        self.rowNumbers = rowNumbers
+        self.numRows = len(rowNumbers)
+
+    @classmethod
+    def fromFile(cls, fileName):
+        try:
+            # attempt to process as xls file
+            columns, rowNumbers = getColumnsFromXls(fileName)
+        except:
+            # attempt to process as tsv file
+            columns, rowNumbers = getColumnsFromTsv(fileName)
+        return cls(columns, rowNumbers)
+
+    def getColumn(self, name):
+        if name in self.uuidColumns:
+            return self.uuidColumns[name]
+        return self.columns.get(name)
+
+    def getRow(self, index):
+        """
+        The input values of a row as a dict, without derived uuids.
+        """
+        return dict((name, column[index])
+                    for name, column in self.columns.iteritems())
+
+    def setUuids(self):
+        """
+        Derive the donor, specimen, sample and workflow uuid columns, see
+        setUuids(). Returns the set of row indices whose uuids could not be
+        derived because a key field is missing or not text.
+        """
+        badRows = set()
+        checked = set()
+        for uuidName, keyFields in UUID_KEY_FIELDS:
+            keyColumns = []
+            for field in keyFields:
+                column = self.getColumn(field)
+                if column is None:
+                    return set(xrange(self.numRows))
+                if field not in checked:
+                    badRows.update(self.findRows(
+                        column, lambda value: isinstance(value, basestring)))
+                    checked.add(field)
+                keyColumns.append(column)
+            # many rows share a donor, specimen or sample
+            uuids = {}
+            uuidColumn = []
+            for i, key in enumerate(izip(*keyColumns)):
+                id = uuids.get(key)
+                if id is None and i not in badRows:
+                    id = uuids[key] = generateUuid5(key)
+                uuidColumn.append(id)
+            self.uuidColumns[uuidName] = uuidColumn
+        return badRows
+
+    @staticmethod
+    def findRows(column, isValid):
+        """
+        Indices of the values of column for which isValid() is False. It is
+        called once per distinct value.
+        """
+        invalid = set(value for value in set(column) if not isValid(value))
+        if not invalid:
+            return []
+        return [i for i, value in enumerate(column) if value in invalid]
+
+    def checkSchema(self, schema):
+        """
+        Returns the set of row indices that fail schema, checked column-wise,
+        or None if the schema uses more than simple string property checks.
+        Rows are built with exactly the schema's properties, a missing
+        column being ''.
+        """
+        if set(schema) - set(["$schema", "title", "description", "type",
+                              "properties"]) or \
+                schema.get("type", "object") != "object":
+            return None
+        badRows = set()
+        for propName, propSchema in schema.get("properties", {}).items():
+            if set(propSchema) - COLUMN_CHECK_KEYWORDS or \
+                    propSchema.get("type", "string") != "string":
+                return None
+            column = self.getColumn(propName)
+            if column is None:
+                column = [''] * self.numRows
+            badRows.update(self.findRows(
+                column, partial(isValidString, propSchema.get("minLength", 0),
+                                propSchema.get("maxLength"),
+                                propSchema.get("enum"),
+                                re.compile(propSchema["pattern"])
+                                if "pattern" in propSchema else None)))
+        return badRows
+
+    def getDataObjs(self, propNames):
+        """
+        Yield the Row that getDataObj() builds for each row, assuming its
+        uuids are set and it passed the schema.
+        """
+        extraNames = [name for name in propNames if name not in Row.FIELDS]
+        columns = []
+        for name in Row.FIELDS + tuple(extraNames):
+            column = None
+            if name in propNames or name == "workflow_uuid":
+                column = self.getColumn(name)
+            columns.append(column if column is not None
+                           else repeat('', self.numRows))
+        numFields = len(Row.FIELDS)
+        for values in izip(*columns):
+            # every slot is set here, skip Row.__init__
+            dataObj = Row.__new__(Row)
+            for field, value in izip(Row.FIELDS, values):
+                setattr(dataObj, field, value)
+            dataObj.extra = dict(izip(extraNames, values[numFields:])) \
+                if extraNames else None
+            dataObj.source = None
+            yield dataObj
+
+
+def parseManifest(fileName, schemaFileName, schema=None, validator=None):
+    """
+    Read and validate the rows of one input manifest. Returns a list of
+    (row number, Row or None, [(logger name, log level, aggregate key,
+    message)]), the messages being those logged while the row was
+    processed. Runs in the worker processes of readManifests(), which load
+    the schema themselves.
+    """
+    if schema is None:
+        if schemaFileName not in ingestSchemas:
+            schema = loadJsonSchema(schemaFileName)
+            cls = jsonschema.validators.validator_for(schema)
+            ingestSchemas[schemaFileName] = (schema, cls(schema))
+        schema, validator = ingestSchemas[schemaFileName]
+    for logger in (logging.getLogger(), dumpLogger):
+        if rowLogCapture not in logger.filters:
+            logger.addFilter(rowLogCapture)
+
+    manifest = ManifestColumns.fromFile(fileName)
+    # rows failing the column-wise checks go through getDataObj() one at a
+    # time, for its error messages
+    slowRows = manifest.setUuids()
+    badRows = manifest.checkSchema(schema)
+    if badRows is None:
+        slowRows = set(xrange(manifest.numRows))
+    else:
+        slowRows.update(badRows)
+    propNames = schema["properties"].keys()
+
+    results = []
+    dataObjs = manifest.getDataObjs(propNames)
+    for index, rowNumber in enumerate(manifest.rowNumbers):
+        records = []
+        fastObj = next(dataObjs)
+        if index in slowRows:
+            rowLogCapture.capture()
+            try:
+                metaObj = getDataObj(manifest.getRow(index), schema,
+                                     validator)
+            except KeyError as exc:
+                logging.error("column %s is missing" % exc)
+                metaObj = None
+            finally:
+                records = rowLogCapture.release()
+        else:
+            metaObj = fastObj
+        if metaObj is not None:
+            metaObj.source = "%s:%s" % (fileName, rowNumber)
+        results.append((rowNumber, metaObj,
+                        [(record.name, record.levelno,
+                          logqueue.getAggregateKey(record),
+                          record.getMessage())
+                         for record in records]))
+    return results
 
-    return data
+
+def parseManifestInWorker(args):
+    return parseManifest(*args)
+
+
+def readManifests(fileNames, schemaFileName, schema, validator, processes=0,
+                  invalidRows=None):
+    """
+    Yield the valid Rows of all input manifests in the order of fileNames
+    and their rows, each tagged with its source "<file>:<row>". The files
+    are parsed by a pool of processes (0 is one per CPU, up to one per
+    file) while the rows of the first files are already yielded. Messages
+    about a row are logged prefixed with its source. Invalid rows are added
+    to the invalidRows report.ReportTable (columns source and error) if
+    given, their messages are then only logged at debug level.
+    """
+    if processes <= 0:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(fileNames))
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        parsed = pool.imap(parseManifestInWorker,
+                           [(fileName, schemaFileName)
+                            for fileName in fileNames])
+    else:
+        parsed = (parseManifest(fileName, schemaFileName, schema, validator)
+                  for fileName in fileNames)
+    try:
+        for fileName, results in izip(fileNames, parsed):
+            for rowNumber, metaObj, messages in results:
+                source = "%s:%s" % (fileName, rowNumber)
+                if metaObj is None and invalidRows is not None:
+                    errors = [message for name, level, key, message
+                              in messages if level >= logging.ERROR and
+                              name != dumpLogger.name]
+                    invalidRows.add({"source": source,
+                                     "error": errors[0] if errors else ""})
+                    for name, level, key, message in messages:
+                        logging.getLogger(name).debug(
+                            "%s: %s", source, message,
+                            extra={"aggregateKey": key})
+                    continue
+                for name, level, key, message in messages:
+                    logging.getLogger(name).log(
+                        level, "%s: %s", source, message,
+                        extra={"aggregateKey": key})
+                if metaObj is not None:
+                    yield metaObj
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def parsePartition(partitionStr):
+    """
+    Parse a "K/N" partition spec into a (K, N) tuple, 1 <= K <= N.
+    """
+    try:
+        k, n = [int(x) for x in partitionStr.split("/")]
+    except ValueError:
+        raise ValueError("invalid partition '{}', expected K/N".format(
+            partitionStr))
+    if n < 1 or k < 1 or k > n:
+        raise ValueError("invalid partition '{}', need 1 <= K <= N".format(
+            partitionStr))
+    return (k, n)
+
+
+def getPartition(donor_uuid, numPartitions):
+    """
+    Deterministically map a donor_uuid to a 1-based partition number.
+    """
+    return uuid.UUID(donor_uuid).int % numPartitions + 1
+
+
+def filterPartition(flatMetadataObjs, partition):
+    """
+    Keep only the rows whose donor falls into partition (K, N).
+    """
+    k, n = partition
+    return [metaObj for metaObj in flatMetadataObjs
+            if getPartition(metaObj["donor_uuid"], n) == k]
+
+
+def getColumnsFromXls(fileName, sheetName="Sheet1"):
+    """
+    Get {normalized column name: list of cell values} from
+    .xlsx,.xlsm,.xltx,.xltm.
+    """
+    workbook = openpyxl.load_workbook(fileName)
+    worksheet = workbook.get_sheet_by_name(sheetName)
+    rows = iter(worksheet.rows)
+    headerRow = next(rows, ())
+    colMapping = [(colIdx, normalizePropertyName(cell.value))
+                  for colIdx, cell in enumerate(headerRow)
+                  if cell.value is not None]
+    valueRows = [[cell.value for cell in row] for row in rows]
+    columns = {}
+    for colIdx, colName in colMapping:
+        columns[colName] = [row[colIdx] if colIdx < len(row) else None
+                            for row in valueRows]
+    return columns, range(2, len(valueRows) + 2)
+
+
+def getColumnsFromTsv(fileName):
+    """
+    Get {normalized column name: list of values} and the line numbers of
+    the rows from a tsv file. Short rows are filled with None like
+    csv.DictReader does.
+    """
+    reader = csv.reader(readFileLines(fileName), delimiter="\t")
+    header = next(reader, None)
+    if header is None:
+        return {}, []
+    numColumns = len(header)
+    rows = []
+    rowNumbers = []
+    for row in reader:
+        if row:
+            if len(row) < numColumns:
+                row.extend([None] * (numColumns - len(row)))
+            rows.append(row)
+            rowNumbers.append(reader.line_num)
+    columns = {}
+    if rows:
+        for colName, column in izip(header, izip(*rows)):
+            columns[normalizePropertyName(colName)] = column
+    else:
+        for colName in header:
+            columns[normalizePropertyName(colName)] = ()
+    return columns, rowNumbers
 
 
 def ln_s(file_path, link_path):
@@ -384,6 +1388,62 @@ def ln_s(file_path, link_path):
     return None
 
 
+# linux ioctl to clone a file's extents (btrfs, xfs)
+FICLONE = 0x40049409
+
+LINK_STRATEGIES = ["symlink", "hardlink", "reflink"]
+
+STAGING_PREFIX = ".staging-"
+
+# bundle dirs, export.py stream, or both
+BUNDLE_LAYOUTS = ["dirs", "stream", "both"]
+
+# http(s) File Paths are downloaded below this dir of the output dir
+DOWNLOAD_DIR = ".downloads"
+
+
+def reflink(file_path, link_path):
+    """
+    cp --reflink=always
+    """
+    with open(file_path, 'rb') as src:
+        fd = os.open(link_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                     os.fstat(src.fileno()).st_mode & 0777)
+        try:
+            ioctl(fd, FICLONE, src.fileno())
+        except (IOError, OSError):
+            os.close(fd)
+            os.unlink(link_path)
+            raise
+        os.close(fd)
+    return None
+
+
+def linkFile(file_path, link_path, strategy="symlink"):
+    """
+    Place file_path at link_path as a symlink, hard link or reflink copy.
+    Hard links and reflinks fall back to a symlink if the file system can't
+    do them. Returns the strategy that was used.
+    """
+    if strategy == "hardlink":
+        try:
+            os.link(os.path.realpath(file_path), link_path)
+            return strategy
+        except OSError as exc:
+            if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    elif strategy == "reflink":
+        try:
+            reflink(os.path.realpath(file_path), link_path)
+            return strategy
+        except (IOError, OSError) as exc:
+            if exc.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL,
+                                 errno.ENOTTY):
+                raise
+    ln_s(file_path, link_path)
+    return "symlink"
+
+
 def mkdir_p(path):
     """
     mkdir -p
@@ -398,161 +1458,522 @@ def mkdir_p(path):
     return None
 
 
-def getWorkflowObjects(flatMetadataObjs):
+def formatBytes(num):
+    """
+    Human readable byte count, e.g. 1.5 GB
+    """
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(num) < 1024.0 or unit == "TB":
+            break
+        num /= 1024.0
+    return "%.1f %s" % (num, unit)
+
+
+def getMountPoint(path):
+    """
+    Get the mount point of the file system holding path.
+    """
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def statInputFile(file_path):
     """
-    For each flattened metadata object, build up a metadataObj with
-    correct structure.
+    stat one input file for the pre-flight plan. Returns a dict with the
+    size, device and symlink target of the file, or an error message.
+    For http(s) URLs the device is the host.
+    """
+    info = {"file_path": file_path, "size": 0, "device": None,
+            "link_target": None, "error": None}
+    if fetch.isRemote(file_path):
+        # remote files are grouped by host
+        try:
+            info["size"] = fetch.statUrl(file_path)["size"] or 0
+            info["device"] = fetch.getHost(file_path)
+        except fetch.FetchError as exc:
+            info["error"] = str(exc)
+        return info
+    try:
+        if os.path.islink(file_path):
+            info["link_target"] = os.path.realpath(file_path)
+        st = os.stat(file_path)
+        if not stat.S_ISREG(st.st_mode):
+            info["error"] = "not a regular file"
+        elif not os.access(file_path, os.R_OK):
+            info["error"] = "not readable"
+        else:
+            info["size"] = st.st_size
+            info["device"] = st.st_dev
+    except OSError as exc:
+        if info["link_target"] is not None:
+            info["error"] = "broken symlink to {}".format(info["link_target"])
+        else:
+            info["error"] = exc.strerror
+    return info
+
+
+def measureHashThroughput(file_path, sampleSize=64 * 1024 * 1024):
+    """
+    Hash up to sampleSize bytes of file_path and return the throughput in
+    bytes/s, or None if too little was read to measure.
+    """
+    d = hashlib.sha1()
+    numBytes = 0
+    start = time.time()
+    with open(file_path, mode='rb') as f:
+        while numBytes < sampleSize:
+            buf = f.read(1024 * 1024)
+            if not buf:
+                break
+            d.update(buf)
+            numBytes += len(buf)
+    elapsed = time.time() - start
+    if numBytes == 0 or elapsed <= 0:
+        return None
+    return numBytes / elapsed
+
+
+def planUpload(flatMetadataObjs, numThreads=16, uploadRate=None,
+               numHashPasses=1):
+    """
+    Pre-flight check: stat every input file in parallel, group the files by
+    device and estimate hash and upload times. uploadRate is in bytes/s.
+    Returns a plan dict, plan["errors"] lists the files that can't be used.
+    """
+    filePaths = sorted(set(metaObj["file_path"]
+                           for metaObj in flatMetadataObjs))
+    pool = ThreadPool(max(1, numThreads))
+    try:
+        infos = pool.map(statInputFile, filePaths)
+    finally:
+        pool.close()
+        pool.join()
+
+    plan = {"num_files": len(filePaths),
+            "num_bundles": len(set(metaObj["workflow_uuid"]
+                                   for metaObj in flatMetadataObjs)),
+            "total_bytes": 0, "devices": {}, "errors": [],
+            "hash_seconds": 0.0, "upload_seconds": None}
+    for info in infos:
+        if info["error"] is not None:
+            plan["errors"].append(info)
+            continue
+        plan["total_bytes"] += info["size"]
+        remote = fetch.isRemote(info["file_path"])
+        device = plan["devices"].setdefault(info["device"], {
+            "mount_point": info["device"] if remote
+            else getMountPoint(info["file_path"]), "remote": remote,
+            "num_files": 0, "total_bytes": 0, "largest_file": None,
+            "largest_size": -1, "hash_rate": None})
+        device["num_files"] += 1
+        device["total_bytes"] += info["size"]
+        if info["size"] > device["largest_size"]:
+            device["largest_file"] = info["file_path"]
+            device["largest_size"] = info["size"]
+
+    # sample the hashing throughput once per device, remote files are
+    # hashed while they download
+    for device in plan["devices"].values():
+        if device["remote"]:
+            continue
+        device["hash_rate"] = measureHashThroughput(device["largest_file"])
+        if device["hash_rate"]:
+            plan["hash_seconds"] += \
+                numHashPasses * device["total_bytes"] / device["hash_rate"]
+    if uploadRate:
+        plan["upload_seconds"] = plan["total_bytes"] / uploadRate
+    return plan
+
+
+def logPlan(plan):
+    """
+    Print the pre-flight plan.
+    """
+    logging.info("pre-flight plan: %s files in %s bundles, %s total"
+                 % (plan["num_files"], plan["num_bundles"],
+                    formatBytes(plan["total_bytes"])))
+    for device in sorted(plan["devices"].values(),
+                         key=lambda x: x["mount_point"]):
+        rate = device["hash_rate"]
+        if device["remote"]:
+            hashing = "hashed while downloading"
+        else:
+            hashing = "hashing at " + \
+                (formatBytes(rate) + "/s" if rate else "n/a")
+        logging.info("  %s: %s files, %s, %s"
+                     % (device["mount_point"], device["num_files"],
+                        formatBytes(device["total_bytes"]), hashing))
+    logging.info("estimated hash time: %s"
+                 % datetime.timedelta(seconds=int(plan["hash_seconds"])))
+    if plan["upload_seconds"] is not None:
+        logging.info("estimated upload time: %s" % datetime.timedelta(
+            seconds=int(plan["upload_seconds"])))
+    for info in plan["errors"]:
+        logging.error("%s: %s" % (info["file_path"], info["error"]))
+    return None
+
+
+def groupRows(rows, field):
+    """
+    Group rows by the value of field in one pass. Returns {value: [rows]}.
+    """
+    groups = {}
+    for row in rows:
+        key = row[field]
+        group = groups.get(key)
+        if group is None:
+            groups[key] = [row]
+        else:
+            group.append(row)
+    return groups
+
+
+def getDownloadPath(outputDir, url):
+    """
+    Where url is downloaded to: <outputDir>/.downloads/<sha1 of url>/<file
+    name>, the same path in every run so that downloads can resume. URLs
+    without a file name are downloaded to a file named download.
+    """
+    return os.path.join(outputDir, DOWNLOAD_DIR,
+                        hashlib.sha1(url).hexdigest()[:16],
+                        fetch.getFileName(url) or "download")
+
+
+FETCH_ERROR_COLUMNS = ["source", "url", "error"]
+
+
+def fetchRemoteFiles(flatMetadataObjs, checksumCache, options, events=None):
+    """
+    Download the http(s) File Paths of the rows into the output dir,
+    options.max_fetch_workers files at once, hashing them on the way, and
+    point the rows at the downloaded files. Each URL is fetched once.
+    Raises SubmissionError with a table of the URLs that failed.
+    """
+    urls = sorted(set(metaObj["file_path"] for metaObj in flatMetadataObjs
+                      if fetch.isRemote(metaObj["file_path"])))
+    if not urls:
+        return None
+    callback = None
+    if events is not None:
+        callback = partial(events.progress, "fetch")
+    fetcher = fetch.Fetcher(
+        options.fetch_connections,
+        poolSize=options.max_fetch_workers * options.fetch_connections,
+        callback=callback)
+
+    def fetchFile(url):
+        path = getDownloadPath(options.metadataOutDir, url)
+        inspector = integrity.getInspector(path) \
+            if checksumCache.verifyContent else None
+        try:
+            sums = fetcher.fetch(url, path, inspector)
+        except (fetch.FetchError, IOError, OSError) as exc:
+            return url, None, str(exc)
+        checksumCache.put(path, sums,
+                          inspector.finish() if inspector is not None
+                          else None)
+        return url, path, None
+
+    pool = ThreadPool(max(1, min(options.max_fetch_workers, len(urls))))
+    try:
+        results = pool.map(fetchFile, urls)
+    finally:
+        pool.close()
+        pool.join()
+
+    paths = {}
+    errors = {}
+    for url, path, error in results:
+        paths[url] = path
+        if error is not None:
+            errors[url] = error
+    fetchErrors = report.ReportTable(
+        "fetch_errors", FETCH_ERROR_COLUMNS, options.metadataOutDir,
+        options.report_rows)
+    with fetchErrors:
+        for metaObj in flatMetadataObjs:
+            url = metaObj["file_path"]
+            if url in errors:
+                fetchErrors.add({"source": metaObj.source, "url": url,
+                                 "error": errors[url]})
+            elif url in paths:
+                metaObj["file_path"] = paths[url]
+    if fetchErrors.numRows:
+        raise SubmissionError("\n{} file(s) could not be downloaded. Run "
+                              "again to resume.\nNO DATA WAS UPLOADED.\n\n"
+                              "{}\n".format(len(errors),
+                                           fetchErrors.format()))
+    logging.info("downloaded %s files" % len(urls))
+    return None
+
+
+def getWorkflowObjects(flatMetadataObjs, checksumCache=None,
+                       dedupReferences=False, events=None):
+    """
+    For each flattened metadata object, build up a Bundle with correct
+    structure. Returns a map of workflow_uuid to Bundle.
+    With dedupReferences, a file whose content (size and sha1) was already
+    seen in an earlier bundle references that bundle instead of being
+    uploaded again.
     """
     schema_version = "0.0.3"
+    if checksumCache is None:
+        checksumCache = ChecksumCache()
+    # (size, sha1) -> reference to first bundle file with that content
+    contentIndex = {}
+    uploadBytesSaved = 0
 
-    commonObjMap = {}
+    checksumCache.prefetch([metaObj["file_path"]
+                            for metaObj in flatMetadataObjs], events)
+
+    commonObjMap = dict(
+        (workflow_uuid, Bundle.from_row(metaObjs[0], schema_version))
+        for workflow_uuid, metaObjs in groupRows(
+            flatMetadataObjs, "workflow_uuid").iteritems())
+
+    # add file info, in row order so references point to the first bundle
     for metaObj in flatMetadataObjs:
         workflow_uuid = metaObj["workflow_uuid"]
-        if workflow_uuid in commonObjMap.keys():
-            pass
+        bundle = commonObjMap[workflow_uuid]
+        file_path = metaObj["file_path"]
+        file_size = os.path.getsize(file_path)
+        file_sha = checksumCache.sha1sum(file_path)
+        reference = None
+        if dedupReferences:
+            reference = contentIndex.setdefault((file_size, file_sha), {
+                "bundle_uuid": workflow_uuid,
+                "file_path": os.path.basename(file_path)})
+            if reference["bundle_uuid"] == workflow_uuid:
+                reference = None
+            else:
+                uploadBytesSaved += file_size
+        bundle.workflow_outputs.append(BundleFile(
+            metaObj["file_type"], file_path, file_size, file_sha, reference,
+            stats=checksumCache.getStats(file_path)))
+
+    logging.info("skipped hashing %s of repeated files"
+                 % formatBytes(checksumCache.bytesSaved))
+    if dedupReferences:
+        logging.info("skipped uploading %s of repeated files"
+                     % formatBytes(uploadBytesSaved))
+    return commonObjMap
+
+
+def loadPreviousBundles(previousOutputDir, receiptFileName):
+    """
+    Read the receipt and bundle metadata.json files of a previous upload.
+    Returns a map of (sample_uuid, workflow_name) to the latest uploaded
+    version of that bundle: {"bundle_uuid", "workflow_version", "files"},
+    where files maps file names to (file_size, file_sha, file_uuid).
+    """
+    previousBundles = {}
+    receiptPath = os.path.join(previousOutputDir, receiptFileName)
+    for row in readTsv(readFileLines(receiptPath)):
+        key = (row["sample_uuid"], row["workflow_name"])
+        previous = previousBundles.get(key)
+        if previous is not None and \
+                previous["bundle_uuid"] != row["bundle_uuid"]:
+            if semver.compare(previous["workflow_version"],
+                              row["workflow_version"]) >= 0:
+                continue
+            previous = None
+        if previous is None:
+            previous = {"bundle_uuid": row["bundle_uuid"],
+                        "workflow_version": row["workflow_version"],
+                        "files": {}}
+            previousBundles[key] = previous
+        previous["files"][os.path.basename(row["file_path"])] = \
+            [None, None, row["file_uuid"]]
+
+    # the digests are only recorded in the bundle metadata
+    index = None
+    if export.hasExport(previousOutputDir):
+        index = export.readIndex(previousOutputDir)
+    for previous in previousBundles.values():
+        if index is not None:
+            obj = export.loadBundle(previousOutputDir,
+                                    previous["bundle_uuid"], index)
         else:
-            workflowObj = {}
-            commonObjMap[workflow_uuid] = workflowObj
-            workflowObj["program"] = metaObj["program"]
-            workflowObj["project"] = metaObj["project"]
-            workflowObj["center_name"] = metaObj["center_name"]
-            workflowObj["submitter_donor_id"] = metaObj["submitter_donor_id"]
-            workflowObj["donor_uuid"] = metaObj["donor_uuid"]
-            # ADDING THE PRIMARY SITE; Since it is optional, if it isn't
-            # present, it will be empty
-            workflowObj["submitter_donor_primary_site"] = getValueFromObject(
-                metaObj, "submitter_donor_primary_site"
-            )
-            # ^ metaObj["submitter_donor_primary_site"]
-            workflowObj["timestamp"] = getNow().isoformat()
-            workflowObj["schema_version"] = schema_version
-
-            workflowObj["specimen"] = []
-
-            # add specimen
-            specObj = {}
-            workflowObj["specimen"].append(specObj)
-            specObj["submitter_specimen_id"] = metaObj["submitter_specimen_id"]
-            specObj["submitter_specimen_type"] = metaObj[
-                "submitter_specimen_type"
-            ]
-            specObj["submitter_experimental_design"] = metaObj[
-                "submitter_experimental_design"
-            ]
-            specObj["specimen_uuid"] = metaObj["specimen_uuid"]
-            specObj["samples"] = []
-
-            # add sample
-            sampleObj = {}
-            specObj["samples"].append(sampleObj)
-            sampleObj["submitter_sample_id"] = metaObj["submitter_sample_id"]
-            sampleObj["sample_uuid"] = metaObj["sample_uuid"]
-            sampleObj["analysis"] = []
-
-            # add workflow
-            workFlowObj = {}
-            sampleObj["analysis"].append(workFlowObj)
-            workFlowObj["workflow_name"] = metaObj["workflow_name"]
-            workFlowObj["workflow_version"] = metaObj["workflow_version"]
-            workFlowObj["analysis_type"] = metaObj["analysis_type"]
-            workFlowObj["workflow_outputs"] = []
-            workFlowObj["bundle_uuid"] = metaObj["workflow_uuid"]
-
-        # retrieve workflow
-        workflowObj = commonObjMap[workflow_uuid]
-        # analysis_type = metaObj["analysis_type"]
-        wf_outputsObj = workflowObj["specimen"][0]["samples"][0][
-            "analysis"][0]["workflow_outputs"]
-
-        # add file info
-        fileInfoObj = {}
-        wf_outputsObj.append(fileInfoObj)
-        fileInfoObj["file_type"] = metaObj["file_type"]
-        fileInfoObj["file_path"] = metaObj["file_path"]
-        fileInfoObj["file_size"] = os.path.getsize(metaObj["file_path"])
-        fileInfoObj["file_sha"] = sha1sum(metaObj["file_path"])
+            metadataPath = os.path.join(previousOutputDir,
+                                        previous["bundle_uuid"],
+                                        "metadata.json")
+            obj = loadJsonObj(metadataPath) \
+                if os.path.isfile(metadataPath) else None
+        if obj is None:
+            logging.warn("no metadata.json for previous bundle %s"
+                         % previous["bundle_uuid"])
+            continue
+        bundle = Bundle.from_dict(obj)
+        for output in bundle.workflow_outputs:
+            fileInfo = previous["files"].get(
+                os.path.basename(output.file_path))
+            if fileInfo is not None:
+                fileInfo[0] = output.file_size
+                fileInfo[1] = output.file_sha
+    return previousBundles
 
-    return commonObjMap
+
+def applyPreviousBundles(structuredMetaDataObjMap, previousBundles):
+    """
+    Make the files that are unchanged since the previous version of a bundle
+    reference the already uploaded file instead of being uploaded again.
+    Returns the number of bytes that don't need to be uploaded.
+    """
+    bytesSaved = 0
+    for bundle in structuredMetaDataObjMap.values():
+        previous = previousBundles.get((bundle.sample_uuid,
+                                        bundle.workflow_name))
+        if previous is None or previous["bundle_uuid"] == bundle.bundle_uuid:
+            continue
+        for output in bundle.workflow_outputs:
+            fileName = os.path.basename(output.file_path)
+            fileInfo = previous["files"].get(fileName)
+            if output.reference is not None or fileInfo is None:
+                continue
+            file_size, file_sha, file_uuid = fileInfo
+            if file_sha is None or file_sha != output.file_sha or \
+                    file_size != output.file_size:
+                continue
+            output.reference = {"bundle_uuid": previous["bundle_uuid"],
+                                "file_path": fileName}
+            output.file_uuid = file_uuid
+            bytesSaved += output.file_size
+    return bytesSaved
 
 
 def writeJson(directory, fileName, jsonObj):
     """
     Dump a json object to the specified directory/fileName. Creates directory
-    if necessary.
+    if necessary. The object is written to a temp file which is fsync'd and
+    renamed, so the file is either complete or not there.
     NOTE: will clobber the existing file
     """
     success = None
+    tmpPath = None
     try:
         mkdir_p(directory)
         filePath = os.path.join(directory, fileName)
-        file = open(filePath, 'w')
-        json.dump(jsonObj, file, indent=4, separators=(',', ': '),
-                  sort_keys=True)
+        fd, tmpPath = tempfile.mkstemp(prefix="." + fileName, dir=directory)
+        with os.fdopen(fd, 'w') as file:
+            json.dump(jsonObj, file, indent=4, separators=(',', ': '),
+                      sort_keys=True)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmpPath, 0644)
+        os.rename(tmpPath, filePath)
         success = 1
     except:
         logging.error("Error writing %s/%s" % (directory, fileName))
+        if tmpPath is not None and os.path.exists(tmpPath):
+            os.unlink(tmpPath)
         success = 0
-    finally:
-        file.close()
     return success
 
 
-def writeDataBundleDirs(structuredMetaDataObjMap, outputDir):
+def writeDataBundleDirs(structuredMetaDataObjMap, outputDir,
+                        linkStrategy="symlink", checksumCache=None):
     """
     For each structuredMetaDataObj, prepare a data bundle dir for the workflow.
     Assumes one data bundle per structuredMetaDataObj. That means 1 specimen,
     1 sample, 1 analysis.
+    Each bundle is staged in a hidden dir that is renamed into place once the
+    files are linked and metadata.json is written, so an interrupted run
+    leaves no partial bundle dirs behind. Stale staging dirs are removed.
+    Files downloaded by fetchRemoteFiles() are hard linked into the bundle
+    dirs and the downloads dir is removed once all bundles are written.
     """
     numFilesWritten = 0
+    numFallbacks = 0
+    cwd = os.getcwd()
+    mkdir_p(outputDir)
+    downloadDir = os.path.join(os.path.realpath(outputDir), DOWNLOAD_DIR)
+    for name in os.listdir(outputDir):
+        if name.startswith(STAGING_PREFIX):
+            shutil.rmtree(os.path.join(outputDir, name))
+
     for workflow_uuid in structuredMetaDataObjMap.keys():
         metaObj = structuredMetaDataObjMap[workflow_uuid]
 
         # get outputDir (bundle_uuid)
         bundlePath = os.path.join(outputDir, workflow_uuid)
+        stagingPath = os.path.join(outputDir, STAGING_PREFIX + workflow_uuid)
+        os.mkdir(stagingPath)
 
         # link data file(s)
-        workflow_outputs = metaObj["specimen"][0]["samples"][0][
-            "analysis"][0]["workflow_outputs"]
-        for outputObj in workflow_outputs:
-            file_path = outputObj["file_path"]
+        for outputObj in metaObj.workflow_outputs:
+            file_path = outputObj.file_path
             # so I'm editing the file path here since directory
             # structures are stripped out upon upload
             file_name_array = file_path.split("/")
-            outputObj["file_path"] = file_name_array[-1]
-            fullFilePath = os.path.join(os.getcwd(), file_path)
+            outputObj.file_path = file_name_array[-1]
+            if outputObj.reference is not None:
+                # uploaded with the referenced bundle
+                continue
+            fullFilePath = os.path.join(cwd, file_path)
             filename = os.path.basename(file_path)
-            linkPath = os.path.join(bundlePath, filename)
-            mkdir_p(bundlePath)
-            ln_s(fullFilePath, linkPath)
+            linkPath = os.path.join(stagingPath, filename)
+            if os.path.lexists(linkPath):
+                # let ln_s report the name collision
+                ln_s(fullFilePath, linkPath)
+                continue
+            if os.path.realpath(fullFilePath).startswith(
+                    downloadDir + os.sep):
+                # on the same file system, so no copy is made
+                linkFile(fullFilePath, linkPath, "hardlink")
+            elif linkFile(fullFilePath, linkPath, linkStrategy) != \
+                    linkStrategy:
+                numFallbacks += 1
+            elif linkStrategy == "reflink" and checksumCache is not None:
+                checksumCache.alias(fullFilePath, linkPath)
 
         # write metadata
-        numFilesWritten += writeJson(bundlePath, "metadata.json", metaObj)
-
+        success = writeJson(stagingPath, "metadata.json", metaObj.to_dict())
+        numFilesWritten += success
+        if success:
+            os.rename(stagingPath, bundlePath)
+
+    if numFallbacks:
+        logging.warn("%s files were symlinked because %s is not supported "
+                     "for them" % (numFallbacks, linkStrategy))
+    if numFilesWritten == len(structuredMetaDataObjMap) and \
+            os.path.isdir(downloadDir):
+        shutil.rmtree(downloadDir)
     return numFilesWritten
 
 
-def setupLogging(logfileName, logFormat, logLevel, logToConsole=True):
+def setupLogging(logfileName, logFormat, logLevel, logToConsole=True,
+                 rateLimit=10):
     """
-    Setup simultaneous logging to file and console.
+    Setup simultaneous logging to file and console, written by the
+    logqueue background thread. Every message type is logged at most
+    rateLimit times a minute (0 for no limit); everything, including the
+    full row dumps, goes to the compressed <logfile>.debug.gz.
     """
     # logFormat = "%(asctime)s %(levelname)s %(funcName)s:%(lineno)d
     # %(message)s"
-    logging.basicConfig(filename=logfileName, level=logging.NOTSET,
-                        format=logFormat)
+    formatter = logging.Formatter(logFormat)
+    handlers = [logging.FileHandler(logfileName)]
     if logToConsole:
         console = logging.StreamHandler()
         console.setLevel(logLevel)
-        formatter = logging.Formatter(logFormat)
-        console.setFormatter(formatter)
-        logging.getLogger('').addHandler(console)
+        handlers.append(console)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    logging.getLogger('').setLevel(logging.NOTSET)
+    logqueue.start(handlers, os.path.splitext(logfileName)[0] + ".debug.gz",
+                   logFormat, burst=rateLimit)
     return None
 
 
 def add_to_registration(registration, bundle_id, project, file_path,
-                        controlled_access):
+                        controlled_access, checksumCache=None, events=None):
     access = 'controlled' if controlled_access else 'open'
+    file_md5 = checksumCache.md5sum(file_path, events) \
+        if checksumCache is not None else md5sum(file_path)
     registration.write('{}\t{}\t{}\t{}\t{}\n'.format(
-        bundle_id, project, file_path, md5sum(file_path), access))
+        bundle_id, project, file_path, file_md5, access))
 
 
 def register_upload(manifest, outdir):
@@ -570,7 +1991,7 @@ def register_upload(manifest, outdir):
     return success
 
 
-def perform_upload(manifest, force):
+def perform_upload(manifest, force, events=None):
     success = True
     f = '--force' if force else ''
     command = "icgc-storage-client upload --manifest {} {}".format(manifest, f)
@@ -583,12 +2004,15 @@ def perform_upload(manifest, force):
     fcntl(process.stderr, F_SETFL, flags | os.O_NONBLOCK)
     while process.poll() is None:
         try:
+            select.select([process.stderr], [], [], 1.0)
             process_msg = os.read(process.stderr.fileno(), 1024)
             if 'ERROR' in process_msg:
                 logging.error(process_msg)
             elif process_msg.strip():
                 sys.stdout.write(process_msg)
                 sys.stdout.flush()
+                if events is not None:
+                    emitUploadProgress(events, manifest, process_msg)
         except:
             continue
     results = process.communicate()
@@ -606,6 +2030,81 @@ def perform_upload(manifest, force):
         return success
 
 
+UPLOAD_CHUNK_BYTES = 1024 * 1024 * 1024
+
+
+def splitUploadManifest(manifest, chunkBytes=UPLOAD_CHUNK_BYTES):
+    """
+    Split an icgc-storage-client upload manifest into manifests of about
+    chunkBytes each, written next to it. Returns [(path, bytes)].
+    """
+    fileLines = readFileLines(manifest)
+    header = [line for line in fileLines
+              if line.split() and line.split()[0] == "object-id"]
+    chunks = []
+    for line in fileLines:
+        fields = line.split()
+        if not fields or fields[0] == "object-id":
+            continue
+        size = os.path.getsize(fields[1])
+        if not chunks or chunks[-1][1] >= chunkBytes:
+            chunks.append([[], 0])
+        chunks[-1][0].append(line)
+        chunks[-1][1] += size
+    chunkManifests = []
+    for i, (lines, size) in enumerate(chunks):
+        chunkManifest = "{}.part-{}".format(manifest, i + 1)
+        with open(chunkManifest, "w") as chunkFile:
+            chunkFile.write("\n".join(header + lines) + "\n")
+        chunkManifests.append((chunkManifest, size))
+    return chunkManifests
+
+
+def perform_uploads(manifest, force, events=None, controller=None,
+                    limiter=None):
+    """
+    Upload the files of manifest. With a controller allowing more than one
+    worker, or a limiter, the manifest is split into chunks that are
+    uploaded by as many icgc-storage-client processes as the controller
+    allows, each chunk starting only once the limiter lets its bytes
+    through.
+    """
+    if limiter is None and (controller is None or
+                            controller.maxWorkers == 1):
+        return perform_upload(manifest, force, events)
+    chunkManifests = splitUploadManifest(manifest)
+    if controller is None:
+        controller = adaptive.AdaptiveController("upload", maxWorkers=1)
+
+    def uploadChunk(chunk):
+        chunkManifest, size = chunk
+        if limiter is not None:
+            limiter.consume(size)
+        start = time.time()
+        success = perform_upload(chunkManifest, force, events)
+        controller.record(size, time.time() - start)
+        return success
+
+    logging.info("uploading %s in %s chunks with up to %s processes"
+                 % (manifest, len(chunkManifests), controller.maxWorkers))
+    return all(adaptive.mapAdaptive(uploadChunk, chunkManifests, controller))
+
+
+UPLOAD_PERCENT_RE = re.compile(r"(\d{1,3}(?:\.\d+)?)\s*%")
+
+
+def emitUploadProgress(events, manifest, process_msg):
+    """
+    Turn the last percentage printed by icgc-storage-client into an upload
+    progress event.
+    """
+    percents = UPLOAD_PERCENT_RE.findall(process_msg)
+    if percents:
+        events.progress("upload", manifest, min(float(percents[-1]), 100.0),
+                        100.0)
+    return None
+
+
 def writeJarExceptionsToLog(errorOutput):
     """
     Output the 'ERROR' lines in the jar error output.
@@ -619,114 +2118,87 @@ def writeJarExceptionsToLog(errorOutput):
 
 def parseUploadManifestFile(manifestFilePath):
     """
-    from the upload manifest file, get the file_uuid for each uploaded file
+    from the upload manifest file, get the file_uuid for each uploaded file.
+    Returns a map of (bundle_uuid, file name) to object id; the uploaded
+    files are in <output dir>/<bundle_uuid>/.
     """
     idMapping = {}
     fileLines = readFileLines(manifestFilePath)
     for line in fileLines:
         fields = line.split()
-        if fields[0] != "object-id":
-            file_name = os.path.basename(fields[1])
+        if fields and fields[0] != "object-id":
+            bundleDir, file_name = os.path.split(fields[1])
             object_id = fields[0]
-            idMapping[file_name] = object_id
+            idMapping[(os.path.basename(bundleDir), file_name)] = object_id
     return idMapping
 
 
-def collectReceiptData(manifestData, metadataObj):
+def collectReceiptData(manifestData, bundle):
     """
-    collect the data for the upload receipt file The required fields are:
+    Yield the upload receipt lines for a Bundle, with the object ids from
+    the upload manifest data. The required fields are:
     program project center_name submitter_donor_id donor_uuid
     submitter_specimen_id specimen_uuid submitter_specimen_type
     submitter_sample_id sample_uuid analysis_type workflow_name
     workflow_version file_type file_path file_uuid bundle_uuid metadata_uuid
     """
-    collectedData = []
-
-    commonData = {}
-    commonData["program"] = metadataObj["program"]
-    commonData["project"] = metadataObj["project"]
-    commonData["center_name"] = metadataObj["center_name"]
-    commonData["submitter_donor_id"] = metadataObj["submitter_donor_id"]
-    commonData["donor_uuid"] = metadataObj["donor_uuid"]
-    # ADDING PRIMARY SITE
-    commonData["submitter_donor_primary_site"] = getValueFromObject(
-        metadataObj, "submitter_donor_primary_site")
-    # ^ metadataObj["submitter_donor_primary_site"]
-
-    commonData["submitter_specimen_id"] = \
-        metadataObj["specimen"][0]["submitter_specimen_id"]
-    commonData["specimen_uuid"] = metadataObj["specimen"][0]["specimen_uuid"]
-    commonData["submitter_specimen_type"] = \
-        metadataObj["specimen"][0]["submitter_specimen_type"]
-    commonData["submitter_experimental_design"] = \
-        metadataObj["specimen"][0]["submitter_experimental_design"]
-
-    commonData["submitter_sample_id"] = \
-        metadataObj["specimen"][0]["samples"][0]["submitter_sample_id"]
-    commonData["sample_uuid"] = \
-        metadataObj["specimen"][0]["samples"][0]["sample_uuid"]
-
-    commonData["analysis_type"] = metadataObj["specimen"][0][
-        "samples"][0]["analysis"][0]["analysis_type"]
-    commonData["workflow_name"] = metadataObj["specimen"][0][
-        "samples"][0]["analysis"][0]["workflow_name"]
-    commonData["workflow_version"] = metadataObj["specimen"][0][
-        "samples"][0]["analysis"][0]["workflow_version"]
-    commonData["bundle_uuid"] = \
-        metadataObj["specimen"][0]["samples"][0]["analysis"][0]["bundle_uuid"]
-    commonData["metadata_uuid"] = manifestData["metadata.json"]
-
-    workflow_outputs = metadataObj["specimen"][0][
-        "samples"][0]["analysis"][0]["workflow_outputs"]
-    for output in workflow_outputs:
-        data = copy.deepcopy(commonData)
-        data["file_type"] = output["file_type"]
-        data["file_path"] = output["file_path"]
-
-        fileName = os.path.basename(output["file_path"])
-        data["file_uuid"] = manifestData[fileName]
-
-        collectedData.append(data)
-
-    return collectedData
-
-
-def writeReceipt(collectedReceipts, receiptFileName, d="\t"):
+    metadata_uuid = getUploadedObjectId(manifestData, bundle.bundle_uuid,
+                                        "metadata.json")
+    for output in bundle.workflow_outputs:
+        if output.file_uuid is not None:
+            file_uuid = output.file_uuid
+        elif output.reference is not None:
+            file_uuid = getUploadedObjectId(
+                manifestData, output.reference["bundle_uuid"],
+                os.path.basename(output.reference["file_path"]))
+        else:
+            file_uuid = getUploadedObjectId(
+                manifestData, bundle.bundle_uuid,
+                os.path.basename(output.file_path))
+        yield ReceiptLine(bundle, output, file_uuid, metadata_uuid)
+
+
+def getUploadedObjectId(manifestData, bundle_uuid, fileName):
+    try:
+        return manifestData[(bundle_uuid, fileName)]
+    except KeyError:
+        raise SubmissionError("%s of bundle %s is not in the upload manifest"
+                              % (fileName, bundle_uuid))
+
+
+def writeReceipt(receiptLines, receiptFileName, d="\t"):
     '''
-    write an upload receipt file
+    write an upload receipt file, one line at a time from the iterable
+    receiptLines. Returns the number of lines written.
     '''
+    numLines = 0
     with open(receiptFileName, 'w') as receiptFile:
-        fieldnames = [
-            "program", "project", "center_name", "submitter_donor_id",
-            "donor_uuid", "submitter_donor_primary_site",
-            "submitter_specimen_id", "specimen_uuid",
-            "submitter_specimen_type", "submitter_experimental_design",
-            "submitter_sample_id", "sample_uuid", "analysis_type",
-            "workflow_name", "workflow_version", "file_type", "file_path",
-            "file_uuid", "bundle_uuid", "metadata_uuid"]
-        writer = csv.DictWriter(receiptFile, fieldnames=fieldnames,
-                                delimiter=d)
-
-        writer.writeheader()
-        writer.writerows(collectedReceipts)
-    return None
+        writer = csv.writer(receiptFile, delimiter=d, lineterminator="\r\n")
+        writer.writerow(ReceiptLine.FIELDS)
+        for receiptLine in receiptLines:
+            writer.writerow(receiptLine.values())
+            numLines += 1
+    return numLines
 
 
-def validateMetadataObjs(metadataObjs, jsonSchemaFile):
+def validateMetadataObjs(metadataObjs, jsonSchemaFile, validator=None):
     '''
     validate metadata objects
     '''
-    schema = loadJsonSchema(jsonSchemaFile)
+    schema = validator or loadJsonSchema(jsonSchemaFile)
     valid = []
     invalid = []
+    errors = []
     for metadataObj in metadataObjs:
-        isValid = validateObjAgainstJsonSchema(metadataObj, schema)
-        if isValid:
+        exc = getValidationError(metadataObj, schema)
+        if exc is None:
             valid.append(metadataObj)
         else:
             invalid.append(metadataObj)
+            errors.append(getattr(exc, "message", str(exc)))
 
-    obj = {"valid": valid, "invalid": invalid}
+    # errors[i] is why invalid[i] failed
+    obj = {"valid": valid, "invalid": invalid, "errors": errors}
     return obj
 
 
@@ -844,121 +2316,650 @@ def mergeDonors(metadataObjs):
     return donorMapping
 
 
-def change_dict_list_to_table_str(dict_list, columns_fields, margin_size=2):
+def mergeTsvFiles(inputFiles, outputFile, keyField=None,
+                  lineterminator="\n"):
+    """
+    Concatenate TSV files that share a header into outputFile. If keyField is
+    given, a value of that column may only come from one input file.
+    Returns False on a header mismatch or key collision.
+    """
+    header = None
+    keySources = {}
+    with open(outputFile, 'w') as out:
+        for inputFile in inputFiles:
+            lines = readFileLines(inputFile)
+            if len(lines) == 0:
+                continue
+            if header is None:
+                header = lines[0]
+                out.write(header + lineterminator)
+            elif lines[0] != header:
+                logging.error("header of {} does not match {}".format(
+                    inputFile, inputFiles[0]))
+                return False
+            keyIdx = header.split("\t").index(keyField) \
+                if keyField is not None else None
+            for line in lines[1:]:
+                if not line:
+                    continue
+                if keyIdx is not None:
+                    key = line.split("\t")[keyIdx]
+                    source = keySources.setdefault(key, inputFile)
+                    if source != inputFile:
+                        logging.error("{} {} found in both {} and {}".format(
+                            keyField, key, source, inputFile))
+                        return False
+                out.write(line + lineterminator)
+    return True
+
+
+def mergePartitions(partitionDirs, options):
     """
-        turns a list of dictionaries, into a string that can printed as a readable table
+    Merge the receipt and registration files of --partition runs into
+    options.metadataOutDir and submit the merged receipt.
     """
+    receipts = []
+    registrations = []
+    for partitionDir in partitionDirs:
+        receipt = os.path.join(partitionDir, options.receiptFile)
+        if not os.path.isfile(receipt):
+            logging.error("no receipt found in {}".format(partitionDir))
+            return False
+        receipts.append(receipt)
+        registration = os.path.join(partitionDir,
+                                    options.redwood_registration_file)
+        if os.path.isfile(registration):
+            registrations.append(registration)
 
-    # Creates a list of the largest string's lengths + the margin size of each column in the table
-    largest_sizes = [max([len(ud_values[cf]) for ud_values in dict_list]) + margin_size for cf in columns_fields]
+    receipt_file = os.path.join(options.metadataOutDir, options.receiptFile)
+    if not mergeTsvFiles(receipts, receipt_file, keyField="bundle_uuid",
+                         lineterminator="\r\n"):
+        return False
+    logging.info("merged {} receipts into {}".format(len(receipts),
+                                                     receipt_file))
+    if registrations:
+        registration_file = os.path.join(options.metadataOutDir,
+                                         options.redwood_registration_file)
+        if not mergeTsvFiles(registrations, registration_file):
+            return False
+        logging.info("merged {} registration manifests into {}".format(
+            len(registrations), registration_file))
 
-    # Creates a string format pattern based on the largest sizes, so the columns are spaced neatly
-    format_pattern = " ".join(["{:" + str(s) + "s}" for s in largest_sizes])
+    if not options.skip_submit:
+        submission_id = createSubmission(options.submissionServerUrl)
+        submitReceipt(options.submissionServerUrl, submission_id,
+                      receipt_file)
+    return True
 
-    # Creates the table string using the format pattern and the dict_list
-    table_str = "\n".join([format_pattern.format(*[row[field] for field in columns_fields]) for row in dict_list])
 
-    return table_str
+def createSubmission(submissionServerUrl, session=requests):
+    """
+    Create a new submission on the submission server and return its id.
+    """
+    r = session.post(submissionServerUrl + "/v0/submissions", json={})
+    submission_id = json.loads(r.text)["submission"]["id"]
+    logging.info("You can monitor the upload at {}/v0/submissions/{}"
+                 .format(submissionServerUrl, submission_id))
+    return submission_id
 
 
-def main():
-    startTime = getNow()
-    (options, args, parser) = getOptions()
-    redwood_upload_manifest_dir = "redwoodUploadManifest"
+def submitReceipt(submissionServerUrl, submission_id, receipt_file,
+                  session=requests):
+    """
+    Send the receipt to the submission server.
+    """
+    with open(receipt_file) as f:
+        session.put(submissionServerUrl
+                     + "/v0/submissions/{}".format(submission_id),
+                     json={"receipt": f.read()})
+    logging.info("You can view the receipt at {}/v0/submissions/{}"
+                 .format(submissionServerUrl, submission_id))
+    return None
 
-    if len(args) == 0:
-        logging.error("no input files")
-        sys.exit(1)
 
-    for dirName, subdirList, fileList in os.walk(options.metadataOutDir):
-        if 'metadata.json' in fileList:
-            logging.error("bundles from previous upload found in {}. Please"
-                          " use a fresh directory".format(
-                              options.metadataOutDir))
-            sys.exit(1)
+class ExistingBundleRow(object):
+    """
+    Report row for an input row whose bundle is already in the storage
+    system: the row's fields plus its source.
+    """
 
-    if options.verbose:
-        logLevel = logging.DEBUG
-    else:
-        logLevel = logging.INFO
-    logfileName = os.path.basename(__file__).replace(".py", ".log")
+    def __init__(self, row):
+        self.row = row
+
+    def __getitem__(self, key):
+        if key == "source":
+            return self.row.source
+        return self.row[key]
+
+
+CORRUPT_FILE_COLUMNS = ["source", "file_path", "error"]
+
+
+def checkFileContents(flatMetadataObjs, checksumCache, options):
+    """
+    Raise SubmissionError with a table of the rows whose file failed the
+    --verify-content check.
+    """
+    corruptFiles = report.ReportTable(
+        "corrupt_files", CORRUPT_FILE_COLUMNS, options.metadataOutDir,
+        options.report_rows)
+    with corruptFiles:
+        for metaObj in flatMetadataObjs:
+            stats = checksumCache.getStats(metaObj["file_path"])
+            if stats is not None and "error" in stats:
+                corruptFiles.add({"source": metaObj.source,
+                                  "file_path": metaObj["file_path"],
+                                  "error": stats["error"]})
+    if corruptFiles.numRows:
+        raise SubmissionError("\n{} file(s) are truncated or corrupt."
+                              "\nNO DATA WAS UPLOADED.\n\n{}\n".format(
+                                  corruptFiles.numRows, corruptFiles.format()))
+    return None
+
+
+INVALID_BUNDLE_COLUMNS = ["bundle_uuid", "program", "project",
+                          "submitter_donor_id", "submitter_sample_id",
+                          "workflow_name", "workflow_version", "error"]
+
+
+class InvalidBundleRow(object):
+    """
+    Report row for a Bundle that failed metadata validation.
+    """
+
+    def __init__(self, bundle, error):
+        self.bundle = bundle
+        self.error = error
+
+    def __getitem__(self, key):
+        if key == "error":
+            return self.error
+        return getattr(self.bundle, key)
+
+
+def openEventStream(options):
+    """
+    Build the EventStream requested by the --events option, shared by all
+    submissions. --push-events sinks are added per submission, see
+    processManifests().
+    """
+    sinks = []
+    if options.events is not None:
+        sinks.append(events_module.openSink(options.events))
+    return events_module.EventStream(sinks, options.events_interval)
+
+
+def getSubmissionContext(options, progress=True):
+    """
+    Build the SubmissionContext for the worker and rate options.
+    """
+    megabyte = 1024 * 1024
+    return SubmissionContext(
+        progress, openEventStream(options),
+        options.max_hash_workers, options.max_upload_workers,
+        options.max_read_rate * megabyte if options.max_read_rate else None,
+        options.max_upload_rate * megabyte
+        if options.max_upload_rate else None,
+        options.hash_backend, options.verify_content)
+
+
+def watchSpool(options):
+    """
+    Daemon mode: process every manifest dropped into the options.watch spool
+    dir with one warm SubmissionContext, each into its own dir below
+    options.metadataOutDir.
+    """
     mkdir_p(options.metadataOutDir)
-    logFilePath = os.path.join(options.metadataOutDir, logfileName)
-    logFormat = "%(asctime)s %(levelname)s %(funcName)s:%(lineno)d %(message)s"
-    setupLogging(logFilePath, logFormat, logLevel)
+    logFormat = "%(asctime)s %(levelname)s %(threadName)s " \
+        "%(funcName)s:%(lineno)d %(message)s"
+    setupLogging(os.path.join(options.metadataOutDir, "spinnaker-watch.log"),
+                 logFormat, logging.DEBUG if options.verbose else logging.INFO,
+                 rateLimit=options.log_rate_limit)
+
+    # tqdm progress bars can't be shared between manifest threads
+    context = getSubmissionContext(options, progress=False)
+
+    def processManifest(manifestPath, outputDir):
+        manifestOptions = copy.copy(options)
+        manifestOptions.metadataOutDir = outputDir
+        processManifests(manifestOptions, [manifestPath], context,
+                         os.path.join(outputDir, "spinnaker.log"))
+
+    watcher = watch.SpoolWatcher(options.watch, options.metadataOutDir,
+                                 processManifest,
+                                 concurrency=options.watch_concurrency,
+                                 pollInterval=options.watch_interval,
+                                 logFormat=logFormat)
+    try:
+        watcher.run()
+    finally:
+        context.events.close()
+    return None
 
-    # !!! careful not to expose the access token !!!
-    printOptions = copy.deepcopy(vars(options))
-    logging.debug('options:\t%s' % (str(printOptions)))
-    logging.debug('args:\t%s' % (str(args)))
 
-    # load flattened metadata schema for input validation
-    inputMetadataSchema = loadJsonSchema(options.inputMetadataSchemaFileName)
+class SubmissionError(Exception):
+    """
+    Raised when a submission has to be stopped. The message has already
+    been worded for the user.
+    """
+    pass
+
+
+class SubmissionContext(object):
+    """
+    State that can be reused across submissions in one process: parsed and
+    compiled schemas, a pooled HTTP session and the checksum cache.
+    """
+
+    def __init__(self, progress=True, events=None, maxHashWorkers=1,
+                 maxUploadWorkers=1, maxReadRate=None, maxUploadRate=None,
+                 hashBackend="readinto", verifyContent=False):
+        self.schemas = {}
+        self.validators = {}
+        self.session = requests.Session()
+        self.events = events if events is not None \
+            else events_module.EventStream()
+        # rates and worker limits are shared by all manifests of a --watch
+        # daemon, so the caps hold for the whole host
+        self.readLimiter = adaptive.RateLimiter(maxReadRate) \
+            if maxReadRate else None
+        self.uploadLimiter = adaptive.RateLimiter(maxUploadRate) \
+            if maxUploadRate else None
+        self.hashController = adaptive.AdaptiveController(
+            "hash", maxWorkers=maxHashWorkers, limiter=self.readLimiter)
+        self.uploadController = adaptive.AdaptiveController(
+            "upload", maxWorkers=maxUploadWorkers, window=30.0,
+            limiter=self.uploadLimiter)
+        self.checksumCache = ChecksumCache(progress, self.events,
+                                           self.hashController,
+                                           self.readLimiter, hashBackend,
+                                           verifyContent)
+        # the metadata api is accessed without certificate verification
+        requests.packages.urllib3.disable_warnings()
+
+    def getSchema(self, fileName):
+        if fileName not in self.schemas:
+            self.schemas[fileName] = loadJsonSchema(fileName)
+        return self.schemas[fileName]
+
+    def getValidator(self, fileName):
+        if fileName not in self.validators:
+            schema = self.getSchema(fileName)
+            cls = jsonschema.validators.validator_for(schema)
+            cls.check_schema(schema)
+            self.validators[fileName] = cls(schema)
+        return self.validators[fileName]
+
+
+class SubmissionResult(object):
+    """
+    Outcome of one submission: the Bundles by bundle uuid, the plan, the
+    receipt file and its number of lines, and the seconds spent in each
+    phase. error is set when a Submitter caught an error of the submission.
+    """
+
+    def __init__(self, manifests, outputDir, events=None):
+        self.manifests = list(manifests)
+        self.outputDir = outputDir
+        self.events = events
+        self.bundles = {}
+        self.plan = None
+        self.numInvalidRows = 0
+        self.submissionId = None
+        self.receiptFile = None
+        self.numReceiptLines = 0
+        self.error = None
+        # phase -> seconds
+        self.timings = {}
+        self.phaseName = None
+        self.phaseStart = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def phase(self, name, **fields):
+        """
+        Start phase name, ending the current one, and emit its event.
+        """
+        now = time.time()
+        if self.phaseName is not None:
+            self.timings[self.phaseName] = \
+                self.timings.get(self.phaseName, 0) + now - self.phaseStart
+        self.phaseName = name
+        self.phaseStart = now
+        if self.events is not None:
+            self.events.phase(name, **fields)
+        return None
+
+    def to_dict(self):
+        return {
+            "manifests": self.manifests, "output_dir": self.outputDir,
+            "ok": self.ok, "error": self.error,
+            "submission_id": self.submissionId,
+            "num_invalid_rows": self.numInvalidRows,
+            "bundles": sorted(self.bundles),
+            "receipt_file": self.receiptFile,
+            "num_receipt_lines": self.numReceiptLines,
+            "timings": self.timings}
 
-    flatMetadataObjs = []
 
-    # iter over input files
-    for fileName in args:
+def hasPreviousBundles(outputDir):
+    """
+    Whether outputDir already holds bundle dirs, other than partially
+    staged ones, or a bundle stream.
+    """
+    if export.hasExport(outputDir):
+        return True
+    for dirName, subdirList, fileList in os.walk(outputDir):
+        if 'metadata.json' in fileList and \
+                not os.path.basename(dirName).startswith(STAGING_PREFIX):
+            return True
+    return False
+
+
+class Submitter(object):
+    """
+    Run submissions in the calling process, for orchestrators that submit
+    many manifests. The SubmissionContext (compiled validators, HTTP
+    session, checksum cache, rate limits) is kept warm between
+    submissions.
+
+        submitter = Submitter(["--skip-upload", "-d", "/data/submissions"])
+        result = submitter.submit(["a.tsv", "b.tsv"])
+        results = submitter.submitMany([["c.tsv"], ["d.tsv"]], concurrency=2)
+
+    argv holds spinnaker.py command line options, overrides set option
+    attributes by dest. Every submission goes to a new dir below the output
+    dir, with its own spinnaker.log. Failed submissions are returned with
+    their error instead of raising. Otherwise, logging is left to the
+    caller.
+    """
+
+    def __init__(self, argv=(), progress=False, **overrides):
+        self.options = getOptions(list(argv))[0]
+        for key, value in overrides.items():
+            setattr(self.options, key, value)
+        self.context = getSubmissionContext(self.options, progress)
+
+    def getOutputDir(self, manifests):
+        name = os.path.splitext(os.path.basename(manifests[0]))[0]
+        stamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        return os.path.join(self.options.metadataOutDir,
+                            "{}-{}".format(name, stamp))
+
+    def submit(self, manifests, outputDir=None, **overrides):
+        """
+        Run one submission of the manifest files and return its
+        SubmissionResult. overrides change options for this submission only.
+        """
+        if isinstance(manifests, basestring):
+            manifests = [manifests]
+        options = copy.copy(self.options)
+        for key, value in overrides.items():
+            setattr(options, key, value)
+        if outputDir is None:
+            outputDir = self.getOutputDir(manifests)
+        options.metadataOutDir = outputDir
+        result = SubmissionResult(manifests, outputDir)
+        if hasPreviousBundles(outputDir):
+            result.error = "bundles from previous upload found in {}" \
+                .format(outputDir)
+            return result
+
+        mkdir_p(outputDir)
+        logFilePath = os.path.join(outputDir, "spinnaker.log")
+        handler = logging.FileHandler(logFilePath)
+        handler.addFilter(watch.ThreadFilter(threading.current_thread().name))
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(funcName)s:%(lineno)d %(message)s"))
+        logging.getLogger('').addHandler(handler)
         try:
-            # attempt to process as xls file
-            fileDataList = getDataDictFromXls(fileName)
-        except:
-            # attempt to process as tsv file
-            # logging.info("couldn't read %s as excel file" % fileName)
-            # logging.info("---now trying to read as tsv file")
-            fileLines = readFileLines(fileName)
-            reader = readTsv(fileLines)
-            fileDataList = processFieldNames(reader)
+            processManifests(options, manifests, self.context, logFilePath,
+                             result)
+        except SubmissionError as exc:
+            result.error = str(exc)
+        except Exception as exc:
+            # one broken submission must not lose the results of the others
+            logging.exception("submission of %s failed"
+                              % ", ".join(manifests))
+            result.error = "%s: %s" % (type(exc).__name__, exc)
+        finally:
+            logging.getLogger('').removeHandler(handler)
+            handler.close()
+        return result
+
+    def submitMany(self, batches, concurrency=1):
+        """
+        Run a submission for each list of manifest files in batches, up to
+        concurrency at a time. Returns their SubmissionResults in order.
+        """
+        batches = list(batches)
+        if concurrency <= 1 or len(batches) < 2:
+            return [self.submit(batch) for batch in batches]
+        pool = ThreadPool(min(concurrency, len(batches)))
+        try:
+            return pool.map(self.submit, batches)
+        finally:
+            pool.close()
+            pool.join()
 
-        for data in fileDataList:
-            metaObj = getDataObj(data, inputMetadataSchema)
+    def close(self):
+        self.context.events.close()
+        return None
 
-            if metaObj is None:
-                continue
+    def __enter__(self):
+        return self
 
-            flatMetadataObjs.append(metaObj)
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def processManifests(options, args, context=None, logFilePath=None,
+                     result=None):
+    """
+    Run the submission for the manifest files in args: build, validate and
+    write the bundles and, unless options.skip_upload, register and upload
+    them and write the receipt. Returns the SubmissionResult, filled into
+    result if given. Raises SubmissionError if the submission has to be
+    stopped, after emitting the "failed" phase.
+    The submission's events go to a child of the context's stream, stamped
+    with the manifests and, once created, the submission_id.
+    """
+    if context is None:
+        context = SubmissionContext()
+    events = context.events.child(manifests=list(args), submission_id=None)
+    if options.push_events and not options.skip_submit:
+        events.addSink(events_module.SubmissionPushSink(
+            options.submissionServerUrl))
+    if result is None:
+        result = SubmissionResult(args, options.metadataOutDir)
+    result.events = events
+    try:
+        return runSubmission(options, args, context, events, logFilePath,
+                             result)
+    except Exception as exc:
+        result.phase("failed", error=str(exc))
+        raise
+    finally:
+        events.close()
+
+
+def runSubmission(options, args, context, events, logFilePath, result):
+    """
+    The phases of processManifests().
+    """
+    startTime = getNow()
+    redwood_upload_manifest_dir = "redwoodUploadManifest"
+    result.phase("ingest", manifests=args)
 
-    redwood_host = os.environ['REDWOOD_ENDPOINT']
-    bundle_err_tbl_cols = ['program', 'project', 'center_name', 'submitter_donor_id',
+    # load flattened metadata schema for input validation
+    inputMetadataSchema = context.getSchema(
+        options.inputMetadataSchemaFileName)
+    inputMetadataValidator = context.getValidator(
+        options.inputMetadataSchemaFileName)
+
+    flatMetadataObjs = []
+    # (bundle uuid, file name) -> source of the first row with that file
+    bundleFiles = {}
+    # bundle uuid -> source of its first row, None once warned about
+    bundleSources = {}
+    invalidRows = report.ReportTable(
+        "invalid_rows", ["source", "error"], options.metadataOutDir,
+        options.report_rows)
+    duplicateRows = report.ReportTable(
+        "duplicate_rows", ["source", "bundle_uuid", "file_name",
+                           "first_source"],
+        options.metadataOutDir, options.report_rows)
+
+    # parse the input files in parallel, checking for duplicates on the way
+    for metaObj in readManifests(args, options.inputMetadataSchemaFileName,
+                                 inputMetadataSchema, inputMetadataValidator,
+                                 options.ingest_processes, invalidRows):
+        if fetch.getScheme(metaObj["file_path"]) == "file":
+            try:
+                metaObj["file_path"] = fetch.getLocalPath(
+                    metaObj["file_path"])
+            except fetch.FetchError as exc:
+                invalidRows.add({"source": metaObj.source,
+                                 "error": str(exc)})
+                continue
+        key = (metaObj["workflow_uuid"],
+               fetch.getFileName(metaObj["file_path"]))
+        if not key[1]:
+            invalidRows.add({"source": metaObj.source,
+                             "error": "%s has no file name"
+                             % metaObj["file_path"]})
+            continue
+        if key in bundleFiles:
+            duplicateRows.add({"source": metaObj.source,
+                               "bundle_uuid": key[0], "file_name": key[1],
+                               "first_source": bundleFiles[key]})
+            continue
+        bundleFiles[key] = metaObj.source
+        firstSource = bundleSources.setdefault(key[0], metaObj.source)
+        if firstSource is not None and firstSource.rsplit(":", 1)[0] != \
+                metaObj.source.rsplit(":", 1)[0]:
+            logging.warn("%s: bundle %s was started in %s"
+                         % (metaObj.source, key[0], firstSource))
+            # only warn once per bundle
+            bundleSources[key[0]] = None
+        flatMetadataObjs.append(metaObj)
+    invalidRows.close()
+    duplicateRows.close()
+    result.numInvalidRows = invalidRows.numRows
+    if invalidRows.numRows:
+        logging.error("%s invalid rows were skipped:\n%s"
+                      % (invalidRows.numRows, invalidRows.format()))
+    if duplicateRows.numRows:
+        raise SubmissionError("%s rows repeat a file of their bundle. NO DATA "
+                              "WAS UPLOADED.\n%s"
+                              % (duplicateRows.numRows,
+                                 duplicateRows.format()))
+
+    if options.partition is not None:
+        numRows = len(flatMetadataObjs)
+        flatMetadataObjs = filterPartition(flatMetadataObjs, options.partition)
+        logging.info("partition %s/%s: processing %s of %s rows"
+                     % (options.partition[0], options.partition[1],
+                        len(flatMetadataObjs), numRows))
+        if not options.skip_submit:
+            logging.info("partitioned run, leaving submission to "
+                         "--merge-partitions")
+            options.skip_submit = True
+
+    # pre-flight check of all input files before any hashing
+    result.phase("plan")
+    # without --skip-upload files are hashed twice (sha1 and md5)
+    plan = planUpload(flatMetadataObjs, options.plan_threads,
+                      None if options.skip_upload
+                      else min(options.plan_upload_rate,
+                               options.max_upload_rate or
+                               options.plan_upload_rate) * 1024 * 1024,
+                      1 if options.skip_upload else 2)
+    logPlan(plan)
+    events.emit("plan", num_files=plan["num_files"],
+                num_bundles=plan["num_bundles"],
+                total_bytes=plan["total_bytes"],
+                hash_seconds=plan["hash_seconds"],
+                upload_seconds=plan["upload_seconds"],
+                errors=[info["file_path"] for info in plan["errors"]])
+    if plan["errors"]:
+        raise SubmissionError("%s input files can't be read. NO DATA WAS "
+                              "UPLOADED." % len(plan["errors"]))
+    result.plan = plan
+    if options.plan_only:
+        return result
+
+    redwood_host = os.environ.get('REDWOOD_ENDPOINT')
+    if not redwood_host:
+        raise SubmissionError("REDWOOD_ENDPOINT is not set. NO DATA WAS "
+                              "UPLOADED.")
+    bundle_err_tbl_cols = ['source', 'program', 'project', 'center_name', 'submitter_donor_id',
                            'submitter_donor_primary_site', 'submitter_specimen_id', 'submitter_sample_id',
                            'workflow_name', 'workflow_version', 'file_path']
 
-    # Context hack for accessing the metadata api
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-
-    existing_bundles = []
+    result.phase("check_existing")
 
     # Checks if the bundle uuids generated from the manifest file are already in the storage system.
     # The bundle_ids are also called workflow uuids and gnos ids.
-    for fmo in flatMetadataObjs:
-        mtadta_dict_copy = fmo.copy()
-        metadata_url = "https://metadata.{}/entities?gnosId={}".format(redwood_host, mtadta_dict_copy['workflow_uuid'])
-        file_name_metadata_json = urlopen(metadata_url, context=ctx).read()
-        file_name_metadata = json.loads(file_name_metadata_json)
-        if file_name_metadata['totalElements'] > 0:
-            existing_bundles.append(fmo)
+    # Context hack for accessing the metadata api: no cert verification
+    metadataClient = metadata_client.MetadataClient(
+        options.metadata_url or "https://metadata.{}".format(redwood_host),
+        context.session, options.metadata_cache_dir or None,
+        options.metadata_cache_ttl, options.metadata_bulk_size, verify=False)
+    try:
+        existing_uuids = metadataClient.findExistingBundles(
+            [fmo['workflow_uuid'] for fmo in flatMetadataObjs])
+    except metadata_client.MetadataClientError as exc:
+        raise SubmissionError("can't check for existing bundles: %s" % exc)
+    existing_bundles = report.ReportTable(
+        "existing_bundles", bundle_err_tbl_cols, options.metadataOutDir,
+        options.report_rows)
+    with existing_bundles:
+        for fmo in flatMetadataObjs:
+            if fmo['workflow_uuid'] in existing_uuids:
+                existing_bundles.add(ExistingBundleRow(fmo))
 
     # If at least a single row contains a bundle_uuid/gnos_uuid/workflow_uuid exists in storage system, the duplicate
     # bundle id error is logged, a list of duplicate bundles is shown, and the whole upload process is stopped.
-    if existing_bundles:
-        table_str = change_dict_list_to_table_str(existing_bundles, bundle_err_tbl_cols)
-        logging.error("\nUpload was interrupted because the following row(s) contain data that already has been "
-                      "uploaded."
-                      "\nTo upload again, please find the row(s) that match(es) the data below and bump up the workflow"
-                      " version for the following row(s) and re-upload."
-                      "\nNO DATA WAS UPLOADED."
-                      "\n\nBundles already in System\n=========\n{}\n".format(table_str))
-        sys.exit(1)
+    if existing_bundles.numRows:
+        table_str = existing_bundles.format()
+        raise SubmissionError("\nUpload was interrupted because the following row(s) contain data that already has been "
+                              "uploaded."
+                              "\nTo upload again, please find the row(s) that match(es) the data below and bump up the workflow"
+                              " version for the following row(s) and re-upload."
+                              "\nNO DATA WAS UPLOADED."
+                              "\n\nBundles already in System\n=========\n{}\n".format(table_str))
+
+    # download http(s) File Paths, hashing them on the way
+    checksumCache = context.checksumCache
+    result.phase("fetch")
+    fetchRemoteFiles(flatMetadataObjs, checksumCache, options, events)
 
     # get structured workflow objects
-    structuredWorkflowObjMap = getWorkflowObjects(flatMetadataObjs)
+    result.phase("hash")
+    structuredWorkflowObjMap = getWorkflowObjects(
+        flatMetadataObjs, checksumCache, options.dedup_references, events)
+    result.bundles = structuredWorkflowObjMap
+    if checksumCache.verifyContent:
+        checkFileContents(flatMetadataObjs, checksumCache, options)
+
+    if options.previousOutputDir is not None:
+        previousBundles = loadPreviousBundles(options.previousOutputDir,
+                                              options.receiptFile)
+        bytesSaved = applyPreviousBundles(structuredWorkflowObjMap,
+                                          previousBundles)
+        logging.info("%s of unchanged files are referenced from previous "
+                     "bundle versions instead of uploaded"
+                     % formatBytes(bytesSaved))
 
     if options.test:
         # donorObjMapping = mergeDonors(structuredWorkflowObjMap.values())
         validationResults = validateMetadataObjs(
-            structuredWorkflowObjMap.values(), options.metadataSchemaFileName)
+            [b.to_dict() for b in structuredWorkflowObjMap.values()],
+            options.metadataSchemaFileName,
+            context.getValidator(options.metadataSchemaFileName))
         numInvalidResults = len(validationResults["invalid"])
         if numInvalidResults != 0:
             logging.error("%s invalid merged objects found:"
@@ -968,30 +2969,51 @@ def main():
 
     # validate metadata objects
     # exit script before upload
-    validationResults = validateMetadataObjs(structuredWorkflowObjMap.values(),
-                                             options.metadataSchemaFileName)
+    result.phase("validate")
+    validationResults = validateMetadataObjs(
+        [b.to_dict() for b in structuredWorkflowObjMap.values()],
+        options.metadataSchemaFileName,
+        context.getValidator(options.metadataSchemaFileName))
     numInvalidResults = len(validationResults["invalid"])
     if numInvalidResults != 0:
-        logging.error("%s invalid metadata objects found:"
-                      % (numInvalidResults))
-        for metaObj in validationResults["invalid"]:
-            logging.error("INVALID: %s" % (json.dumps(metaObj)))
-        sys.exit(1)
+        invalidBundles = report.ReportTable(
+            "invalid_bundles", INVALID_BUNDLE_COLUMNS, options.metadataOutDir,
+            options.report_rows)
+        with invalidBundles:
+            for metaObj, error in izip(validationResults["invalid"],
+                                       validationResults["errors"]):
+                logging.debug("INVALID: %s" % (json.dumps(metaObj)))
+                invalidBundles.add(InvalidBundleRow(Bundle.from_dict(metaObj),
+                                                    error))
+        logging.error("%s invalid metadata objects found:\n%s"
+                      % (numInvalidResults, invalidBundles.format()))
+        raise SubmissionError("metadata validation failed")
     else:
         logging.info("validated all metadata objects for output")
 
     # write metadata files and link data files
-    numFilesWritten = writeDataBundleDirs(
-        structuredWorkflowObjMap, options.metadataOutDir)
-    logging.info("number of metadata files written: %s"
-                 % (str(numFilesWritten)))
+    result.phase("stage")
+    if options.bundle_layout in ("stream", "both"):
+        # before the bundle dirs cut the file paths to the file name
+        numBundlesWritten = export.writeBundleStream(
+            structuredWorkflowObjMap, options.metadataOutDir)
+        logging.info("number of bundles written to %s: %s"
+                     % (export.STREAM_FILE, numBundlesWritten))
+    if options.bundle_layout in ("dirs", "both"):
+        numFilesWritten = writeDataBundleDirs(
+            structuredWorkflowObjMap, options.metadataOutDir,
+            options.link_strategy, checksumCache)
+        logging.info("number of metadata files written: %s"
+                     % (str(numFilesWritten)))
 
     if (options.skip_upload):
         logging.info("Skipping data upload steps.")
-        logging.info("A detailed log is at: %s" % (logFilePath))
+        if logFilePath is not None:
+            logging.info("A detailed log is at: %s" % (logFilePath))
         runTime = getTimeDelta(startTime).total_seconds()
         logging.info("Program ran for %s s." % str(runTime))
-        return None
+        result.phase("done", seconds=runTime)
+        return result
     else:
         logging.info("Uploading files.")
         logging.info("NOTE: If it hangs IP may be blocked")
@@ -1001,13 +3023,16 @@ def main():
     counts["bundlesFound"] = 0
 
     if not options.skip_submit:
-        r = requests.post(
-            options.submissionServerUrl + "/v0/submissions", json={})
-        submission_id = json.loads(r.text)["submission"]["id"]
-        logging.info("You can monitor the upload at {}/v0/submissions/{}"
-                     .format(options.submissionServerUrl, submission_id))
+        submission_id = createSubmission(options.submissionServerUrl,
+                                         context.session)
+        result.submissionId = submission_id
+        events.setField("submission_id", submission_id)
+        for sink in events.sinks:
+            if hasattr(sink, "setSubmission"):
+                sink.setSubmission(submission_id)
 
     # build redwood registration manifest
+    result.phase("register")
     redwood_registration_manifest = os.path.join(
         options.metadataOutDir, options.redwood_registration_file)
     redwood_upload_manifest = None
@@ -1040,7 +3065,8 @@ def main():
                 for f in files:
                     file = os.path.join(dir_name, f)
                     add_to_registration(registration, bundle_uuid, program,
-                                        file, controlled_access)
+                                        file, controlled_access,
+                                        checksumCache, events)
             else:
                 logging.info("no metadata file found in %s" % dir_name)
 
@@ -1051,50 +3077,94 @@ def main():
     reg_success = register_upload(redwood_registration_manifest,
                                   os.path.dirname(redwood_upload_manifest))
     if reg_success:
-        if not perform_upload(redwood_upload_manifest, options.force_upload):
-            logging.error("redwood upload failed")
-            sys.exit(1)
+        result.phase("upload")
+        if not perform_uploads(redwood_upload_manifest, options.force_upload,
+                               events, context.uploadController,
+                               context.uploadLimiter):
+            raise SubmissionError("redwood upload failed")
 
     else:
-        logging.error("upload registration failed")
-        sys.exit(1)
+        raise SubmissionError("upload registration failed")
 
     # generate receipt.tsv
+    result.phase("receipt")
     logging.info("now generate upload receipt")
-    collected_receipts = []
     manifest_data = parseUploadManifestFile(redwood_upload_manifest)
-    for dirName, subdirList, fileList in os.walk(options.metadataOutDir):
-        if dirName == options.metadataOutDir \
-                or os.path.basename(dirName) == redwood_upload_manifest_dir \
-                or len(subdirList) != 0:
-            continue
-        if "metadata.json" in fileList:
-            metadataFilePath = os.path.join(
-                os.getcwd(), dirName, "metadata.json")
-            metadataObj = loadJsonObj(metadataFilePath)
-
-            receipt_data = collectReceiptData(manifest_data, metadataObj)
-            for data in receipt_data:
-                collected_receipts.append(data)
-        else:
-            logging.info("no manifest file found in %s" % dirName)
-
+    receiptLines = (
+        line for bundle_uuid in sorted(structuredWorkflowObjMap)
+        for line in collectReceiptData(
+            manifest_data, structuredWorkflowObjMap[bundle_uuid]))
     receipt_file = os.path.join(options.metadataOutDir, options.receiptFile)
-    writeReceipt(collected_receipts, receipt_file)
+    result.numReceiptLines = writeReceipt(receiptLines, receipt_file)
+    result.receiptFile = receipt_file
 
     # Sent the receipt to the submission server
     if not options.skip_submit:
-        with open(receipt_file) as f:
-            r = requests.put(options.submissionServerUrl
-                             + "/v0/submissions/{}".format(submission_id),
-                             json={"receipt": f.read()})
-            logging.info("You can view the receipt at {}/v0/submissions/{}"
-                         .format(options.submissionServerUrl, submission_id))
-
-    logging.info("Upload succeeded. A detailed log is at: %s" % (logFilePath))
+        submitReceipt(options.submissionServerUrl, submission_id,
+                      receipt_file, context.session)
+
+    if logFilePath is not None:
+        logging.info("Upload succeeded. A detailed log is at: %s"
+                     % (logFilePath))
+    else:
+        logging.info("Upload succeeded.")
     runTime = getTimeDelta(startTime).total_seconds()
     logging.info("Upload took %s s." % str(runTime))
-    logging.shutdown()
+    result.phase("done", seconds=runTime)
+    return result
+
+
+def main():
+    (options, args, parser) = getOptions()
+
+    if options.watch is not None:
+        watchSpool(options)
+        return None
+
+    if len(args) == 0:
+        logging.error("no input files")
+        sys.exit(1)
+
+    if not options.merge_partitions and \
+            hasPreviousBundles(options.metadataOutDir):
+        logging.error("bundles from previous upload found in {}. Please"
+                      " use a fresh directory".format(options.metadataOutDir))
+        sys.exit(1)
+
+    if options.verbose:
+        logLevel = logging.DEBUG
+    else:
+        logLevel = logging.INFO
+    logfileName = os.path.basename(__file__).replace(".py", ".log")
+    mkdir_p(options.metadataOutDir)
+    logFilePath = os.path.join(options.metadataOutDir, logfileName)
+    logFormat = "%(asctime)s %(levelname)s %(funcName)s:%(lineno)d %(message)s"
+    setupLogging(logFilePath, logFormat, logLevel,
+                 rateLimit=options.log_rate_limit)
+
+    # !!! careful not to expose the access token !!!
+    printOptions = copy.deepcopy(vars(options))
+    logging.debug('options:\t%s' % (str(printOptions)))
+    logging.debug('args:\t%s' % (str(args)))
+
+    if options.merge_partitions:
+        if not mergePartitions(args, options):
+            logging.error("merging partitions failed")
+            sys.exit(1)
+        logging.info("Merge succeeded. A detailed log is at: %s"
+                     % (logFilePath))
+        return None
+
+    context = getSubmissionContext(options)
+    try:
+        processManifests(options, args, context, logFilePath)
+    except SubmissionError as exc:
+        logging.error(str(exc))
+        sys.exit(1)
+    finally:
+        context.events.close()
+        logqueue.stop()
+        logging.shutdown()
     return None
 
 
@@ -0,0 +1,220 @@
+"""
+watch.py
+
+Watch a spool directory for new manifests and hand each one to a processing
+function in its own output directory. Uses inotify where available and
+falls back to polling. Used by spinnaker.py --watch.
+
+Spool layout:
+    <spool>/            new manifests are dropped here
+    <spool>/processing/ manifests being processed
+    <spool>/done/       manifests processed successfully
+    <spool>/failed/     manifests that failed
+"""
+import logging
+import os
+import errno
+import select
+import signal
+import threading
+import time
+import datetime
+import ctypes
+import ctypes.util
+
+MANIFEST_EXTENSIONS = (".tsv", ".xlsx", ".xlsm", ".xltx", ".xltm")
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+
+class ThreadFilter(logging.Filter):
+    """
+    Only pass records logged from one thread.
+    """
+
+    def __init__(self, threadName):
+        logging.Filter.__init__(self)
+        self.threadName = threadName
+
+    def filter(self, record):
+        return record.threadName == self.threadName
+
+
+def openInotify(path):
+    """
+    Return an inotify fd watching path for new files, or None if inotify is
+    not available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, path,
+                                  IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+def isManifest(fileName):
+    return not fileName.startswith(".") and \
+        fileName.lower().endswith(MANIFEST_EXTENSIONS)
+
+
+def findManifests(spoolDir, settleTime):
+    """
+    List the manifests in spoolDir not modified for settleTime seconds.
+    """
+    now = time.time()
+    manifests = []
+    for fileName in sorted(os.listdir(spoolDir)):
+        filePath = os.path.join(spoolDir, fileName)
+        if not isManifest(fileName) or not os.path.isfile(filePath):
+            continue
+        if now - os.path.getmtime(filePath) < settleTime:
+            continue
+        manifests.append(filePath)
+    return manifests
+
+
+def moveTo(filePath, dirPath):
+    newPath = os.path.join(dirPath, os.path.basename(filePath))
+    os.rename(filePath, newPath)
+    return newPath
+
+
+class SpoolWatcher(object):
+    """
+    Process the manifests dropped into spoolDir with
+    processManifest(manifestPath, outputDir), at most concurrency at a time.
+    Each manifest gets its own dir below outputRoot with a log file holding
+    the messages of its processing thread.
+    """
+
+    def __init__(self, spoolDir, outputRoot, processManifest, concurrency=1,
+                 pollInterval=5.0, settleTime=2.0,
+                 logFileName="spinnaker.log", logFormat=None):
+        self.spoolDir = spoolDir
+        self.outputRoot = outputRoot
+        self.processManifest = processManifest
+        self.pollInterval = pollInterval
+        self.settleTime = settleTime
+        self.logFileName = logFileName
+        self.logFormat = logFormat
+        self.slots = threading.BoundedSemaphore(max(1, concurrency))
+        self.workers = []
+        self.stopping = threading.Event()
+        for name in ["processing", "done", "failed"]:
+            path = os.path.join(spoolDir, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def stop(self, signum=None, frame=None):
+        if not self.stopping.is_set():
+            logging.info("shutting down after the running manifests finish")
+        self.stopping.set()
+
+    def getOutputDir(self, manifestPath):
+        name = os.path.splitext(os.path.basename(manifestPath))[0]
+        stamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S%f")
+        return os.path.join(self.outputRoot, "{}-{}".format(name, stamp))
+
+    def runManifest(self, manifestPath):
+        handler = None
+        try:
+            outputDir = self.getOutputDir(manifestPath)
+            os.makedirs(outputDir)
+            handler = logging.FileHandler(os.path.join(outputDir,
+                                                       self.logFileName))
+            handler.addFilter(ThreadFilter(threading.current_thread().name))
+            if self.logFormat is not None:
+                handler.setFormatter(logging.Formatter(self.logFormat))
+            logging.getLogger('').addHandler(handler)
+            logging.info("processing %s into %s" % (manifestPath, outputDir))
+            self.processManifest(manifestPath, outputDir)
+            moveTo(manifestPath, os.path.join(self.spoolDir, "done"))
+            logging.info("done with %s" % manifestPath)
+        except BaseException as exc:
+            logging.exception("processing %s failed: %s"
+                              % (manifestPath, exc))
+            moveTo(manifestPath, os.path.join(self.spoolDir, "failed"))
+        finally:
+            if handler is not None:
+                logging.getLogger('').removeHandler(handler)
+                handler.close()
+            self.slots.release()
+
+    def startManifest(self, manifestPath):
+        # claim the manifest before processing so it's only picked up once
+        manifestPath = moveTo(manifestPath,
+                              os.path.join(self.spoolDir, "processing"))
+        worker = threading.Thread(
+            target=self.runManifest, args=(manifestPath,),
+            name="manifest-" + os.path.basename(manifestPath))
+        worker.daemon = False
+        self.workers.append(worker)
+        worker.start()
+
+    def waitForChanges(self, inotifyFd):
+        if inotifyFd is None:
+            self.stopping.wait(self.pollInterval)
+            return None
+        try:
+            readable = select.select([inotifyFd], [], [],
+                                     self.pollInterval)[0]
+        except select.error as exc:
+            if exc.args[0] == errno.EINTR:
+                return None
+            raise
+        if readable:
+            # the events themselves are not needed, the dir is rescanned
+            os.read(inotifyFd, 64 * 1024)
+            # let writers finish before the manifest is picked up
+            self.stopping.wait(self.settleTime)
+        return None
+
+    def run(self):
+        """
+        Watch the spool dir until SIGTERM or SIGINT, then wait for the
+        running manifests to finish.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        inotifyFd = openInotify(self.spoolDir)
+        logging.info("watching %s for manifests (%s)" % (
+            self.spoolDir, "inotify" if inotifyFd is not None else "polling"))
+        try:
+            while not self.stopping.is_set():
+                for manifestPath in findManifests(self.spoolDir,
+                                                  self.settleTime):
+                    # wait for a free slot without missing a shutdown
+                    acquired = False
+                    while not self.stopping.is_set():
+                        acquired = self.slots.acquire(False)
+                        if acquired:
+                            break
+                        self.stopping.wait(0.5)
+                    if not acquired:
+                        break
+                    try:
+                        self.startManifest(manifestPath)
+                    except OSError as exc:
+                        logging.error("can't start %s: %s"
+                                      % (manifestPath, exc))
+                        self.slots.release()
+                self.workers = [w for w in self.workers if w.is_alive()]
+                if not self.stopping.is_set():
+                    self.waitForChanges(inotifyFd)
+        finally:
+            if inotifyFd is not None:
+                os.close(inotifyFd)
+            for worker in self.workers:
+                while worker.is_alive():
+                    worker.join(1.0)
+        logging.info("stopped watching %s" % self.spoolDir)
+        return None